@@ -11,13 +11,21 @@ from .callbacks import (
     ProgressBarLogger,
     TemperatureUpdater,
     TensorboardLogger,
+    find_checkpoint,
+    load_checkpoint,
 )
 from .continous_communication import (
     ContinuousLinearReceiver,
     ContinuousLinearSender,
     SenderReceiverContinuousCommunication,
 )
+from .distributed import distributed_data_loader, launch_local_workers
 from .early_stopping import EarlyStopperAccuracy
+from .ensemble import (
+    EnsembleCheckpointSaver,
+    EnsembleEarlyStopperAccuracy,
+    EnsembleGame,
+)
 from .gs_wrappers import (
     GumbelSoftmaxWrapper,
     RelaxedEmbedding,
@@ -27,7 +35,15 @@ from .gs_wrappers import (
     SymbolGameGS,
     SymbolReceiverWrapper,
 )
-from .interaction import Interaction, LoggingStrategy, dump_interactions
+from .interaction import (
+    Interaction,
+    InteractionBuffer,
+    LoggingStrategy,
+    MappedInteraction,
+    RunningAuxStatistics,
+    dump_interactions,
+    save_interaction,
+)
 from .language_analysis import (
     Disent,
     MessageEntropy,
@@ -36,6 +52,7 @@ from .language_analysis import (
 )
 from .losses import DiscriminationLoss, NTXentLoss, ReconstructionLoss
 from .population import FullSweepAgentSampler, PopulationGame, UniformAgentSampler
+from .profiling import StepProfiler
 from .reinforce_wrappers import (
     CommunicationRnnReinforce,
     ReinforceDeterministicWrapper,
@@ -57,6 +74,7 @@ from .util import (
     get_opts,
     get_summary_writer,
     init,
+    message_mask,
     move_to,
 )
 
@@ -73,6 +91,8 @@ __all__ = [
     "TemperatureUpdater",
     "InteractionSaver",
     "CheckpointSaver",
+    "find_checkpoint",
+    "load_checkpoint",
     "ReinforceWrapper",
     "GumbelSoftmaxWrapper",
     "SymbolGameGS",
@@ -96,8 +116,13 @@ __all__ = [
     "TransformerSenderReinforce",
     "RnnEncoder",
     "find_lengths",
+    "message_mask",
     "LoggingStrategy",
     "Interaction",
+    "InteractionBuffer",
+    "RunningAuxStatistics",
+    "MappedInteraction",
+    "save_interaction",
     "MessageEntropy",
     "TopographicSimilarity",
     "Disent",
@@ -108,6 +133,12 @@ __all__ = [
     "UniformAgentSampler",
     "FullSweepAgentSampler",
     "PopulationGame",
+    "StepProfiler",
+    "EnsembleGame",
+    "EnsembleEarlyStopperAccuracy",
+    "EnsembleCheckpointSaver",
+    "launch_local_workers",
+    "distributed_data_loader",
     "ContinuousLinearSender",
     "ContinuousLinearReceiver",
     "SenderReceiverContinuousCommunication",
@@ -4,11 +4,18 @@
 # LICENSE file in the root directory of this source tree.
 
 from abc import ABC, abstractmethod
+from typing import Any, Dict
 
 import torch
 
 
 class Baseline(ABC):
+    """
+    Baselines keep their state in tensors that live on the device of the observed losses, so that neither `update`
+    nor `predict` synchronises with the host. The state can be checkpointed via `state_dict` / `load_state_dict`;
+    the REINFORCE games store the state of their baselines in their own state_dict.
+    """
+
     @abstractmethod
     def update(self, loss: torch.Tensor) -> None:
         """Update internal state according to the observed loss
@@ -24,6 +31,14 @@ class Baseline(ABC):
         """
         pass
 
+    def state_dict(self) -> Dict[str, Any]:
+        """Returns the internal state of the baseline"""
+        return {}
+
+    def load_state_dict(self, state_dict: Dict[str, Any]) -> None:
+        """Restores the internal state returned by `state_dict`"""
+        pass
+
 
 class NoBaseline(Baseline):
     """Baseline that does nothing (constant zero baseline)"""
@@ -41,12 +56,24 @@ class NoBaseline(Baseline):
 class MeanBaseline(Baseline):
     """Running mean baseline; all loss batches have equal importance/weight,
     hence it is better if they are equally-sized.
+
+    >>> baseline = MeanBaseline()
+    >>> baseline.update(torch.tensor([1.0, 3.0]))
+    >>> baseline.update(torch.tensor([4.0, 4.0]))
+    >>> baseline.predict(torch.zeros(2))
+    tensor([3.])
+    >>> restored = MeanBaseline()
+    >>> restored.load_state_dict(baseline.state_dict())
+    >>> restored.update(torch.tensor([6.0]))
+    >>> restored.predict(torch.zeros(2))
+    tensor([4.])
     """
 
     def __init__(self):
         super().__init__()
 
         self.mean_baseline = torch.zeros(1, requires_grad=False)
+        # the number of updates is only known on the host, it does not need any synchronisation
         self.n_points = 0.0
 
     def update(self, loss: torch.Tensor) -> None:
@@ -55,7 +82,7 @@ class MeanBaseline(Baseline):
             self.mean_baseline = self.mean_baseline.to(loss.device)
 
         self.mean_baseline += (
-            loss.detach().mean().item() - self.mean_baseline
+            loss.detach().mean() - self.mean_baseline
         ) / self.n_points
 
     def predict(self, loss: torch.Tensor) -> torch.Tensor:
@@ -63,6 +90,108 @@ class MeanBaseline(Baseline):
             self.mean_baseline = self.mean_baseline.to(loss.device)
         return self.mean_baseline
 
+    def state_dict(self) -> Dict[str, Any]:
+        return {"mean_baseline": self.mean_baseline.clone(), "n_points": self.n_points}
+
+    def load_state_dict(self, state_dict: Dict[str, Any]) -> None:
+        self.mean_baseline = state_dict["mean_baseline"].clone()
+        self.n_points = state_dict["n_points"]
+
+
+class EMABaseline(Baseline):
+    """Exponential moving average baseline, which follows the recent losses more closely than `MeanBaseline` does.
+    As in Adam, the average is corrected for its initialisation at zero.
+
+    >>> baseline = EMABaseline(decay=0.5)
+    >>> baseline.update(torch.tensor([2.0, 2.0]))
+    >>> baseline.predict(torch.zeros(2))
+    tensor([2.])
+    >>> baseline.update(torch.tensor([5.0]))
+    >>> baseline.predict(torch.zeros(2))
+    tensor([4.])
+    """
+
+    def __init__(self, decay: float = 0.99):
+        super().__init__()
+        assert 0.0 <= decay < 1.0, "decay must be in [0, 1)"
+        self.decay = decay
+
+        self.ema = torch.zeros(1, requires_grad=False)
+        self.n_points = 0.0
+
+    def update(self, loss: torch.Tensor) -> None:
+        self.n_points += 1
+        if self.ema.device != loss.device:
+            self.ema = self.ema.to(loss.device)
+
+        self.ema.mul_(self.decay).add_(loss.detach().mean(), alpha=1.0 - self.decay)
+
+    def predict(self, loss: torch.Tensor) -> torch.Tensor:
+        if self.ema.device != loss.device:
+            self.ema = self.ema.to(loss.device)
+        if self.n_points == 0:
+            return self.ema
+        return self.ema / (1.0 - self.decay ** self.n_points)
+
+    def state_dict(self) -> Dict[str, Any]:
+        return {"ema": self.ema.clone(), "n_points": self.n_points}
+
+    def load_state_dict(self, state_dict: Dict[str, Any]) -> None:
+        self.ema = state_dict["ema"].clone()
+        self.n_points = state_dict["n_points"]
+
+
+class PositionalMeanBaseline(Baseline):
+    """Running mean baseline computed separately for each position of losses of shape (batch size, positions, ...),
+    e.g. per-symbol losses of a message. The batch dimension is averaged out.
+
+    >>> baseline = PositionalMeanBaseline()
+    >>> baseline.update(torch.tensor([[1.0, 2.0, 0.0], [3.0, 2.0, 0.0]]))
+    >>> baseline.update(torch.tensor([[4.0, 5.0, 3.0]]))
+    >>> baseline.predict(torch.zeros(4, 3))
+    tensor([3.0000, 3.5000, 1.5000])
+    """
+
+    def __init__(self):
+        super().__init__()
+
+        self.mean_baseline = None
+        self.n_points = 0.0
+
+    def update(self, loss: torch.Tensor) -> None:
+        loss = loss.detach()
+        if self.mean_baseline is None:
+            self.mean_baseline = torch.zeros(
+                loss.size()[1:], dtype=torch.float, device=loss.device
+            )
+        assert (
+            self.mean_baseline.size() == loss.size()[1:]
+        ), f"expected losses of shape (batch size, {tuple(self.mean_baseline.size())}), got {tuple(loss.size())}"
+
+        self.n_points += 1
+        if self.mean_baseline.device != loss.device:
+            self.mean_baseline = self.mean_baseline.to(loss.device)
+
+        self.mean_baseline += (loss.mean(dim=0) - self.mean_baseline) / self.n_points
+
+    def predict(self, loss: torch.Tensor) -> torch.Tensor:
+        if self.mean_baseline is None:
+            return torch.zeros(loss.size()[1:], device=loss.device)
+        if self.mean_baseline.device != loss.device:
+            self.mean_baseline = self.mean_baseline.to(loss.device)
+        return self.mean_baseline
+
+    def state_dict(self) -> Dict[str, Any]:
+        mean_baseline = (
+            None if self.mean_baseline is None else self.mean_baseline.clone()
+        )
+        return {"mean_baseline": mean_baseline, "n_points": self.n_points}
+
+    def load_state_dict(self, state_dict: Dict[str, Any]) -> None:
+        mean_baseline = state_dict["mean_baseline"]
+        self.mean_baseline = None if mean_baseline is None else mean_baseline.clone()
+        self.n_points = state_dict["n_points"]
+
 
 class BuiltInBaseline(Baseline):
     """Built-in baseline; for any row in the batch, the mean of all other rows serves as a control variate.
@@ -3,12 +3,15 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import queue
+import threading
+import warnings
+from typing import Any, Dict, Iterable, Optional
 
-from typing import Any, Dict, Optional
-
+import numpy as np
 import torch
 
-from egg.core.util import move_to
+from egg.core.util import get_rng_state, move_to, pin_memory
 
 
 class Batch:
@@ -69,12 +72,135 @@ class Batch:
             [self.sender_input, self.labels, self.receiver_input, self.aux_input]
         )
 
-    def to(self, device: torch.device):
+    def to(self, device: torch.device, non_blocking: bool = False):
         """Method to move all (nested) tensors of the batch to a specific device.
         This operation doest not change the original batch element and returns a new Batch instance.
         """
-        self.sender_input = move_to(self.sender_input, device)
-        self.labels = move_to(self.labels, device)
-        self.receiver_input = move_to(self.receiver_input, device)
-        self.aux_input = move_to(self.aux_input, device)
+        self.sender_input = move_to(self.sender_input, device, non_blocking)
+        self.labels = move_to(self.labels, device, non_blocking)
+        self.receiver_input = move_to(self.receiver_input, device, non_blocking)
+        self.aux_input = move_to(self.aux_input, device, non_blocking)
+        return self
+
+    def pin_memory(self):
+        """Places all (nested) cpu tensors of the batch in page-locked memory"""
+        self.sender_input = pin_memory(self.sender_input)
+        self.labels = pin_memory(self.labels)
+        self.receiver_input = pin_memory(self.receiver_input)
+        self.aux_input = pin_memory(self.aux_input)
         return self
+
+
+class BatchPrefetcher:
+    """
+    Iterates over `data` on a background thread, which converts its items to Batch instances and moves them to
+    `device` while the consumer processes the previous batches; up to `n_batches` ready batches are kept in a
+    bounded queue. When `device` is a gpu, batches are pinned and copied with non-blocking transfers.
+
+    The batches are yielded in the order of `data`. The iterator is created, and its first two batches drawn, on the
+    calling thread, at the same points as without prefetching. If drawing the second batch changes the state of the
+    global (python, numpy or torch cpu) RNGs, as datasets adding random noise or applying random transforms do,
+    the draws of a background thread would interleave with those of the training in an order that depends on
+    timing: a warning is then issued, and the batches are drawn on the calling thread instead, so that the results
+    are the same as without prefetching. Data drawing its batches from its own random state (as the EGG data
+    iterators do) is prefetched. Exceptions raised by `data` are re-raised by the consumer.
+
+    >>> data = [(torch.tensor([i]), torch.tensor([-i])) for i in range(5)]
+    >>> [batch.sender_input.item() for batch in BatchPrefetcher(data, torch.device("cpu"), n_batches=2)]
+    [0, 1, 2, 3, 4]
+    >>> def failing():
+    ...     yield torch.zeros(1), torch.zeros(1)
+    ...     raise ValueError("broken data")
+    >>> list(BatchPrefetcher(failing(), torch.device("cpu")))
+    Traceback (most recent call last):
+    ...
+    ValueError: broken data
+    """
+
+    _end = object()
+
+    def __init__(self, data: Iterable, device: torch.device, n_batches: int = 2):
+        assert n_batches > 0, "at least one batch has to be prefetched"
+        self.data = data
+        self.device = torch.device(device)
+        if self.device.type == "cuda" and self.device.index is None:
+            # the current device of the background thread is not the one of the caller
+            self.device = torch.device("cuda", torch.cuda.current_device())
+        self.n_batches = n_batches
+
+    def __len__(self):
+        return len(self.data)
+
+    def _prepare(self, batch) -> Batch:
+        if not isinstance(batch, Batch):
+            batch = Batch(*batch)
+        if self.device.type == "cuda":
+            return batch.pin_memory().to(self.device, non_blocking=True)
+        return batch.to(self.device)
+
+    def _produce(self, iterator, ready: queue.Queue, stop: threading.Event):
+        def put(item):
+            while not stop.is_set():
+                try:
+                    ready.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        try:
+            for batch in iterator:
+                if not put(self._prepare(batch)):
+                    return
+        except BaseException as e:
+            put(e)
+            return
+        put(self._end)
+
+    def __iter__(self):
+        iterator = iter(self.data)
+        try:
+            yield self._prepare(next(iterator))
+            rng_state = get_rng_state()
+            second = next(iterator)
+        except StopIteration:
+            return
+
+        if _global_rngs_changed(rng_state, get_rng_state()):
+            warnings.warn(
+                "the data draws its batches from the global RNGs, they are not prefetched to preserve determinism"
+            )
+            yield self._prepare(second)
+            for batch in iterator:
+                yield self._prepare(batch)
+            return
+
+        ready = queue.Queue(maxsize=self.n_batches)
+        stop = threading.Event()
+        producer = threading.Thread(
+            target=self._produce, args=(iterator, ready, stop), daemon=True
+        )
+        producer.start()
+        try:
+            yield self._prepare(second)
+            while True:
+                item = ready.get()
+                if item is self._end:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            producer.join()
+
+
+def _global_rngs_changed(before: dict, after: dict) -> bool:
+    """Whether the python, numpy or torch cpu RNG states differ (see util.get_rng_state)"""
+    numpy_before, numpy_after = before["numpy"], after["numpy"]
+    return (
+        before["python"] != after["python"]
+        or not np.array_equal(numpy_before[1], numpy_after[1])
+        or numpy_before[2:] != numpy_after[2:]
+        or not torch.equal(before["torch"], after["torch"])
+    )
@@ -4,12 +4,15 @@
 # LICENSE file in the root directory of this source tree.
 
 import argparse
+import hashlib
 import json
 import os
 import pathlib
 import re
 import sys
+import time
 from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Union
 
 import torch
@@ -26,7 +29,7 @@ from rich.progress import (
 from rich.table import Table
 from rich.text import Text
 
-from egg.core.interaction import Interaction
+from egg.core.interaction import Interaction, save_interaction
 from egg.core.util import get_summary_writer
 
 
@@ -64,6 +67,11 @@ class Callback:
     ):
         pass
 
+    def needs_interaction_logs(self, epoch: int, is_training: bool) -> bool:
+        """Whether the callback needs the full interaction logs of the epoch (rather than only the means of the aux
+        metrics); checked by Trainer when the logs of the distributed workers are not gathered every batch"""
+        return False
+
 
 class ConsoleLogger(Callback):
     def __init__(self, print_train_loss=False, as_json=False):
@@ -182,6 +190,8 @@ class Checkpoint(NamedTuple):
     model_state_dict: Dict[str, Any]
     optimizer_state_dict: Dict[str, Any]
     optimizer_scheduler_state_dict: Optional[Dict[str, Any]]
+    # position of the training and RNG states, see Trainer.training_state
+    training_state: Optional[Dict[str, Any]] = None
 
 
 class CheckpointSaver(Callback):
@@ -191,39 +201,133 @@ class CheckpointSaver(Callback):
         checkpoint_freq: int = 1,
         prefix: str = "",
         max_checkpoints: int = sys.maxsize,
+        asynchronous: bool = False,
+        every_steps: int = 0,
+        every_seconds: float = 0,
     ):
         """Saves a checkpoint file for training.
         :param checkpoint_path:  path to checkpoint directory, will be created if not present
         :param checkpoint_freq:  Number of epochs for checkpoint saving
         :param prefix: Name of checkpoint file, will be {prefix}{current_epoch}.tar
         :param max_checkpoints: Max number of concurrent checkpoint files in the directory.
+        :param asynchronous: If set, checkpoints are snapshotted to cpu memory and written by a background thread,
+            while training goes on. At most one checkpoint is being written at any time, and `on_train_end` waits
+            for the last one (see `flush`).
+        :param every_steps: If positive, a checkpoint is also saved every `every_steps` optimizer steps, under
+            `{prefix}_latest.tar` (or `latest.tar`), which is overwritten each time. Trainer resumes from such
+            checkpoints at the exact step where they were taken.
+        :param every_seconds: If positive, the `latest` checkpoint is also saved at the end of the first optimizer
+            step that happens at least `every_seconds` seconds after the previous checkpoint.
+        Checkpoints are written to a temporary file that is then renamed, hence a `.tar` file is always complete.
+        Next to each checkpoint `<name>.tar`, a small json index `<name>.index.json` records its epoch, step, the
+        last train/validation metrics, its size and sha256 hash, so that checkpoints can be found (see
+        `find_checkpoint`) without reading them.
         """
         self.checkpoint_path = pathlib.Path(checkpoint_path)
         self.checkpoint_freq = checkpoint_freq
         self.prefix = prefix
         self.max_checkpoints = max_checkpoints
         self.epoch_counter = 0
+        self.every_steps = every_steps
+        self.every_seconds = every_seconds
+        self._last_save = time.monotonic()
+
+        self.asynchronous = asynchronous
+        self._checkpoint_files: Optional[List[str]] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._pending: List[Future] = []
+        self._metrics: Dict[str, Dict[str, float]] = {}
+        self._last_path: Optional[pathlib.Path] = None
+
+    def on_train_begin(self, trainer_instance: "Trainer"):  # noqa: F821
+        super().on_train_begin(trainer_instance)
+        self._last_save = time.monotonic()
+
+    def on_batch_end(
+        self, logs: Interaction, loss: float, batch_id: int, is_training: bool = True
+    ):
+        if not is_training or (batch_id + 1) % self.trainer.update_freq != 0:
+            # checkpoints are only taken right after optimizer steps
+            return
+        step = self.trainer.global_step
+        if (self.every_steps > 0 and step % self.every_steps == 0) or (
+            self.every_seconds > 0
+            and time.monotonic() - self._last_save >= self.every_seconds
+        ):
+            # the current epoch is not complete
+            self.epoch_counter = self.trainer.current_epoch - 1
+            self.save_checkpoint(
+                filename=f"{self.prefix}_latest" if self.prefix else "latest"
+            )
 
     def on_epoch_end(self, loss: float, logs: Interaction, epoch: int):
         self.epoch_counter = epoch
+        self._metrics = {"train": _mean_metrics(loss, logs)}
+        self._last_path = None
         if self.checkpoint_freq > 0 and (epoch % self.checkpoint_freq == 0):
             filename = f"{self.prefix}_{epoch}" if self.prefix else str(epoch)
             self.save_checkpoint(filename=filename)
 
+    def on_validation_end(self, loss: float, logs: Interaction, epoch: int):
+        self._metrics["validation"] = _mean_metrics(loss, logs)
+        if self._last_path is not None:
+            # the checkpoint of this epoch was saved before its validation
+            self._submit(_update_index, self._last_path, dict(metrics=self._metrics))
+
     def on_train_end(self):
         self.save_checkpoint(
             filename=f"{self.prefix}_final" if self.prefix else "final"
         )
+        self.flush()
 
     def save_checkpoint(self, filename: str):
         """
         Saves the game, agents, and optimizer states to the checkpointing path under `<number_of_epochs>.tar` name
         """
+        # the previous checkpoint must be written before a new snapshot is taken
+        self.flush()
         self.checkpoint_path.mkdir(exist_ok=True, parents=True)
-        if len(self.get_checkpoint_files()) > self.max_checkpoints:
+        checkpoint_files = self.get_checkpoint_files()
+        if len(checkpoint_files) > self.max_checkpoints:
             self.remove_oldest_checkpoint()
         path = self.checkpoint_path / f"{filename}.tar"
-        torch.save(self.get_checkpoint(), path)
+        self.write(self.get_checkpoint(), path)
+        self._last_save = time.monotonic()
+        self._last_path = path
+
+        if path.name in checkpoint_files:
+            checkpoint_files.remove(path.name)
+        checkpoint_files.append(path.name)
+
+    def write(self, obj: Any, path: pathlib.Path):
+        """Atomically saves `obj` to `path`, on the background thread if the saver is asynchronous. Checkpoints
+        get an index file."""
+        index = None
+        if isinstance(obj, Checkpoint):
+            step = obj.training_state["global_step"] if obj.training_state else None
+            index = dict(
+                epoch=obj.epoch,
+                step=step,
+                metrics=dict((k, dict(v)) for k, v in self._metrics.items()),
+                saved_at=time.time(),
+            )
+        if self.asynchronous:
+            obj = _snapshot(obj)
+        self._submit(_atomic_save, obj, path, index)
+
+    def _submit(self, fn, *args):
+        if not self.asynchronous:
+            fn(*args)
+            return
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending.append(self._executor.submit(fn, *args))
+
+    def flush(self):
+        """Waits until the pending checkpoints are written; errors of the background writes are raised here"""
+        pending, self._pending = self._pending, []
+        for future in pending:
+            future.result()
 
     def get_checkpoint(self):
         optimizer_schedule_state_dict = None
@@ -240,13 +344,19 @@ class CheckpointSaver(Callback):
             model_state_dict=game.state_dict(),
             optimizer_state_dict=self.trainer.optimizer.state_dict(),
             optimizer_scheduler_state_dict=optimizer_schedule_state_dict,
+            training_state=self.trainer.training_state(),
         )
 
     def get_checkpoint_files(self):
         """
-        Return a list of the files in the checkpoint dir
+        Return a list of the files in the checkpoint dir, from the oldest to the newest. The directory is only listed
+        once, the list is then kept up to date by the saver.
         """
-        return [name for name in os.listdir(self.checkpoint_path) if ".tar" in name]
+        if self._checkpoint_files is None:
+            self._checkpoint_files = self.natural_sort(
+                name for name in os.listdir(self.checkpoint_path) if ".tar" in name
+            )
+        return self._checkpoint_files
 
     @staticmethod
     def natural_sort(to_sort):
@@ -262,8 +372,173 @@ class CheckpointSaver(Callback):
         """
         Remove the oldest checkpoint from the dir
         """
-        checkpoints = self.natural_sort(self.get_checkpoint_files())
-        os.remove(os.path.join(self.checkpoint_path, checkpoints[0]))
+        oldest = self.checkpoint_path / self.get_checkpoint_files().pop(0)
+        for path in [oldest, _index_path(oldest)]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+def _snapshot(obj: Any) -> Any:
+    """A copy of a (nested) checkpoint where all tensors are copied to cpu memory, so that it is not affected
+    by subsequent training steps"""
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        snapshot = type(obj)((k, _snapshot(v)) for k, v in obj.items())
+        if hasattr(obj, "_metadata"):
+            # used by nn.Module.load_state_dict
+            snapshot._metadata = obj._metadata
+        return snapshot
+    if isinstance(obj, tuple) and hasattr(obj, "_fields"):
+        return type(obj)(*[_snapshot(x) for x in obj])
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_snapshot(x) for x in obj)
+    return obj
+
+
+class _HashingWriter:
+    """Forwards the writes to a file, while computing their size and sha256 hash"""
+
+    def __init__(self, f):
+        self.f = f
+        self.size = 0
+        self.hash = hashlib.sha256()
+
+    def write(self, data):
+        self.size += len(data)
+        self.hash.update(data)
+        return self.f.write(data)
+
+    def flush(self):
+        self.f.flush()
+
+
+def _atomic_write_json(obj: Any, path: pathlib.Path):
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(obj, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def _atomic_save(obj: Any, path: pathlib.Path, index: Optional[Dict[str, Any]] = None):
+    # the temporary name does not contain `.tar`, so that it is never mistaken for a checkpoint
+    tmp_path = path.with_name(f".{path.stem}.tmp")
+    with open(tmp_path, "wb") as f:
+        writer = _HashingWriter(f)
+        torch.save(obj, writer)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+    # the index is written once the checkpoint is complete
+    if index is not None:
+        index = dict(
+            index, file=path.name, size=writer.size, sha256=writer.hash.hexdigest()
+        )
+        _atomic_write_json(index, _index_path(path))
+
+
+def _update_index(path: pathlib.Path, update: Dict[str, Any]):
+    index_path = _index_path(path)
+    if index_path.exists():
+        with open(index_path) as f:
+            index = json.load(f)
+        index.update(update)
+        _atomic_write_json(index, index_path)
+
+
+def _index_path(path: pathlib.Path) -> pathlib.Path:
+    return path.with_name(f"{path.stem}.index.json")
+
+
+def _mean_metrics(loss: float, logs: Interaction) -> Dict[str, float]:
+    metrics = dict(loss=float(loss))
+    for k, v in logs.aux.items():
+        if torch.is_tensor(v) and v.numel() > 0 and v.is_floating_point():
+            metrics[k] = v.float().mean().item()
+    return metrics
+
+
+def read_checkpoint_index(
+    checkpoint_dir: Union[str, pathlib.Path]
+) -> List[Dict[str, Any]]:
+    """The index entries of the checkpoints in `checkpoint_dir`, from the oldest to the newest"""
+    checkpoint_dir = pathlib.Path(checkpoint_dir)
+    entries = []
+    for index_path in checkpoint_dir.glob("*.index.json"):
+        with open(index_path) as f:
+            entry = json.load(f)
+        if (checkpoint_dir / entry["file"]).exists():
+            entry["path"] = str(checkpoint_dir / entry["file"])
+            entries.append(entry)
+    return sorted(entries, key=lambda entry: entry["saved_at"])
+
+
+def find_checkpoint(
+    checkpoint_dir: Union[str, pathlib.Path],
+    metric: Optional[str] = None,
+    mode: str = "max",
+    split: str = "validation",
+) -> Optional[pathlib.Path]:
+    """
+    Finds a checkpoint saved by CheckpointSaver from the index files only. By default, this is the latest one;
+    if `metric` is set, the one with the best (highest for `mode="max"`, lowest for `mode="min"`) mean
+    `metric` on the `split` ("train" or "validation") at the time it was saved (the latest one among ties).
+    Returns None if none matches.
+    """
+    assert mode in ["max", "min"], f"Unknown mode: {mode}"
+    entries = read_checkpoint_index(checkpoint_dir)
+    if metric is not None:
+        entries = [
+            entry for entry in entries if metric in entry["metrics"].get(split, {})
+        ]
+        sign = 1.0 if mode == "max" else -1.0
+        entries.sort(key=lambda entry: sign * entry["metrics"][split][metric])
+    return pathlib.Path(entries[-1]["path"]) if entries else None
+
+
+def load_checkpoint(
+    path: Union[str, pathlib.Path],
+    load_optimizer: bool = True,
+    mmap: bool = True,
+    verify: bool = False,
+) -> Checkpoint:
+    """
+    Loads a checkpoint saved by CheckpointSaver.
+    :param load_optimizer: If not set, the optimizer and scheduler states are dropped (e.g. for evaluation)
+    :param mmap: If set, the tensors are memory-mapped from the file rather than read (if supported by the
+        installed torch and the file format), so that only the tensors that are used are actually read
+    :param verify: If set, the file is checked against the size and hash recorded in its index
+    """
+    path = pathlib.Path(path)
+    if verify:
+        with open(_index_path(path)) as f:
+            index = json.load(f)
+        file_hash = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                file_hash.update(chunk)
+        if file_hash.hexdigest() != index["sha256"]:
+            raise RuntimeError(f"Checkpoint {path} does not match its index")
+
+    # checkpoints are Checkpoint tuples, which are not loadable in the weights_only mode
+    checkpoint = None
+    if mmap:
+        try:
+            checkpoint = torch.load(path, weights_only=False, mmap=True)
+        except (TypeError, RuntimeError):
+            # older torch or legacy file format
+            pass
+    if checkpoint is None:
+        checkpoint = torch.load(path, weights_only=False)
+
+    if not load_optimizer:
+        checkpoint = checkpoint._replace(
+            optimizer_state_dict=None, optimizer_scheduler_state_dict=None
+        )
+    return checkpoint
 
 
 class InteractionSaver(Callback):
@@ -292,6 +567,9 @@ class InteractionSaver(Callback):
 
         self.aggregated_interaction = aggregated_interaction
 
+    def needs_interaction_logs(self, epoch: int, is_training: bool) -> bool:
+        return epoch in (self.train_epochs if is_training else self.test_epochs)
+
     @staticmethod
     def dump_interactions(
         logs: Interaction,
@@ -301,8 +579,7 @@ class InteractionSaver(Callback):
         dump_dir: str = "./interactions",
     ):
         dump_dir = pathlib.Path(dump_dir) / mode / f"epoch_{epoch}"
-        dump_dir.mkdir(exist_ok=True, parents=True)
-        torch.save(logs, dump_dir / f"interaction_gpu{rank}")
+        save_interaction(logs, dump_dir / f"interaction_gpu{rank}")
 
     def on_validation_end(self, loss: float, logs: Interaction, epoch: int):
         if epoch in self.test_epochs:
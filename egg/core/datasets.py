@@ -3,13 +3,27 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
-import itertools
 from typing import Iterable, Tuple
 
 import numpy as np
 import torch
 
 
+def attribute_value_table(n_attributes: int, n_values: int) -> torch.Tensor:
+    """
+    All the combinations of `n_attributes` attributes with values in 1..`n_values`, as a contiguous
+    (n_values ** n_attributes, n_attributes) integer tensor, in the order of itertools.product.
+
+    >>> attribute_value_table(2, 3).t()
+    tensor([[1, 1, 1, 2, 2, 2, 3, 3, 3],
+            [1, 2, 3, 1, 2, 3, 1, 2, 3]])
+    """
+    # the rows are the base-n_values representations of their indices, the first attribute being the most significant
+    radix = n_values ** torch.arange(n_attributes - 1, -1, -1)
+    indices = torch.arange(n_values ** n_attributes).unsqueeze(1)
+    return torch.div(indices, radix, rounding_mode="floor") % n_values + 1
+
+
 class AttributesValuesDataset:
     """
     >>> d1 = AttributesValuesDataset(3, 4, 20, 5)
@@ -38,9 +52,7 @@ class AttributesValuesDataset:
         self.n_batches_per_epoch = int(n_train_samples_per_epoch) // batch_size
         assert self.n_batches_per_epoch
 
-        self.samples = list(
-            itertools.product(*(range(1, n_values + 1) for _ in range(n_attributes)))
-        )
+        self.samples = attribute_value_table(n_attributes, n_values)
 
         seed = seed if seed else np.random.randint(0, 2 ** 31)
         self.seed = seed
@@ -53,6 +65,7 @@ class AttributesValuesDataset:
 
 class AttributesValuesIterator:
     """
+    >>> import itertools
     >>> samples = list(itertools.product(*(range(1, 4) for _ in range(3))))
     >>> it1 = AttributesValuesIterator(samples, 10, 2, 11)
     >>> it2 = AttributesValuesIterator(samples, 10, 2, 11)
@@ -76,7 +89,7 @@ class AttributesValuesIterator:
         self.batches_generated = 0
         self.idx = 0
 
-        self.data = samples
+        self.data = torch.as_tensor(samples)
         seed = seed if seed else np.random.randint(0, 2 ** 31)
         self.random_state = np.random.RandomState(seed)
 
@@ -93,20 +106,16 @@ class AttributesValuesIterator:
             raise StopIteration()
 
         if not self.batches_generated:
-            self.data = torch.from_numpy(
-                self.random_state.permutation(self.data)
-            ).float()
-
-        tnsr = [
-            torch.Tensor(elem)
-            for elem in self.data[self.idx : self.idx + self.batch_size]
-        ]
-        self.idx += self.batch_size - 1
-        batch = torch.stack(tnsr)
+            permutation = torch.from_numpy(
+                self.random_state.permutation(len(self.data))
+            )
+            self.data = self.data.index_select(0, permutation)
+
+        batch = self.data[self.idx : self.idx + self.batch_size].float()
         labels = torch.zeros(1)
 
         self.batches_generated += 1
-        self.idx += 1
+        self.idx += self.batch_size
 
         return batch, labels
 
@@ -151,6 +160,7 @@ class AttributesValuesWithDistractorsDataset(AttributesValuesDataset):
 
 class AttributesValuesWithDistractorsIterator(AttributesValuesIterator):
     """
+    >>> import itertools
     >>> samples = list(itertools.product(*(range(1, 4) for _ in range(3))))
     >>> it1 = AttributesValuesWithDistractorsIterator(samples, 10, 2, 1, 22)
     >>> it2 = AttributesValuesWithDistractorsIterator(samples, 10, 2, 1, 22)
@@ -184,19 +194,22 @@ class AttributesValuesWithDistractorsIterator(AttributesValuesIterator):
             raise StopIteration()
 
         if not self.batches_generated:
-            self.data = self.random_state.permutation(self.data)
+            permutation = torch.from_numpy(
+                self.random_state.permutation(len(self.data))
+            )
+            self.data = self.data.index_select(0, permutation)
 
         # fmt: off
         idxs = self.random_state.randint(len(self.data), size=(self.batch_size * (self.distractors+1)))  # noqa: E226
-        receiver_input = np.reshape(self.data[idxs], (self.batch_size, self.distractors+1, -1))  # noqa: E226
         labels = self.random_state.choice(self.distractors+1, size=self.batch_size)  # noqa: E226
         # fmt: on
-        target = receiver_input[np.arange(self.batch_size), labels]  # noqa: E226
+        idxs = torch.from_numpy(idxs).view(self.batch_size, self.distractors + 1)
+        labels = torch.from_numpy(labels).long()
+
+        receiver_input = self.data[idxs].float()
+        target = receiver_input[torch.arange(self.batch_size), labels]
 
         self.batches_generated += 1
         self.idx += 1
 
-        target = torch.from_numpy(target).float()
-        labels = torch.from_numpy(labels).long()
-        receiver_input = torch.from_numpy(receiver_input).float()
         return target, labels, receiver_input
@@ -7,8 +7,11 @@ import pathlib
 import subprocess
 import uuid
 from dataclasses import dataclass
+from typing import Callable, Optional
 
+import torch
 import torch.distributed as dist
+from torch.utils.data import DataLoader, Dataset, DistributedSampler
 
 
 @dataclass(frozen=True, repr=True, eq=True, unsafe_hash=True)
@@ -18,11 +21,24 @@ class DistributedContext:
     local_rank: int
     world_size: int
     mode: str
+    backend: str = "none"
 
     @property
     def is_leader(self) -> bool:
         return self.rank == 0
 
+    @property
+    def uses_cuda(self) -> bool:
+        return self.backend == "nccl"
+
+
+def get_backend(args) -> str:
+    """The backend requested with --distributed_backend; by default, nccl when training on GPUs and gloo otherwise"""
+    backend = getattr(args, "distributed_backend", None)
+    if backend is None:
+        backend = "nccl" if getattr(args, "cuda", True) else "gloo"
+    return backend
+
 
 def maybe_init_distributed(args) -> DistributedContext:
     assert not hasattr(
@@ -33,6 +49,8 @@ def maybe_init_distributed(args) -> DistributedContext:
         is_distributed=False, rank=0, local_rank=0, world_size=1, mode="none"
     )
 
+    backend = get_backend(args)
+
     launch_keys = ["MASTER_ADDR", "MASTER_PORT", "WORLD_SIZE", "RANK", "LOCAL_RANK"]
     slurm_keys = [
         "SLURM_LOCALID",
@@ -54,9 +72,10 @@ def maybe_init_distributed(args) -> DistributedContext:
             world_size=world_size,
             local_rank=local_rank,
             mode="launch",
+            backend=backend,
         )
         dist.init_process_group(
-            backend="nccl", init_method=init_method, world_size=world_size, rank=rank
+            backend=backend, init_method=init_method, world_size=world_size, rank=rank
         )
     # is it slurm?
     elif all(key in os.environ for key in slurm_keys):
@@ -83,9 +102,10 @@ def maybe_init_distributed(args) -> DistributedContext:
                 local_rank=local_rank,
                 world_size=world_size,
                 mode="slurm",
+                backend=backend,
             )
             dist.init_process_group(
-                backend="nccl",
+                backend=backend,
                 init_method=init_method,
                 world_size=world_size,
                 rank=rank,
@@ -94,6 +114,52 @@ def maybe_init_distributed(args) -> DistributedContext:
     return context
 
 
+def launch_local_workers(
+    main: Callable, n_workers: int, *args, port: Optional[int] = None
+) -> None:
+    """
+    Runs `main(*args)` in `n_workers` local processes that are set up as torch.distributed.launch would do, so that
+    `core.init` puts each of them in the same distributed group (using gloo, unless training on GPUs). This allows
+    data-parallel training on CPU-only machines, e.g.
+        launch_local_workers(main, 4, sys.argv[1:], port=18363)
+    `main` and `args` must be picklable, i.e. `main` has to be defined at the top level of a module.
+    """
+    assert n_workers > 0, "at least one worker is needed"
+    port = 18363 if port is None else port
+    torch.multiprocessing.spawn(
+        _run_local_worker,
+        args=(main, n_workers, port, args),
+        nprocs=n_workers,
+        join=True,
+    )
+
+
+def _run_local_worker(rank, main, n_workers, port, args):
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(port)
+    os.environ["WORLD_SIZE"] = str(n_workers)
+    os.environ["RANK"] = str(rank)
+    os.environ["LOCAL_RANK"] = str(rank)
+    main(*args)
+
+
+def distributed_data_loader(
+    dataset: Dataset, batch_size: int, shuffle: bool = True, **kwargs
+) -> DataLoader:
+    """
+    A DataLoader over the shard of `dataset` that belongs to this worker (see DistributedSampler); if
+    torch.distributed is not initialized, it is a plain DataLoader over the whole dataset.
+    Trainer calls `set_epoch` of the sampler at the beginning of each epoch, so that the shuffling changes across
+    epochs.
+    """
+    if not dist.is_initialized():
+        return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, **kwargs)
+
+    drop_last = kwargs.get("drop_last", False)
+    sampler = DistributedSampler(dataset, shuffle=shuffle, drop_last=drop_last)
+    return DataLoader(dataset, batch_size=batch_size, sampler=sampler, **kwargs)
+
+
 # should be part of the dustributed context
 def get_preemptive_checkpoint_dir(checkpoint_root):
     if "SLURM_JOB_ID" not in os.environ:
@@ -0,0 +1,302 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import random
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Sequence
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.func import functional_call, vmap
+
+from .callbacks import Checkpoint, CheckpointSaver
+from .early_stopping import EarlyStopperAccuracy
+from .interaction import Interaction
+from .util import _set_seed
+from .vectorization import (
+    concatenate_stacked,
+    flatten_interaction,
+    probe_vmap,
+    stack_state,
+    write_back_buffers,
+)
+
+
+class EnsembleGame(nn.Module):
+    """
+    Trains K copies of a game, which only differ by their random seed, in a single process: each batch is played by
+    all the members (e.g. the games of a seed sweep) at once. The parameters of the members are stacked along a
+    leading member dimension and the game is run by `torch.func.vmap` over it, so that the K members launch the
+    kernels of a single, K times bigger, model. As the members do not share any parameter, the gradient of each
+    member only comes from its own loss, and they are all updated by a single optimisation step of an optimizer
+    holding all their parameters.
+
+    Each member is built by `game_factory` after seeding all the RNGs with its seed, so that it is initialised as a
+    solo run with that seed would be. Under vmap, the members draw different random numbers from the global torch
+    RNG. Games that cannot be vmapped (e.g. games that call `.item()` or branch on tensor values in their forward),
+    or whose forward updates python-side state (e.g. the baselines of REINFORCE games: under vmap, the python code
+    runs once for all the members, which would share that state) are detected at their first forward in each mode,
+    and their members are then run one after another; in that mode, each member keeps its own state and torch RNG
+    stream, and reproduces the sampling of a solo run.
+
+    The returned loss, which is both reported and optimised, is the mean of the members' losses: each member gets
+    1/K of the gradient of its own loss. This does not matter to optimizers that are invariant to the scale of the
+    gradient, such as Adam; with SGD, the learning rate has to be multiplied by K to match solo runs.
+
+    The returned interaction concatenates the interactions of the members (the rows of member k follow those of
+    member k-1), so that its fields keep their usual layout; `aux["member"]` tells which member each row belongs
+    to. Besides the aux fields of the game, `aux` holds each member's `loss_member<k>` and `<field>_member<k>`,
+    averaged over the member's batch and repeated over all the rows, so that they are reported by the loggers.
+    Members can be frozen by setting `active[k] = False` (see `EnsembleEarlyStopperAccuracy`): they are then skipped
+    during training, but still evaluated.
+
+    >>> class Game(nn.Module):
+    ...     def __init__(self):
+    ...         super().__init__()
+    ...         self.fc = nn.Linear(2, 1)
+    ...     def forward(self, x, labels):
+    ...         loss = (self.fc(x).squeeze(1) - labels).pow(2)
+    ...         return loss.mean(), Interaction(x, None, labels, None, None, None, None, {"sq_err": loss})
+    >>> ensemble = EnsembleGame(Game, seeds=[1, 2, 3])
+    >>> solo = EnsembleGame(Game, seeds=[2])
+    >>> torch.equal(ensemble.members[1].fc.weight, solo.members[0].fc.weight)
+    True
+    >>> loss, interaction = ensemble(torch.ones(4, 2), torch.zeros(4))
+    >>> interaction.size, interaction.aux["member"].tolist()
+    (12, [0.0, 0.0, 0.0, 0.0, 1.0, 1.0, 1.0, 1.0, 2.0, 2.0, 2.0, 2.0])
+    >>> solo_loss, _ = solo(torch.ones(4, 2), torch.zeros(4))
+    >>> torch.allclose(interaction.aux["loss_member1"], solo_loss)
+    True
+    >>> torch.allclose(interaction.aux["sq_err"][4:8].mean(), interaction.aux["sq_err_member1"][0])
+    True
+    >>> torch.allclose(interaction.aux["sq_err_member1"].mean(), solo_loss)
+    True
+    """
+
+    def __init__(
+        self,
+        game_factory: Callable[[], nn.Module],
+        seeds: Sequence[int],
+        vectorize: bool = True,
+    ):
+        """
+        :param game_factory: builds a member
+        :param seeds: the seeds of the members
+        :param vectorize: run the members under vmap (if the game allows it); otherwise, they are run one after
+            another
+        """
+        super().__init__()
+        assert seeds, "an ensemble needs at least one member"
+        self.seeds = list(seeds)
+        self.vectorize = vectorize
+        self._vmapped_modes = set()
+
+        members = []
+        self._rng_states = []
+        with _preserved_rng():
+            for seed in self.seeds:
+                _set_seed(seed)
+                members.append(game_factory())
+                self._rng_states.append(_get_torch_rng_state())
+        self.members = nn.ModuleList(members)
+
+        self.active = [True] * len(self.members)
+
+    @contextmanager
+    def _member_rng(self, k):
+        """Runs the enclosed code with the torch RNG stream of the k-th member"""
+        state = _get_torch_rng_state()
+        _set_torch_rng_state(self._rng_states[k])
+        try:
+            yield
+        finally:
+            self._rng_states[k] = _get_torch_rng_state()
+            _set_torch_rng_state(state)
+
+    def forward(self, *args, **kwargs):
+        playing = [
+            k for k in range(len(self.members)) if self.active[k] or not self.training
+        ]
+        if not self.vectorize:
+            losses, fields = self._sequential_forward(playing, args, kwargs)
+        elif self.training in self._vmapped_modes:
+            losses, fields = self._vectorized_forward(playing, args, kwargs)
+        else:
+            # whether the game can be vmapped is found out by the first forward in each mode
+            (losses, fields), self.vectorize = probe_vmap(
+                lambda: self._vectorized_forward(playing, args, kwargs),
+                lambda: self._sequential_forward(playing, args, kwargs),
+                self.members,
+                name="the game",
+            )
+            if self.vectorize:
+                self._vmapped_modes.add(self.training)
+
+        return losses.mean(), _ensemble_interaction(playing, losses, fields)
+
+    def _vectorized_forward(self, playing, args, kwargs):
+        members = [self.members[k] for k in playing]
+        params, buffers = stack_state(members)
+
+        def play(params, buffers):
+            loss, interaction = functional_call(
+                self.members[0], (params, buffers), args, kwargs
+            )
+            return loss, flatten_interaction(interaction)
+
+        losses, fields = vmap(play, randomness="different")(params, buffers)
+        # the buffers updated in place by the game (e.g. running statistics) are written back to the members
+        write_back_buffers(members, buffers)
+        return losses, fields
+
+    def _sequential_forward(self, playing, args, kwargs):
+        losses, fields = [], []
+        for k in playing:
+            with self._member_rng(k):
+                loss, interaction = self.members[k](*args, **kwargs)
+            losses.append(loss)
+            fields.append(flatten_interaction(interaction))
+        return torch.stack(losses), dict(
+            (name, torch.stack([f[name] for f in fields])) for name in fields[0]
+        )
+
+    @staticmethod
+    def member_optimizer_state_dict(
+        optimizer: torch.optim.Optimizer, member: nn.Module
+    ):
+        """The part of the state_dict of `optimizer` that concerns the parameters of `member`, as the state_dict of
+        an optimizer of the same type built on member.parameters() would be"""
+        index, i = {}, 0
+        for group in optimizer.param_groups:
+            for param in group["params"]:
+                index[id(param)] = i
+                i += 1
+        member_ids = [index[id(p)] for p in member.parameters() if id(p) in index]
+        remap = {old: new for new, old in enumerate(member_ids)}
+
+        state_dict = optimizer.state_dict()
+        param_groups = []
+        for group in state_dict["param_groups"]:
+            params = [remap[i] for i in group["params"] if i in remap]
+            if params:
+                param_groups.append({**group, "params": params})
+        state = {remap[i]: v for i, v in state_dict["state"].items() if i in remap}
+        return {"state": state, "param_groups": param_groups}
+
+
+def _get_ensemble(trainer) -> EnsembleGame:
+    game = trainer.game
+    if trainer.distributed_context.is_distributed:
+        game = game.module
+    assert isinstance(game, EnsembleGame), "the trained game must be an EnsembleGame"
+    return game
+
+
+class EnsembleEarlyStopperAccuracy(EarlyStopperAccuracy):
+    """
+    Per-member early stopping for `EnsembleGame`: the members whose mean `<field_name>_member<k>` reaches the
+    threshold are frozen, and training stops once all the members are.
+    """
+
+    def should_stop(self) -> bool:
+        if self.validation:
+            assert (
+                self.validation_stats
+            ), "Validation data must be provided for early stooping to work"
+            loss, last_epoch_interactions = self.validation_stats[-1]
+        else:
+            assert (
+                self.train_stats
+            ), "Training data must be provided for early stooping to work"
+            loss, last_epoch_interactions = self.train_stats[-1]
+
+        ensemble = _get_ensemble(self.trainer)
+        for k in range(len(ensemble.members)):
+            member_metric = last_epoch_interactions.aux.get(
+                f"{self.field_name}_member{k}"
+            )
+            # members absent from the (training) logs are frozen already
+            if member_metric is not None and member_metric.mean() >= self.threshold:
+                ensemble.active[k] = False
+
+        return not any(ensemble.active)
+
+
+class EnsembleCheckpointSaver(CheckpointSaver):
+    """
+    Besides the checkpoint of the whole ensemble (as CheckpointSaver), saves a checkpoint of each member under
+    `checkpoint_path/seed<seed>/`, with the same file names. The member checkpoints hold the member's model and
+    optimizer states, and can be loaded by a Trainer of the game alone.
+    """
+
+    def save_checkpoint(self, filename: str):
+        super().save_checkpoint(filename)
+
+        ensemble = _get_ensemble(self.trainer)
+        for seed, member in zip(ensemble.seeds, ensemble.members):
+            member_path = self.checkpoint_path / f"seed{seed}"
+            member_path.mkdir(exist_ok=True, parents=True)
+            checkpoint = Checkpoint(
+                epoch=self.epoch_counter,
+                model_state_dict=member.state_dict(),
+                optimizer_state_dict=EnsembleGame.member_optimizer_state_dict(
+                    self.trainer.optimizer, member
+                ),
+                optimizer_scheduler_state_dict=None,
+            )
+            self.write(checkpoint, member_path / f"{filename}.tar")
+
+
+def _ensemble_interaction(
+    playing: List[int], losses: torch.Tensor, fields: Dict[str, torch.Tensor]
+) -> Interaction:
+    """Concatenates the interactions of the members, whose fields are stacked along dim 0"""
+    interaction = concatenate_stacked(fields)
+    batch_size = interaction.size // len(playing)
+
+    def member_rows(value):
+        # a metric of one member, averaged over its batch and repeated over all the rows
+        if value.dim() > 0 and value.size(0) == batch_size:
+            value = value.float().mean(dim=0)
+        return value.expand(interaction.size, *value.size())
+
+    for name, values in fields.items():
+        if name.startswith("aux/"):
+            for i, k in enumerate(playing):
+                interaction.aux[f"{name[len('aux/'):]}_member{k}"] = member_rows(
+                    values[i]
+                )
+    for i, k in enumerate(playing):
+        interaction.aux[f"loss_member{k}"] = member_rows(losses[i].detach())
+    interaction.aux["member"] = torch.tensor(
+        playing, dtype=torch.float, device=losses.device
+    ).repeat_interleave(batch_size)
+    return interaction
+
+
+def _get_torch_rng_state():
+    cuda_state = torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None
+    return torch.get_rng_state(), cuda_state
+
+
+def _set_torch_rng_state(state):
+    cpu_state, cuda_state = state
+    torch.set_rng_state(cpu_state)
+    if cuda_state is not None:
+        torch.cuda.set_rng_state_all(cuda_state)
+
+
+@contextmanager
+def _preserved_rng():
+    """Restores the python, numpy and torch RNG states on exit"""
+    python_state, numpy_state = random.getstate(), np.random.get_state()
+    torch_state = _get_torch_rng_state()
+    try:
+        yield
+    finally:
+        random.setstate(python_state)
+        np.random.set_state(numpy_state)
+        _set_torch_rng_state(torch_state)
@@ -10,6 +10,7 @@ import torch.nn.functional as F
 from torch.distributions import RelaxedOneHotCategorical
 
 from .interaction import LoggingStrategy
+from .util import call_on_unique_messages
 
 
 def gumbel_softmax_sample(
@@ -18,23 +19,16 @@ def gumbel_softmax_sample(
     training: bool = True,
     straight_through: bool = False,
 ):
-
-    size = logits.size()
     if not training:
         indexes = logits.argmax(dim=-1)
-        one_hot = torch.zeros_like(logits).view(-1, size[-1])
-        one_hot.scatter_(1, indexes.view(-1, 1), 1)
-        one_hot = one_hot.view(*size)
-        return one_hot
+        # out-of-place, so that it has a batching rule under torch.func.vmap
+        return torch.zeros_like(logits).scatter(-1, indexes.unsqueeze(-1), 1)
 
     sample = RelaxedOneHotCategorical(logits=logits, temperature=temperature).rsample()
 
     if straight_through:
-        size = sample.size()
         indexes = sample.argmax(dim=-1)
-        hard_sample = torch.zeros_like(sample).view(-1, size[-1])
-        hard_sample.scatter_(1, indexes.view(-1, 1), 1)
-        hard_sample = hard_sample.view(*size)
+        hard_sample = torch.zeros_like(sample).scatter(-1, indexes.unsqueeze(-1), 1)
 
         sample = sample + (hard_sample - sample).detach()
     return sample
@@ -146,6 +140,7 @@ class SymbolGameGS(nn.Module):
         loss: Callable,
         train_logging_strategy: Optional[LoggingStrategy] = None,
         test_logging_strategy: Optional[LoggingStrategy] = None,
+        deduplicate_messages: bool = False,
     ):
         """
         :param sender: Sender agent. sender.forward() has to output log-probabilities over the vocabulary.
@@ -159,11 +154,15 @@ class SymbolGameGS(nn.Module):
           * labels: labels that come from dataset
         :param train_logging_strategy, test_logging_strategy: specify what parts of interactions to persist for
             later analysis in the callbacks.
+        :param deduplicate_messages: If set, in evaluation mode (where Sender's messages are one-hot) and when there
+            is neither receiver_input nor aux_input, Receiver is only run once per distinct message
+            (see util.call_on_unique_messages)
         """
         super(SymbolGameGS, self).__init__()
         self.sender = sender
         self.receiver = receiver
         self.loss = loss
+        self.deduplicate_messages = deduplicate_messages
         self.train_logging_strategy = (
             LoggingStrategy()
             if train_logging_strategy is None
@@ -177,7 +176,17 @@ class SymbolGameGS(nn.Module):
 
     def forward(self, sender_input, labels, receiver_input=None, aux_input=None):
         message = self.sender(sender_input, aux_input)
-        receiver_output = self.receiver(message, receiver_input, aux_input)
+        if (
+            self.deduplicate_messages
+            and not self.training
+            and receiver_input is None
+            and not aux_input
+        ):
+            receiver_output = call_on_unique_messages(
+                lambda m: self.receiver(m, None, aux_input), message
+            )
+        else:
+            receiver_output = self.receiver(message, receiver_input, aux_input)
 
         loss, aux_info = self.loss(
             sender_input, message, receiver_input, receiver_output, labels, aux_input
@@ -368,11 +377,40 @@ class RnnReceiverGS(nn.Module):
     into the output vector. Since, due to the relaxation, end-of-sequence symbol might have non-zero probability at
     each timestep of the message, `RnnReceiverGS` is applied for each timestep. The corresponding EOS logic
     is handled by `SenderReceiverRnnGS`.
+
+    With `fused=True`, the whole message is processed by a single call of the corresponding nn.RNN/nn.GRU/nn.LSTM
+    module (sharing the parameters of the cell, hence the state_dict is the same in both modes) and the agent is
+    called once on the hidden states of all timesteps, stacked into a (batch size * message length, hidden size)
+    tensor. This requires the agent to process each row independently; `input` and the tensors in `aux_input`
+    that have a leading batch dimension are repeated for each timestep.
+
+    >>> class Agent(nn.Module):
+    ...     def __init__(self):
+    ...         super().__init__()
+    ...         self.fc = nn.Linear(5, 3)
+    ...     def forward(self, x, _input=None, _aux_input=None):
+    ...         return self.fc(x)
+    >>> receiver = RnnReceiverGS(Agent(), vocab_size=4, embed_dim=2, hidden_size=5, cell='lstm')
+    >>> fused = RnnReceiverGS(Agent(), vocab_size=4, embed_dim=2, hidden_size=5, cell='lstm', fused=True)
+    >>> _ = fused.load_state_dict(receiver.state_dict())
+    >>> message = torch.eye(4).unsqueeze(0).expand(6, -1, -1)
+    >>> output = receiver(message)
+    >>> output.size()  # batch size x message length x agent output size
+    torch.Size([6, 4, 3])
+    >>> torch.allclose(output, fused(message), atol=1e-6)
+    True
+    >>> fused.state_dict().keys() == receiver.state_dict().keys()
+    True
+    >>> fused.double()(message.double()).dtype  # the fused module follows the cell
+    torch.float64
     """
 
-    def __init__(self, agent, vocab_size, embed_dim, hidden_size, cell="rnn"):
+    def __init__(
+        self, agent, vocab_size, embed_dim, hidden_size, cell="rnn", fused=False
+    ):
         super(RnnReceiverGS, self).__init__()
         self.agent = agent
+        self.fused = fused
 
         self.cell = None
         cell = cell.lower()
@@ -386,8 +424,13 @@ class RnnReceiverGS(nn.Module):
             raise ValueError(f"Unknown RNN Cell: {cell}")
 
         self.embedding = nn.Linear(vocab_size, embed_dim)
+        # runs the cell over whole messages in the fused mode; not a submodule (see _FusedRnn)
+        self.fused_rnn = _FusedRnn(self.cell)
 
     def forward(self, message, input=None, aux_input=None):
+        if self.fused:
+            return self._fused_forward(message, input, aux_input)
+
         outputs = []
 
         emb = self.embedding(message)
@@ -414,6 +457,60 @@ class RnnReceiverGS(nn.Module):
 
         return outputs
 
+    def _fused_forward(self, message, input=None, aux_input=None):
+        emb = self.embedding(message)
+        batch_size, seq_len = emb.size(0), emb.size(1)
+
+        hidden = self.fused_rnn(emb)
+        hidden = hidden.reshape(batch_size * seq_len, -1)
+
+        def repeat(x):
+            if torch.is_tensor(x) and x.dim() > 0 and x.size(0) == batch_size:
+                return x.repeat_interleave(seq_len, dim=0)
+            return x
+
+        if input is not None:
+            input = repeat(input)
+        if aux_input:
+            aux_input = {k: repeat(v) for k, v in aux_input.items()}
+
+        outputs = self.agent(hidden, input, aux_input)
+        return outputs.view(batch_size, seq_len, *outputs.size()[1:])
+
+
+class _FusedRnn:
+    """
+    The nn.RNN/nn.GRU/nn.LSTM module matching an RNN cell, and sharing the parameters of the cell. It is a plain
+    (non-module) attribute of its owner, so that the parameters and the state_dict of the owner are those of the cell
+    only; as the parameters are the same objects, they follow the cell when it is moved or loaded.
+    """
+
+    def __init__(self, cell):
+        if isinstance(cell, nn.RNNCell):
+            rnn = nn.RNN(
+                cell.input_size,
+                cell.hidden_size,
+                nonlinearity=cell.nonlinearity,
+                batch_first=True,
+                device="meta",
+            )
+        else:
+            rnn_type = {nn.GRUCell: nn.GRU, nn.LSTMCell: nn.LSTM}[type(cell)]
+            rnn = rnn_type(
+                cell.input_size, cell.hidden_size, batch_first=True, device="meta"
+            )
+        # replaces the (meta) parameters of the module by those of the cell
+        for name, param in cell.named_parameters():
+            setattr(rnn, f"{name}_l0", param)
+        self.rnn = rnn
+
+    def __call__(self, embedded: torch.Tensor) -> torch.Tensor:
+        # on cuda, packs the weights into the single contiguous buffer used by cuDNN, unless they already are (they
+        # are not after the cell was moved or loaded), so that they are not copied at every call
+        self.rnn.flatten_parameters()
+        output, _ = self.rnn(embedded)
+        return output
+
 
 class SenderReceiverRnnGS(nn.Module):
     """
@@ -455,6 +552,7 @@ class SenderReceiverRnnGS(nn.Module):
         length_cost=0.0,
         train_logging_strategy: Optional[LoggingStrategy] = None,
         test_logging_strategy: Optional[LoggingStrategy] = None,
+        vectorized_loss: Optional[bool] = None,
     ):
         """
         :param sender: sender agent
@@ -471,6 +569,10 @@ class SenderReceiverRnnGS(nn.Module):
         :param length_cost: the penalty applied to Sender for each symbol produced
         :param train_logging_strategy, test_logging_strategy: specify what parts of interactions to persist for
             later analysis in the callbacks.
+        :param vectorized_loss: if set, the loss is called once for all message positions, instead of once per
+            position: it gets the whole message and receiver_output of shape (batch size, message length, ...) and
+            returns the loss and the auxiliary information of shape (batch size, message length). By default, it is
+            set to the `vectorized` attribute of the loss, if any (see `DiscriminationLoss` and `ReconstructionLoss`).
 
         """
         super(SenderReceiverRnnGS, self).__init__()
@@ -478,6 +580,9 @@ class SenderReceiverRnnGS(nn.Module):
         self.receiver = receiver
         self.loss = loss
         self.length_cost = length_cost
+        if vectorized_loss is None:
+            vectorized_loss = getattr(loss, "vectorized", False)
+        self.vectorized_loss = vectorized_loss
         self.train_logging_strategy = (
             LoggingStrategy()
             if train_logging_strategy is None
@@ -493,6 +598,83 @@ class SenderReceiverRnnGS(nn.Module):
         message = self.sender(sender_input, aux_input)
         receiver_output = self.receiver(message, receiver_input, aux_input)
 
+        if self.vectorized_loss:
+            loss, aux_info, expected_length = self._vectorized_loss(
+                sender_input,
+                message,
+                receiver_input,
+                receiver_output,
+                labels,
+                aux_input,
+            )
+        else:
+            loss, aux_info, expected_length = self._stepwise_loss(
+                sender_input,
+                message,
+                receiver_input,
+                receiver_output,
+                labels,
+                aux_input,
+            )
+
+        logging_strategy = (
+            self.train_logging_strategy if self.training else self.test_logging_strategy
+        )
+        interaction = logging_strategy.filtered_interaction(
+            sender_input=sender_input,
+            receiver_input=receiver_input,
+            labels=labels,
+            aux_input=aux_input,
+            receiver_output=receiver_output.detach(),
+            message=message.detach(),
+            message_length=expected_length.detach(),
+            aux=aux_info,
+        )
+
+        return loss.mean(), interaction
+
+    def _vectorized_loss(
+        self, sender_input, message, receiver_input, receiver_output, labels, aux_input
+    ):
+        step_loss, step_aux = self.loss(
+            sender_input, message, receiver_input, receiver_output, labels, aux_input
+        )
+
+        eos_mask = message[:, :, 0]  # always eos == 0
+        not_eosed = torch.cumprod(1.0 - eos_mask, dim=1)
+        not_eosed_before = torch.cat(
+            [torch.ones_like(not_eosed[:, :1]), not_eosed[:, :-1]], dim=1
+        )
+        add_mask = eos_mask * not_eosed_before
+        # the remainder of the probability mass goes to the last position
+        remainder = not_eosed[:, -1]
+        weights = torch.cat(
+            [add_mask[:, :-1], (add_mask[:, -1] + remainder).unsqueeze(1)], dim=1
+        )
+
+        z = weights.sum(dim=1)
+        assert z.allclose(
+            torch.ones_like(z)
+        ), f"lost probability mass, {z.min()}, {z.max()}"
+
+        steps = torch.arange(
+            1, message.size(1) + 1, device=message.device, dtype=weights.dtype
+        )
+        loss = (step_loss * weights).sum(dim=1) + self.length_cost * (
+            weights * steps
+        ).sum(dim=1)
+        expected_length = (add_mask.detach() * steps).sum(dim=1) + steps[-1] * remainder
+
+        aux_info = {
+            name: (value * weights).sum(dim=1) for name, value in step_aux.items()
+        }
+        aux_info["length"] = expected_length
+
+        return loss, aux_info, expected_length
+
+    def _stepwise_loss(
+        self, sender_input, message, receiver_input, receiver_output, labels, aux_input
+    ):
         loss = 0
         not_eosed_before = torch.ones(receiver_output.size(0)).to(
             receiver_output.device
@@ -539,18 +721,4 @@ class SenderReceiverRnnGS(nn.Module):
 
         aux_info["length"] = expected_length
 
-        logging_strategy = (
-            self.train_logging_strategy if self.training else self.test_logging_strategy
-        )
-        interaction = logging_strategy.filtered_interaction(
-            sender_input=sender_input,
-            receiver_input=receiver_input,
-            labels=labels,
-            aux_input=aux_input,
-            receiver_output=receiver_output.detach(),
-            message=message.detach(),
-            message_length=expected_length.detach(),
-            aux=aux_info,
-        )
-
-        return loss.mean(), interaction
+        return loss, aux_info, expected_length
@@ -3,13 +3,20 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import json
+import math
+import pathlib
+import pickle
+from collections.abc import Mapping
 from dataclasses import dataclass
-from typing import Dict, Iterable, Optional
+from typing import Any, Dict, Iterable, Optional, Union
 
+import numpy as np
 import torch
 import torch.distributed as distrib
 
 from egg.core.batch import Batch
+from egg.core.util import message_mask
 
 
 @dataclass(repr=True, eq=True)
@@ -178,54 +185,442 @@ class Interaction:
 
     @staticmethod
     def gather_distributed_interactions(log: "Interaction") -> Optional["Interaction"]:
+        """
+        Concatenates the interactions of all the workers, in the order of their ranks. All the tensors are
+        packed into a single byte buffer, so that the gathering takes two collectives (the sizes and the buffer),
+        whatever the number of fields; the workers can hold interactions of different sizes (e.g. the last batch of
+        an epoch), but they must have the same fields, with the same dtypes and trailing dimensions.
+        """
         assert (
             distrib.is_initialized()
         ), "torch.distributed must be initialized beforehand"
         world_size = distrib.get_world_size()
+        # nccl only communicates cuda tensors, gloo can gather cpu tensors directly
+        device = "cuda" if distrib.get_backend() == "nccl" else "cpu"
+
+        fields = [
+            "sender_input",
+            "receiver_input",
+            "labels",
+            "message",
+            "message_length",
+            "receiver_output",
+        ]
+        slots = [(None, name, getattr(log, name)) for name in fields]
+        for group in ["aux_input", "aux"]:
+            d = getattr(log, group) or {}
+            slots.extend((group, k, v) for k, v in d.items())
+
+        tensors = []
+        for _, _, v in slots:
+            if v is not None:
+                v = v.detach().contiguous()
+                tensors.append(v.unsqueeze(0) if v.dim() == 0 else v)
+
+        # every worker sends the leading dimension of each of its tensors...
+        local_sizes = torch.tensor([t.size(0) for t in tensors], device=device)
+        sizes = [torch.zeros_like(local_sizes) for _ in range(world_size)]
+        distrib.all_gather(sizes, local_sizes)
+        sizes = torch.stack(sizes).tolist()
+
+        # ... and then all of them as a single, padded, buffer of bytes; the row sizes are taken from the shapes,
+        # as a worker may hold no row of a field
+        row_bytes = [math.prod(t.shape[1:]) * t.element_size() for t in tensors]
+        n_bytes = [
+            sum(n * b for n, b in zip(rank_sizes, row_bytes)) for rank_sizes in sizes
+        ]
+        buffer = torch.zeros(max(n_bytes), dtype=torch.uint8, device=device)
+        if tensors:
+            payload = torch.cat(
+                [t.reshape(-1).view(torch.uint8).to(device) for t in tensors]
+            )
+            buffer[: payload.numel()] = payload
+        buffers = [torch.zeros_like(buffer) for _ in range(world_size)]
+        distrib.all_gather(buffers, buffer)
+
+        gathered = [[] for _ in tensors]
+        for rank_buffer, rank_sizes in zip(buffers, sizes):
+            rank_buffer, offset = rank_buffer.cpu(), 0
+            for i, (t, n, b) in enumerate(zip(tensors, rank_sizes, row_bytes)):
+                chunk = rank_buffer[offset : offset + n * b].clone()
+                gathered[i].append(chunk.view(t.dtype).view(n, *t.shape[1:]))
+                offset += n * b
+        gathered = iter([torch.cat(parts, dim=0) for parts in gathered])
+
+        interaction_as_dict = {"aux_input": {}, "aux": {}}
+        for group, name, v in slots:
+            v = next(gathered) if v is not None else None
+            if group is None:
+                interaction_as_dict[name] = v
+            else:
+                interaction_as_dict[group][name] = v
+
+        return Interaction(**interaction_as_dict)
+
+
+class _GrowableColumn:
+    """A tensor column that is allocated from the first appended batch and grows by doubling its capacity."""
+
+    def __init__(self):
+        self.storage: Optional[torch.Tensor] = None
+        self.size = 0
+
+    def append(self, t: torch.Tensor) -> None:
+        if t.dim() == 0:
+            t = t.unsqueeze(0)
+        n = t.size(0)
+
+        if self.storage is None:
+            self.storage = torch.empty(
+                (n,) + tuple(t.shape[1:]), dtype=t.dtype, device=t.device
+            )
+        elif self.size + n > self.storage.size(0):
+            capacity = max(self.size + n, 2 * self.storage.size(0))
+            storage = self.storage.new_empty((capacity,) + tuple(t.shape[1:]))
+            storage[: self.size] = self.storage[: self.size]
+            self.storage = storage
+
+        self.storage[self.size : self.size + n] = t
+        self.size += n
+
+    def view(self) -> torch.Tensor:
+        return self.storage[: self.size]
+
+
+class InteractionBuffer:
+    """
+    Columnar, growable storage for a sequence of Interactions; a replacement for collecting Interactions in a list
+    and calling `Interaction.from_iterable` on it. Each field (including every `aux` and `aux_input` key) is
+    allocated once from the shape and dtype of the first appended batch and its capacity is doubled when needed,
+    so that appending a batch amounts to a single slice copy per field. `as_interaction()` returns views of
+    the filled storage and does not copy.
+
+    >>> buffer = InteractionBuffer()
+    >>> buffer.append(Interaction(torch.ones(1), None, None, {}, torch.ones(1), torch.ones(1), None, {}))
+    >>> buffer.append(Interaction(torch.zeros(2), None, None, {}, torch.ones(2), torch.ones(2), None, {}))
+    >>> c = buffer.as_interaction()
+    >>> c.size
+    3
+    >>> c
+    Interaction(sender_input=tensor([1., 0., 0.]), ..., receiver_output=tensor([1., 1., 1.]), message_length=None, aux={})
+    >>> d = Interaction(torch.ones(1), torch.ones(1), None, {}, torch.ones(1), torch.ones(1), None, {})
+    >>> buffer.append(d) # mishaped, should throw an exception
+    Traceback (most recent call last):
+    ...
+    RuntimeError: Appending empty and non-empty interactions logs. Normally this shouldn't happen!
+    """
+
+    _fields = [
+        "sender_input",
+        "receiver_input",
+        "labels",
+        "message",
+        "receiver_output",
+        "message_length",
+    ]
+
+    def __init__(self):
+        self.n_interactions = 0
+        self._columns: Dict[str, Optional[_GrowableColumn]] = {}
+        self._aux_input: Optional[Dict[str, _GrowableColumn]] = None
+        self._aux: Dict[str, _GrowableColumn] = {}
+
+    def __len__(self) -> int:
+        return self.n_interactions
+
+    @staticmethod
+    def _append_to(column: Optional[_GrowableColumn], value) -> None:
+        if (column is None) != (value is None):
+            raise RuntimeError(
+                "Appending empty and non-empty interactions logs. "
+                "Normally this shouldn't happen!"
+            )
+        if column is not None:
+            column.append(value)
+
+    def append(self, interaction: Interaction) -> None:
+        if self.n_interactions == 0:
+            for name in self._fields:
+                value = getattr(interaction, name)
+                self._columns[name] = _GrowableColumn() if value is not None else None
+            if interaction.aux_input is not None:
+                self._aux_input = dict(
+                    (k, _GrowableColumn() if v is not None else None)
+                    for k, v in interaction.aux_input.items()
+                )
+            self._aux = dict(
+                (k, _GrowableColumn() if v is not None else None)
+                for k, v in interaction.aux.items()
+            )
+
+        assert len(interaction.aux) == len(self._aux)
+        if self._aux_input is not None:
+            assert len(interaction.aux_input) == len(
+                self._aux_input
+            ), "found two interactions of different aux_info size"
+        else:
+            assert (
+                not interaction.aux_input
+            ), "some aux_info are defined some are not, this should not happen"
+
+        for name in self._fields:
+            self._append_to(self._columns[name], getattr(interaction, name))
+        if self._aux_input is not None:
+            for k, column in self._aux_input.items():
+                self._append_to(column, interaction.aux_input[k])
+        for k, column in self._aux.items():
+            self._append_to(column, interaction.aux[k])
+
+        self.n_interactions += 1
+
+    def as_interaction(self) -> Interaction:
+        assert self.n_interactions > 0, "interaction buffer must not be empty"
+
+        def _view(column):
+            return column.view() if column is not None else None
+
+        aux_input = None
+        if self._aux_input is not None:
+            aux_input = dict((k, _view(v)) for k, v in self._aux_input.items())
+
+        return Interaction(
+            **dict((name, _view(self._columns[name])) for name in self._fields),
+            aux_input=aux_input,
+            aux=dict((k, _view(v)) for k, v in self._aux.items()),
+        )
 
-        def send_collect_tensor(tnsr):
-            assert tnsr is not None
-
-            tnsr = tnsr.contiguous().cuda()
-            lst = [torch.zeros_like(tnsr) for _ in range(world_size)]
-            distrib.all_gather(lst, tnsr)
-            return torch.cat(lst, dim=0).to("cpu")
-
-        def send_collect_dict(d):
-            if not d or d is None:
-                return {}
-
-            new_d = {}
-            for k, v in d.items():
-                if v is not None:
-                    v = send_collect_tensor(v)
-                new_d[k] = v
-
-            return new_d
-
-        interaction_as_dict = dict(
-            (name, getattr(log, name))
-            for name in [
-                "sender_input",
-                "receiver_input",
-                "labels",
-                "message",
-                "message_length",
-                "receiver_output",
-            ]
+
+class RunningAuxStatistics:
+    """
+    Folds the `aux` dicts of a stream of Interactions into per-key running counts, means and (population)
+    variances, so that per-epoch averages can be reported without keeping every batch log in memory.
+    Each element of an aux tensor has the same weight, hence the means coincide with `.mean()` over the
+    concatenated epoch log. The statistics stay on the device of the incoming tensors; no host synchronisation
+    happens on update.
+
+    >>> stats = RunningAuxStatistics()
+    >>> stats.update({"acc": torch.tensor([1.0, 0.0])})
+    >>> stats.update({"acc": torch.tensor([1.0, 1.0, 1.0, 1.0])})
+    >>> stats.count["acc"], round(stats.mean["acc"].item(), 4), round(stats.var["acc"].item(), 4)
+    (6, 0.8333, 0.1389)
+    >>> stats.summary().aux
+    {'acc': tensor(0.8333)}
+    """
+
+    def __init__(self):
+        self.count: Dict[str, int] = {}
+        self._mean: Dict[str, torch.Tensor] = {}
+        self._m2: Dict[str, torch.Tensor] = {}
+
+    def update(self, aux: Dict[str, torch.Tensor]) -> None:
+        for k, v in aux.items():
+            if v is None or not torch.is_tensor(v) or v.numel() == 0:
+                continue
+            v = v.detach().double()
+            n_b = v.numel()
+            mean_b = v.mean()
+            m2_b = (v - mean_b).pow(2).sum()
+
+            if k not in self.count:
+                self.count[k], self._mean[k], self._m2[k] = n_b, mean_b, m2_b
+                continue
+
+            # Chan et al. pairwise update of the mean and the sum of squared deviations
+            n_a = self.count[k]
+            n = n_a + n_b
+            delta = mean_b - self._mean[k]
+            self._mean[k] = self._mean[k] + delta * (n_b / n)
+            self._m2[k] = self._m2[k] + m2_b + delta.pow(2) * (n_a * n_b / n)
+            self.count[k] = n
+
+    @property
+    def mean(self) -> Dict[str, torch.Tensor]:
+        return dict((k, v.float()) for k, v in self._mean.items())
+
+    @property
+    def var(self) -> Dict[str, torch.Tensor]:
+        return dict((k, (self._m2[k] / self.count[k]).float()) for k in self._m2)
+
+    def all_reduce(
+        self, extra: Optional[torch.Tensor] = None
+    ) -> Optional[torch.Tensor]:
+        """
+        Merges the statistics of all the distributed workers, so that every worker holds the statistics over the
+        union of their streams. The counts, sums and sums of squares of all the keys are reduced by a single
+        collective; `extra` (e.g. a loss) can be summed over the workers by the same collective and is returned.
+        The workers must have seen the same keys.
+        """
+        assert (
+            distrib.is_initialized()
+        ), "torch.distributed must be initialized beforehand"
+        device = "cuda" if distrib.get_backend() == "nccl" else "cpu"
+
+        keys = sorted(self.count)
+        flat = torch.zeros(3 * len(keys) + 1, dtype=torch.float64, device=device)
+        for i, k in enumerate(keys):
+            n, mean = self.count[k], self._mean[k].to(device)
+            flat[3 * i] = n
+            flat[3 * i + 1] = n * mean
+            flat[3 * i + 2] = self._m2[k].to(device) + n * mean.pow(2)
+        if extra is not None:
+            flat[-1] = extra.detach().to(device)
+        distrib.all_reduce(flat)
+
+        for i, k in enumerate(keys):
+            n, total, sum_squares = flat[3 * i : 3 * i + 3].unbind()
+            self.count[k] = int(n.item())
+            self._mean[k] = total / n
+            self._m2[k] = (sum_squares - total * self._mean[k]).clamp(min=0.0)
+
+        return flat[-1] if extra is not None else None
+
+    def summary(self) -> Interaction:
+        """Returns an otherwise empty Interaction that holds the running means as scalar `aux` tensors. Callbacks
+        that only report `aux[k].mean()` (e.g. ConsoleLogger, TensorboardLogger, EarlyStopperAccuracy) can consume
+        it in place of the full epoch log."""
+        summary = Interaction.empty()
+        summary.aux = dict((k, v.cpu()) for k, v in self.mean.items())
+        return summary
+
+
+_MANIFEST_NAME = "manifest.json"
+
+
+def _save_column(value: Any, dump_dir: pathlib.Path, name: str) -> Optional[dict]:
+    if value is None:
+        return None
+    if not torch.is_tensor(value):
+        with open(dump_dir / f"{name}.pkl", "wb") as f:
+            pickle.dump(value, f)
+        return {"file": f"{name}.pkl", "format": "pickle"}
+
+    tensor = value.detach().cpu().contiguous()
+    dtype = str(tensor.dtype).replace("torch.", "")
+    if tensor.dtype == torch.bfloat16:
+        # numpy has no bfloat16: we store the raw bits and reinterpret them on load
+        tensor = tensor.view(torch.int16)
+    np.save(dump_dir / f"{name}.npy", tensor.numpy())
+    return {
+        "file": f"{name}.npy",
+        "format": "npy",
+        "dtype": dtype,
+        "shape": list(value.shape),
+    }
+
+
+def _load_column(entry: Optional[dict], dump_dir: pathlib.Path) -> Any:
+    if entry is None:
+        return None
+    path = dump_dir / entry["file"]
+    if entry["format"] == "pickle":
+        with open(path, "rb") as f:
+            return pickle.load(f)
+
+    # copy-on-write mapping: pages are shared across processes and only read once touched;
+    # empty arrays cannot be mapped
+    mmap_mode = "c" if np.prod(entry["shape"]) > 0 else None
+    tensor = torch.from_numpy(np.load(path, mmap_mode=mmap_mode))
+    dtype = getattr(torch, entry["dtype"])
+    if tensor.dtype != dtype:
+        tensor = tensor.view(dtype)
+    return tensor
+
+
+def save_interaction(interaction: Interaction, dump_dir: Union[str, pathlib.Path]):
+    """
+    Stores an Interaction as a directory with one `.npy` file per field (including each `aux` and `aux_input`
+    entry) and a small JSON manifest, written last. Use `MappedInteraction` (or `util.load_interactions`) to
+    read it back. Non-tensor `aux`/`aux_input` values are pickled.
+    """
+    dump_dir = pathlib.Path(dump_dir)
+    dump_dir.mkdir(exist_ok=True, parents=True)
+
+    manifest = {"version": 1, "fields": {}, "aux_input": None, "aux": {}}
+    for name in InteractionBuffer._fields:
+        manifest["fields"][name] = _save_column(
+            getattr(interaction, name), dump_dir, name
+        )
+    if interaction.aux_input is not None:
+        manifest["aux_input"] = dict(
+            (k, _save_column(v, dump_dir, f"aux_input_{i}"))
+            for i, (k, v) in enumerate(interaction.aux_input.items())
+        )
+    for i, (k, v) in enumerate(interaction.aux.items()):
+        manifest["aux"][k] = _save_column(v, dump_dir, f"aux_{i}")
+
+    with open(dump_dir / _MANIFEST_NAME, "w") as f:
+        json.dump(manifest, f)
+
+
+class _MappedColumns(Mapping):
+    def __init__(self, entries: Dict[str, Optional[dict]], dump_dir: pathlib.Path):
+        self._entries = entries
+        self._dump_dir = dump_dir
+        self._loaded = {}
+
+    def __getitem__(self, key):
+        if key not in self._loaded:
+            self._loaded[key] = _load_column(self._entries[key], self._dump_dir)
+        return self._loaded[key]
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class MappedInteraction:
+    """
+    Read-only view of an Interaction stored by `save_interaction`. Fields are memory-mapped on first access, so that
+    e.g. reading `message` and `sender_input` never touches the files of the remaining fields.
+
+    >>> import tempfile
+    >>> a = Interaction(torch.ones(2, 3), None, None, {}, torch.ones(2, 4).long(), None, None, {"acc": torch.zeros(2)})
+    >>> with tempfile.TemporaryDirectory() as d:
+    ...     save_interaction(a, d)
+    ...     b = MappedInteraction(d)
+    ...     b.size, b.message.dtype, b.receiver_input, b.aux["acc"], dict(b.aux_input)
+    (2, torch.int64, None, tensor([0., 0.]), {})
+    """
+
+    def __init__(self, dump_dir: Union[str, pathlib.Path]):
+        self.dump_dir = pathlib.Path(dump_dir)
+        with open(self.dump_dir / _MANIFEST_NAME) as f:
+            self.manifest = json.load(f)
+
+        self._fields = _MappedColumns(self.manifest["fields"], self.dump_dir)
+        self.aux = _MappedColumns(self.manifest["aux"], self.dump_dir)
+        self.aux_input = (
+            _MappedColumns(self.manifest["aux_input"], self.dump_dir)
+            if self.manifest["aux_input"] is not None
+            else None
         )
 
-        interaction_as_dict = send_collect_dict(interaction_as_dict)
+    def __getattr__(self, name):
+        # only called for the attributes that are not set on the instance, i.e. the Interaction fields
+        fields = self.__dict__.get("_fields")
+        if fields is None or name not in fields:
+            raise AttributeError(name)
+        return fields[name]
 
-        synced_aux_input = send_collect_dict(log.aux_input)
-        interaction_as_dict["aux_input"] = synced_aux_input
-        synced_aux = send_collect_dict(log.aux)
-        interaction_as_dict["aux"] = synced_aux
+    def __repr__(self):
+        return f"MappedInteraction({self.dump_dir})"
 
-        synced_interacton = Interaction(**interaction_as_dict)
+    @property
+    def size(self):
+        for name in InteractionBuffer._fields:
+            entry = self.manifest["fields"][name]
+            if entry is not None:
+                return entry["shape"][0]
+        raise RuntimeError("Cannot determine interaction log size; it is empty.")
 
-        assert log.size * world_size == synced_interacton.size
-        return synced_interacton
+    def to_interaction(self) -> Interaction:
+        return Interaction(
+            **dict((name, self._fields[name]) for name in InteractionBuffer._fields),
+            aux_input=dict(self.aux_input) if self.aux_input is not None else None,
+            aux=dict(self.aux),
+        )
 
 
 def dump_interactions(
@@ -253,7 +648,7 @@ def dump_interactions(
         if device is not None
         else torch.device("cuda" if torch.cuda.is_available() else "cpu")
     )
-    full_interaction = None
+    interactions = InteractionBuffer()
 
     with torch.no_grad():
         for batch in dataset:
@@ -269,15 +664,12 @@ def dump_interactions(
                 )  # actual symbols instead of one-hot encoded
             if apply_padding and variable_length:
                 assert interaction.message_length is not None
-                for i in range(interaction.size):
-                    length = interaction.message_length[i].long().item()
-                    interaction.message[i, length:] = 0  # 0 is always EOS
-
-            full_interaction = (
-                full_interaction + interaction
-                if full_interaction is not None
-                else interaction
-            )
+                mask = message_mask(
+                    interaction.message_length.long(), interaction.message.size(1)
+                )
+                interaction.message[~mask] = 0  # 0 is always EOS
+
+            interactions.append(interaction)
 
     game.train(mode=train_state)
-    return interaction
+    return interactions.as_interaction()
@@ -5,40 +5,84 @@
 
 import json
 from collections import defaultdict
-from typing import Callable, Union
+from typing import Callable, Optional, Tuple, Union
 
 import editdistance
 import numpy as np
 import torch
+import torch.nn.functional as F
 from scipy.spatial import distance
-from scipy.stats import spearmanr
+from scipy.stats import norm, spearmanr
 
 from .callbacks import Callback
 from .interaction import Interaction
 
 
+def _column_codes(x: torch.Tensor) -> torch.Tensor:
+    """
+    Replaces values in each column of a 2d tensor by the ids of their distinct values within the column.
+    >>> _column_codes(torch.tensor([[5, 1], [3, 1], [5, 2]]))
+    tensor([[1, 0],
+            [0, 0],
+            [1, 1]])
+    """
+    sorted_x, order = x.sort(dim=0)
+    is_new = torch.ones_like(sorted_x, dtype=torch.long)
+    is_new[1:] = (sorted_x[1:] != sorted_x[:-1]).long()
+    return torch.empty_like(is_new).scatter_(0, order, is_new.cumsum(dim=0) - 1)
+
+
+def _entropy_from_counts(counts: torch.Tensor) -> torch.Tensor:
+    """Entropy (in bits) of the frequency tables stored along the last dimension of `counts`"""
+    p = counts.double() / counts.sum(dim=-1, keepdim=True)
+    return -torch.where(p > 0, p * p.log2(), torch.zeros_like(p)).sum(dim=-1)
+
+
+def _column_entropy(codes: torch.Tensor) -> torch.Tensor:
+    """Entropy of each column of a (n, c) tensor of ids, as returned by `_column_codes`"""
+    n, c = codes.size()
+    offsets = torch.arange(c, device=codes.device) * n
+    counts = torch.bincount((codes + offsets).view(-1), minlength=n * c)
+    return _entropy_from_counts(counts.view(c, n))
+
+
+def _row_codes(t: torch.Tensor) -> torch.Tensor:
+    """Maps each row of `t` (each element, if `t` is 1d) to the id of its distinct value"""
+    _, codes = torch.unique(t.reshape(t.size(0), -1), dim=0, return_inverse=True)
+    return codes
+
+
 def gap_mi_first_second(attributes, representations):
-    gaps = torch.zeros(representations.size(1))
-    non_constant_positions = 0.0
+    """
+    For each position of `representations`, computes the gap between the highest and the second highest mutual
+    information with an attribute, normalised by the entropy of the position; returns the average gap over
+    non-constant positions. All attribute x position mutual informations are computed in one batched pass.
+
+    >>> attributes = torch.tensor([[0, 0], [0, 1], [1, 0], [1, 1]])
+    >>> gap_mi_first_second(attributes, attributes)
+    1.0
+    """
+    n_attributes = attributes.size(1)
+    n_positions = representations.size(1)
+    n = attributes.size(0)
 
-    for j in range(representations.size(1)):
-        symbol_mi = []
-        h_j = None
-        for i in range(attributes.size(1)):
-            x, y = attributes[:, i], representations[:, j]
-            info = mutual_info(x, y)
-            symbol_mi.append(info)
+    attribute_codes = _column_codes(attributes)
+    position_codes = _column_codes(representations)
+    h_attributes = _column_entropy(attribute_codes)
+    h_positions = _column_entropy(position_codes)
 
-            if h_j is None:
-                h_j = calc_entropy(y)
+    # (n, attribute, position) ids of the joint values, densified so that they stay below n
+    joint = attribute_codes.unsqueeze(2) * n + position_codes.unsqueeze(1)
+    joint = _column_codes(joint.view(n, n_attributes * n_positions))
+    h_joint = _column_entropy(joint).view(n_attributes, n_positions)
 
-        symbol_mi.sort(reverse=True)
+    mi = h_attributes.unsqueeze(1) + h_positions.unsqueeze(0) - h_joint
+    top_mi, _ = mi.topk(2, dim=0)
 
-        if h_j > 0.0:
-            gaps[j] = (symbol_mi[0] - symbol_mi[1]) / h_j
-            non_constant_positions += 1
+    non_constant = h_positions > 0.0
+    gaps = ((top_mi[0] - top_mi[1])[non_constant] / h_positions[non_constant]).float()
 
-    score = gaps.sum() / non_constant_positions
+    score = gaps.sum() / non_constant.sum()
     return score.item()
 
 
@@ -65,6 +109,9 @@ def calc_entropy(messages):
     >>> np.allclose(calc_entropy(messages), 1.0)
     True
     """
+    if torch.is_tensor(messages):
+        return _entropy_from_counts(torch.bincount(_row_codes(messages))).item()
+
     freq_table = defaultdict(float)
 
     for m in messages:
@@ -85,7 +132,21 @@ def _hashable_tensor(t):
 def mutual_info(xs, ys):
     """
     I[x, y] = E[x] + E[y] - E[x,y]
+
+    >>> xs = torch.tensor([[0, 1], [0, 1], [1, 0], [1, 1]])
+    >>> mutual_info(xs, xs[:, 0])
+    1.0
     """
+    if torch.is_tensor(xs) and torch.is_tensor(ys):
+        x_codes, y_codes = _row_codes(xs), _row_codes(ys)
+        xy_codes = x_codes * (y_codes.max() + 1) + y_codes
+
+        e_x, e_y, e_xy = (
+            _entropy_from_counts(torch.bincount(_row_codes(codes)))
+            for codes in (x_codes, y_codes, xy_codes)
+        )
+        return (e_x + e_y - e_xy).item()
+
     e_x = calc_entropy(xs)
     e_y = calc_entropy(ys)
 
@@ -113,6 +174,9 @@ class MessageEntropy(Callback):
         output = json.dumps(dict(entropy=entropy, mode=tag, epoch=epoch))
         print(output, flush=True)
 
+    def needs_interaction_logs(self, epoch: int, is_training: bool) -> bool:
+        return self.print_train or not is_training
+
     def on_epoch_end(self, _loss, logs: Interaction, epoch: int):
         if self.print_train:
             self.print_message_entropy(logs, "train", epoch)
@@ -121,6 +185,98 @@ class MessageEntropy(Callback):
         self.print_message_entropy(logs, "test", epoch)
 
 
+def edit_distance(x: torch.Tensor, y: torch.Tensor) -> torch.Tensor:
+    """
+    Levenshtein distances between corresponding rows of two integer tensors of shapes (n, len_x) and (n, len_y).
+    The dynamic programming table is filled cell by cell, but each cell is computed for all n pairs at once,
+    hence the cost is O(len_x * len_y) vectorised operations over n-sized columns.
+
+    >>> x = torch.tensor([[1, 2, 3], [1, 2, 3], [1, 2, 3]])
+    >>> y = torch.tensor([[1, 2, 3], [2, 3, 0], [4, 5, 6]])
+    >>> edit_distance(x, y)
+    tensor([0, 2, 3])
+    """
+    n, len_x = x.size()
+    len_y = y.size(1)
+    # distances never exceed max(len_x, len_y): small integers keep the columns cache-friendly
+    dtype = torch.int16 if max(len_x, len_y) < 2 ** 15 else torch.int32
+    x, y = x.t().contiguous(), y.t().contiguous()
+
+    def _column(value):
+        return torch.full((n,), value, dtype=dtype, device=x.device)
+
+    # distances between the empty prefix of x and the prefixes of y
+    prev = [_column(j) for j in range(len_y + 1)]
+    for i in range(1, len_x + 1):
+        cur = [_column(i)]
+        for j in range(1, len_y + 1):
+            substitution = prev[j - 1] + (x[i - 1] != y[j - 1]).to(dtype)
+            insertion_or_deletion = torch.min(prev[j], cur[j - 1]) + 1
+            cur.append(torch.min(substitution, insertion_or_deletion))
+        prev = cur
+
+    return prev[-1].long()
+
+
+def _pair_distances(
+    x: torch.Tensor, first: torch.Tensor, second: torch.Tensor, distance_fn
+) -> torch.Tensor:
+    """Distances between the rows x[first[k]] and x[second[k]] for all k"""
+    a, b = x[first], x[second]
+    if distance_fn == "edit":
+        # messages are of a fixed length, hence (len(a) + len(b)) / 2 == len(a)
+        return edit_distance(a, b).double() / x.size(1)
+    if distance_fn == "hamming":
+        return (a != b).double().mean(dim=1)
+    if distance_fn == "euclidean":
+        return (a.double() - b.double()).norm(dim=1)
+    if distance_fn == "cosine":
+        return 1.0 - F.cosine_similarity(a.double(), b.double(), dim=1)
+    if distance_fn == "jaccard":
+        # as scipy, treat the vectors as boolean
+        a, b = a != 0, b != 0
+        nonzero = a | b
+        disagree = ((a != b) & nonzero).double().sum(dim=1)
+        n_nonzero = nonzero.double().sum(dim=1)
+        return torch.where(
+            n_nonzero > 0, disagree / n_nonzero.clamp(min=1), 0.0 * n_nonzero
+        )
+
+    assert callable(distance_fn), f"Cannot recognize {distance_fn} distance"
+    x = x.cpu().numpy()
+    return torch.tensor(
+        [distance_fn(x[i], x[j]) for i, j in zip(first.tolist(), second.tolist())],
+        dtype=torch.float64,
+    )
+
+
+def pairwise_edit_distance(
+    messages: torch.Tensor, max_pairs_per_chunk: int = 2 ** 20
+) -> np.ndarray:
+    """
+    Condensed matrix (in the order of `scipy.spatial.distance.pdist`) of the normalised edit distances between
+    all pairs of fixed-length messages; computed with `edit_distance` over chunks of rows.
+
+    >>> pairwise_edit_distance(torch.tensor([[1, 2], [1, 3], [3, 1]]))
+    array([0.5, 1. , 1. ])
+    """
+    n = messages.size(0)
+    rows_per_chunk = max(1, max_pairs_per_chunk // max(n, 1))
+    all_rows = torch.arange(n, device=messages.device)
+
+    chunks = []
+    for start in range(0, n, rows_per_chunk):
+        rows = all_rows[start : start + rows_per_chunk]
+        first = rows.repeat_interleave(n)
+        second = all_rows.repeat(rows.size(0))
+        upper = second > first
+        chunks.append(
+            _pair_distances(messages, first[upper], second[upper], "edit").cpu()
+        )
+
+    return torch.cat(chunks).numpy() if chunks else np.zeros(0)
+
+
 class TopographicSimilarity(Callback):
     """
     >>> words = ['cat', 'dog', 'pen', 'ben', 'ten']
@@ -144,7 +300,13 @@ class TopographicSimilarity(Callback):
         compute_topsim_train_set: bool = False,
         compute_topsim_test_set: bool = True,
         is_gumbel: bool = False,
+        max_pairs: Optional[int] = None,
     ):
+        """
+        :param max_pairs: if set, and the logs have more than `max_pairs` pairs of examples, topographic similarity
+            is estimated on `max_pairs` randomly sampled pairs (see `estimate_topsim`) and reported together with its
+            95% confidence interval.
+        """
 
         self.sender_input_distance_fn = sender_input_distance_fn
         self.message_distance_fn = message_distance_fn
@@ -154,6 +316,12 @@ class TopographicSimilarity(Callback):
         assert compute_topsim_train_set or compute_topsim_test_set
 
         self.is_gumbel = is_gumbel
+        self.max_pairs = max_pairs
+
+    def needs_interaction_logs(self, epoch: int, is_training: bool) -> bool:
+        if is_training:
+            return self.compute_topsim_train_set
+        return self.compute_topsim_test_set
 
     def on_epoch_end(self, loss: float, logs: Interaction, epoch: int):
         if self.compute_topsim_train_set:
@@ -163,6 +331,16 @@ class TopographicSimilarity(Callback):
         if self.compute_topsim_test_set:
             self.print_message(logs, "test", epoch)
 
+    @staticmethod
+    def _as_fixed_length_tensor(x) -> Optional[torch.Tensor]:
+        if torch.is_tensor(x):
+            return x.reshape(x.size(0), -1)
+        try:
+            x = torch.as_tensor(x)
+        except (ValueError, TypeError):
+            return None  # ragged sequences
+        return x.reshape(x.size(0), -1)
+
     @staticmethod
     def compute_topsim(
         meanings: torch.Tensor,
@@ -179,37 +357,119 @@ class TopographicSimilarity(Callback):
             "euclidean": distance.euclidean,
         }
 
-        meaning_distance_fn = (
-            distances.get(meaning_distance_fn, None)
-            if isinstance(meaning_distance_fn, str)
-            else meaning_distance_fn
-        )
-        message_distance_fn = (
-            distances.get(message_distance_fn, None)
-            if isinstance(message_distance_fn, str)
-            else message_distance_fn
-        )
+        def _pdist(x, distance_fn):
+            if distance_fn == "edit":
+                fixed_length = TopographicSimilarity._as_fixed_length_tensor(x)
+                if fixed_length is not None:
+                    return pairwise_edit_distance(fixed_length)
+            elif isinstance(distance_fn, str) and distance_fn in distances:
+                # scipy's built-in metrics are implemented in C
+                return distance.pdist(x, distance_fn)
+
+            distance_fn = (
+                distances.get(distance_fn, None)
+                if isinstance(distance_fn, str)
+                else distance_fn
+            )
+            assert distance_fn, f"Cannot recognize {distance_fn} distance"
+            return distance.pdist(x, distance_fn)
+
+        meaning_dist = _pdist(meanings, meaning_distance_fn)
+        message_dist = _pdist(messages, message_distance_fn)
+
+        topsim = spearmanr(meaning_dist, message_dist, nan_policy="raise").correlation
+
+        return float(topsim)
 
+    @staticmethod
+    def estimate_topsim(
+        meanings: torch.Tensor,
+        messages: torch.Tensor,
+        meaning_distance_fn: Union[str, Callable] = "hamming",
+        message_distance_fn: Union[str, Callable] = "edit",
+        n_pairs: int = 100_000,
+        confidence: float = 0.95,
+        seed: Optional[int] = None,
+    ) -> Tuple[float, Tuple[float, float]]:
+        """
+        Estimates topographic similarity on `n_pairs` pairs of distinct examples sampled uniformly with replacement,
+        instead of all O(N^2) pairs. Returns the estimate and its confidence interval, obtained with the Fisher
+        z-transform (with Fieller et al.'s variance correction for Spearman correlation). The interval treats
+        the sampled pairs as independent, hence it is approximate.
+
+        >>> meanings = torch.randint(0, 10, (2_000, 3), generator=torch.Generator().manual_seed(0))
+        >>> topsim, (low, high) = TopographicSimilarity.estimate_topsim(
+        ...     meanings, meanings, 'hamming', 'hamming', n_pairs=10_000, seed=0
+        ... )
+        >>> round(topsim, 6), low <= topsim <= high
+        (1.0, True)
+        """
+        meanings = TopographicSimilarity._as_fixed_length_tensor(meanings)
+        messages = TopographicSimilarity._as_fixed_length_tensor(messages)
         assert (
-            meaning_distance_fn and message_distance_fn
-        ), f"Cannot recognize {meaning_distance_fn} \
-            or {message_distance_fn} distances"
+            messages is not None
+        ), "sampled topographic similarity requires fixed-length messages"
+        n = meanings.size(0)
+        assert n > 1, "at least two examples are needed"
+
+        generator = torch.Generator()
+        if seed is not None:
+            generator.manual_seed(seed)
+        first = torch.randint(0, n, (n_pairs,), generator=generator)
+        second = torch.randint(0, n - 1, (n_pairs,), generator=generator)
+        second += (second >= first).long()  # never pair an example with itself
+
+        meaning_dist = _pair_distances(
+            meanings,
+            first.to(meanings.device),
+            second.to(meanings.device),
+            meaning_distance_fn,
+        )
+        message_dist = _pair_distances(
+            messages,
+            first.to(messages.device),
+            second.to(messages.device),
+            message_distance_fn,
+        )
 
-        meaning_dist = distance.pdist(meanings, meaning_distance_fn)
-        message_dist = distance.pdist(messages, message_distance_fn)
+        topsim = spearmanr(
+            meaning_dist.cpu().numpy(), message_dist.cpu().numpy(), nan_policy="raise"
+        ).correlation
 
-        topsim = spearmanr(meaning_dist, message_dist, nan_policy="raise").correlation
+        if abs(topsim) == 1.0:
+            low = high = topsim
+        else:
+            z = np.arctanh(topsim)
+            margin = norm.ppf(0.5 + confidence / 2) * np.sqrt(
+                1.06 / max(n_pairs - 3, 1)
+            )
+            low, high = np.tanh(z - margin), np.tanh(z + margin)
 
-        return topsim
+        return float(topsim), (float(low), float(high))
 
     def print_message(self, logs: Interaction, mode: str, epoch: int) -> None:
         messages = logs.message.argmax(dim=-1) if self.is_gumbel else logs.message
-        messages = [msg.tolist() for msg in messages]
-
-        topsim = self.compute_topsim(logs.sender_input, messages)
-
-        output = json.dumps(dict(topsim=topsim, mode=mode, epoch=epoch))
-        print(output, flush=True)
+        n_pairs = logs.size * (logs.size - 1) // 2
+
+        if self.max_pairs is not None and n_pairs > self.max_pairs:
+            topsim, topsim_ci = self.estimate_topsim(
+                logs.sender_input,
+                messages,
+                self.sender_input_distance_fn,
+                self.message_distance_fn,
+                n_pairs=self.max_pairs,
+            )
+            output = dict(topsim=topsim, topsim_ci=topsim_ci, mode=mode, epoch=epoch)
+        else:
+            topsim = self.compute_topsim(
+                logs.sender_input,
+                messages,
+                self.sender_input_distance_fn,
+                self.message_distance_fn,
+            )
+            output = dict(topsim=topsim, mode=mode, epoch=epoch)
+
+        print(json.dumps(output), flush=True)
 
 
 class Disent(Callback):
@@ -309,6 +569,9 @@ class Disent(Callback):
         output = json.dumps(dict(posdis=posdis, bosdis=bosdis, mode=tag, epoch=epoch))
         print(output, flush=True)
 
+    def needs_interaction_logs(self, epoch: int, is_training: bool) -> bool:
+        return self.print_train if is_training else self.print_test
+
     def on_epoch_end(self, _loss, logs: Interaction, epoch: int):
         if self.print_train:
             self.print_message(logs, "train", epoch)
@@ -340,6 +603,10 @@ class PrintValidationEvents(Callback):
         print("OUTPUTS")
         print([m.tolist() for m in logs.receiver_output], sep="\n")
 
+    # the validation logs are needed at the last epoch, which is not known in advance in case of early stopping
+    def needs_interaction_logs(self, epoch: int, is_training: bool) -> bool:
+        return not is_training
+
     # here is where we make sure we are printing the validation set (on_validation_end, not on_epoch_end)
     def on_validation_end(self, _loss, logs: Interaction, epoch: int):
         # here is where we check that we are at the last epoch
@@ -9,7 +9,38 @@ import torch
 import torch.nn.functional as F
 
 
+def _flatten_steps(receiver_output, labels):
+    """Merges the message position dimension of (batch size, message length, ...) receiver outputs into the batch
+    dimension, repeating the labels accordingly"""
+    batch_size, seq_len = receiver_output.size(0), receiver_output.size(1)
+    receiver_output = receiver_output.reshape(batch_size * seq_len, -1)
+    labels = labels.repeat_interleave(seq_len, dim=0)
+    return receiver_output, labels
+
+
+def _unflatten_steps(loss, aux, batch_size):
+    loss = loss.view(batch_size, -1)
+    aux = {name: value.view(batch_size, -1) for name, value in aux.items()}
+    return loss, aux
+
+
 class DiscriminationLoss:
+    """
+    :param vectorized: if set, the loss is computed for all the message positions at once (see `SenderReceiverRnnGS`):
+        receiver_output is of shape (batch size, message length, n classes) and the loss and accuracy are returned
+        with shape (batch size, message length)
+
+    >>> receiver_output = torch.tensor([[[1.0, 0.0], [0.0, 1.0], [1.0, 0.0]]])
+    >>> loss, aux = DiscriminationLoss(vectorized=True)(None, None, None, receiver_output, torch.tensor([1]), None)
+    >>> loss.size()
+    torch.Size([1, 3])
+    >>> aux["acc"]
+    tensor([[0., 1., 0.]])
+    """
+
+    def __init__(self, vectorized: bool = False):
+        self.vectorized = vectorized
+
     def __call__(
         self,
         sender_input,
@@ -19,6 +50,12 @@ class DiscriminationLoss:
         labels,
         _aux_input,
     ):
+        if self.vectorized:
+            batch_size = receiver_output.size(0)
+            loss, aux = self.discrimination_loss(
+                *_flatten_steps(receiver_output, labels)
+            )
+            return _unflatten_steps(loss, aux, batch_size)
         return self.discrimination_loss(receiver_output, labels)
 
     @staticmethod
@@ -29,10 +66,23 @@ class DiscriminationLoss:
 
 
 class ReconstructionLoss:
-    def __init__(self, n_attributes: int, n_values: int, batch_size: int):
+    """
+    :param vectorized: if set, the loss is computed for all the message positions at once (see `SenderReceiverRnnGS`):
+        receiver_output is of shape (batch size, message length, n_attributes * n_values) and the loss and accuracy
+        are returned with shape (batch size, message length)
+    """
+
+    def __init__(
+        self,
+        n_attributes: int,
+        n_values: int,
+        batch_size: int,
+        vectorized: bool = False,
+    ):
         self.n_attributes = n_attributes
         self.n_values = n_values
         self.batch_size = batch_size
+        self.vectorized = vectorized
 
     def __call__(
         self,
@@ -43,6 +93,17 @@ class ReconstructionLoss:
         labels,
         _aux_input,
     ):
+        if self.vectorized:
+            batch_size = receiver_output.size(0)
+            receiver_output, labels = _flatten_steps(receiver_output, labels)
+            loss, aux = self.reconstruction_loss(
+                receiver_output,
+                labels,
+                receiver_output.size(0),
+                self.n_attributes,
+                self.n_values,
+            )
+            return _unflatten_steps(loss, aux, batch_size)
         return self.reconstruction_loss(
             receiver_output, labels, self.batch_size, self.n_attributes, self.n_values
         )
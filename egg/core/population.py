@@ -4,9 +4,22 @@
 # LICENSE file in the root directory of this source tree.
 
 import itertools
+from typing import Optional
 
 import numpy as np
+import torch
 import torch.nn as nn
+from torch.func import functional_call, vmap
+
+from .interaction import Interaction
+from .vectorization import (
+    concatenate_stacked,
+    flatten_interaction,
+    probe_vmap,
+    same_structure,
+    stack_state,
+    write_back_buffers,
+)
 
 
 class UniformAgentSampler(nn.Module):
@@ -20,12 +33,15 @@ class UniformAgentSampler(nn.Module):
         self.receivers = nn.ModuleList(receivers)
         self.losses = list(losses)
 
-    def forward(self):
-        s_idx, r_idx, l_idx = (
+    def sample_indices(self):
+        return (
             np.random.choice(len(self.senders)),
             np.random.choice(len(self.receivers)),
             np.random.choice(len(self.losses)),
         )
+
+    def forward(self):
+        s_idx, r_idx, l_idx = self.sample_indices()
         return (
             self.senders[s_idx],
             self.receivers[r_idx],
@@ -57,23 +73,257 @@ class FullSweepAgentSampler(nn.Module):
             self.senders_order, self.receivers_order, self.losses_order
         )
 
-    def forward(self):
+    def sample_indices(self):
         try:
-            sender_idx, recv_idx, loss_idx = next(self.iterator)
+            return next(self.iterator)
         except StopIteration:
             self.reset_order()
-            sender_idx, recv_idx, loss_idx = next(self.iterator)
+            return next(self.iterator)
+
+    def forward(self):
+        sender_idx, recv_idx, loss_idx = self.sample_indices()
         return self.senders[sender_idx], self.receivers[recv_idx], self.losses[loss_idx]
 
 
+def _find_batch_size(x) -> Optional[int]:
+    """The leading dimension of the first non-scalar tensor in x (possibly nested in lists, tuples and dicts)"""
+    if torch.is_tensor(x):
+        return x.size(0) if x.dim() > 0 else None
+    if isinstance(x, (list, tuple, dict)):
+        for v in x.values() if isinstance(x, dict) else x:
+            batch_size = _find_batch_size(v)
+            if batch_size is not None:
+                return batch_size
+    return None
+
+
+def _split_batch(x, n_chunks, batch_size):
+    """Splits the tensors in x (possibly nested in lists, tuples and dicts) whose leading dimension is batch_size;
+    returns a list of n_chunks copies of x holding the corresponding chunks, and sharing the other values (e.g.
+    batch-level tensors)"""
+    if torch.is_tensor(x) and x.dim() > 0 and x.size(0) == batch_size:
+        return list(torch.tensor_split(x, n_chunks))
+    if isinstance(x, (list, tuple)):
+        return [
+            list(chunk)
+            for chunk in zip(*(_split_batch(v, n_chunks, batch_size) for v in x))
+        ]
+    if isinstance(x, dict):
+        chunks = [{} for _ in range(n_chunks)]
+        for k, v in x.items():
+            for chunk, v_chunk in zip(chunks, _split_batch(v, n_chunks, batch_size)):
+                chunk[k] = v_chunk
+        return chunks
+    return [x] * n_chunks
+
+
+def _map_batch(x, batch_size, fn):
+    """Applies fn to the tensors in x (possibly nested in lists, tuples and dicts) whose leading dimension is
+    batch_size, keeping the other values"""
+    if torch.is_tensor(x) and x.dim() > 0 and x.size(0) == batch_size:
+        return fn(x)
+    if isinstance(x, (list, tuple)):
+        return type(x)(_map_batch(v, batch_size, fn) for v in x)
+    if isinstance(x, dict):
+        return dict((k, _map_batch(v, batch_size, fn)) for k, v in x.items())
+    return x
+
+
+class _Pair(nn.Module):
+    """A sender and a receiver playing a game, as a single module, whose parameters functional_call can replace"""
+
+    def __init__(self, game, sender, receiver, loss):
+        super().__init__()
+        self.game = game
+        self.sender = sender
+        self.receiver = receiver
+        self.loss = loss
+
+    def forward(self, *args, **kwargs):
+        return self.game(self.sender, self.receiver, self.loss, *args, **kwargs)
+
+
 class PopulationGame(nn.Module):
-    def __init__(self, game, agents_loss_sampler):
+    """
+    Trains a population of agents, pairing a sender and a receiver (and a loss) sampled by `agents_loss_sampler`.
+    With `n_pairs` > 1, each batch is split into `n_pairs` equal parts (or into as many parts as there are
+    examples, for smaller batches), each played by a different sampled pair. Only the tensors whose leading dimension
+    is the batch size (that of the first tensor in the arguments) are split; the others are passed to every pair.
+    The pairs are reported per example in the `sender_id`, `receiver_id` and `pair_loss` entries of the
+    interaction's aux, and their losses are averaged, so that all the pairs are updated in a single backward pass and
+    optimisation step. This requires the sampler to implement `sample_indices()`, as the samplers above do.
+
+    When the sampled senders (resp. receivers) share their architecture, the pairs share their loss and the batch
+    splits evenly, the parameters of the senders and receivers are stacked along a leading pair dimension, and the
+    game is run once by `torch.func.vmap` over it, so that the pairs launch the kernels of a single, bigger, model.
+    Otherwise, and for games that cannot be vmapped (e.g. games that call `.item()` or update python-side state,
+    such as baselines, in their forward; they are detected at their first forward in each mode), or with
+    `vectorize=False`, the pairs are run one after another.
+
+    >>> from .gs_wrappers import SymbolGameGS
+    >>> class Agent(nn.Module):
+    ...     def __init__(self):
+    ...         super().__init__()
+    ...         self.fc = nn.Linear(4, 4)
+    ...     def forward(self, x, _input=None, _aux_input=None):
+    ...         return self.fc(x)
+    >>> class Mechanics(nn.Module):
+    ...     def forward(self, sender, receiver, loss, sender_input, labels):
+    ...         return SymbolGameGS(sender, receiver, loss)(sender_input, labels)
+    >>> loss = lambda _s, _m, _r, receiver_output, labels, _a: ((receiver_output - labels).pow(2).sum(-1), {})
+    >>> sampler = UniformAgentSampler([Agent() for _ in range(3)], [Agent() for _ in range(3)], [loss])
+    >>> game = PopulationGame(Mechanics(), sampler, n_pairs=2)
+    >>> x = torch.eye(4).repeat(2, 1)
+    >>> optimized_loss, interaction = game(x, x)
+    >>> interaction.aux["sender_id"].size(), interaction.aux["pair_loss"].size()
+    (torch.Size([8]), torch.Size([8]))
+    >>> # the stacked pairs play as they would one after another
+    >>> _ = game.eval()
+    >>> np.random.seed(0)
+    >>> stacked_loss, stacked_interaction = game(x, x)
+    >>> sequential_game = PopulationGame(Mechanics(), sampler, n_pairs=2, vectorize=False).eval()
+    >>> np.random.seed(0)
+    >>> sequential_loss, sequential_interaction = sequential_game(x, x)
+    >>> game.vectorize, torch.allclose(stacked_loss, sequential_loss)
+    (True, True)
+    >>> torch.equal(stacked_interaction.aux["sender_id"], sequential_interaction.aux["sender_id"])
+    True
+    >>> # batch-level tensors are not split, and smaller batches are split in fewer parts
+    >>> optimized_loss, interaction = PopulationGame(Mechanics(), sampler, n_pairs=3)(x[:2], torch.zeros(1))
+    >>> interaction.aux["pair_loss"].size(), bool(optimized_loss.isnan())
+    (torch.Size([2]), False)
+    """
+
+    def __init__(
+        self, game, agents_loss_sampler, n_pairs: int = 1, vectorize: bool = True
+    ):
         super().__init__()
 
         self.game = game
         self.agents_loss_sampler = agents_loss_sampler
 
+        assert n_pairs >= 1, "n_pairs must be positive"
+        self.n_pairs = n_pairs
+        self.vectorize = vectorize
+        self._vmapped_modes = set()
+
     def forward(self, *args, **kwargs):
-        sender, receiver, loss = self.agents_loss_sampler()
+        if self.n_pairs == 1:
+            sender, receiver, loss = self.agents_loss_sampler()
+
+            return self.game(sender, receiver, loss, *args, **kwargs)
+
+        sampler = self.agents_loss_sampler
+        batch_size = _find_batch_size((args, kwargs))
+        assert batch_size, "the batch holds no example"
+        # no pair gets an empty part of the batch
+        n_chunks = min(self.n_pairs, batch_size)
+        pairs = [sampler.sample_indices() for _ in range(n_chunks)]
+
+        senders = [sampler.senders[s_idx] for s_idx, _, _ in pairs]
+        receivers = [sampler.receivers[r_idx] for _, r_idx, _ in pairs]
+        stackable = (
+            batch_size % n_chunks == 0
+            and len(set(l_idx for _, _, l_idx in pairs)) == 1
+            and same_structure(senders)
+            and same_structure(receivers)
+        )
+        if not (self.vectorize and stackable):
+            return self._sequential_forward(pairs, args, kwargs, n_chunks, batch_size)
+        if self.training in self._vmapped_modes:
+            return self._vectorized_forward(pairs, args, kwargs, n_chunks, batch_size)
+
+        # whether the game can be vmapped is found out by the first forward in each mode
+        result, self.vectorize = probe_vmap(
+            lambda: self._vectorized_forward(pairs, args, kwargs, n_chunks, batch_size),
+            lambda: self._sequential_forward(pairs, args, kwargs, n_chunks, batch_size),
+            [self.game] + senders + receivers,
+            name="the population game",
+        )
+        if self.vectorize:
+            self._vmapped_modes.add(self.training)
+        return result
+
+    def _vectorized_forward(self, pairs, args, kwargs, n_chunks, batch_size):
+        sampler = self.agents_loss_sampler
+        senders = [sampler.senders[s_idx] for s_idx, _, _ in pairs]
+        receivers = [sampler.receivers[r_idx] for _, r_idx, _ in pairs]
+        pair = _Pair(self.game, senders[0], receivers[0], sampler.losses[pairs[0][2]])
+
+        sender_params, sender_buffers = stack_state(senders)
+        receiver_params, receiver_buffers = stack_state(receivers)
+        params = dict(("sender." + k, v) for k, v in sender_params.items())
+        params.update(("receiver." + k, v) for k, v in receiver_params.items())
+        buffers = dict(("sender." + k, v) for k, v in sender_buffers.items())
+        buffers.update(("receiver." + k, v) for k, v in receiver_buffers.items())
+
+        # the batch tensors, reshaped to (n_chunks, chunk_size, ...)
+        chunks = []
+        _map_batch(
+            (args, kwargs),
+            batch_size,
+            lambda x: chunks.append(x.unflatten(0, (n_chunks, -1))),
+        )
+
+        def play(params, buffers, chunks):
+            chunks = iter(chunks)
+            chunk_args, chunk_kwargs = _map_batch(
+                (args, kwargs), batch_size, lambda _: next(chunks)
+            )
+            loss, interaction = functional_call(
+                pair, (params, buffers), chunk_args, chunk_kwargs
+            )
+            return loss, flatten_interaction(interaction)
+
+        losses, fields = vmap(play, randomness="different")(params, buffers, chunks)
+        # the buffers updated in place by the agents (e.g. running statistics) are written back to them
+        write_back_buffers(senders, sender_buffers)
+        write_back_buffers(receivers, receiver_buffers)
+
+        interaction = concatenate_stacked(fields)
+        chunk_size = batch_size // n_chunks
+
+        def per_example(values):
+            return torch.tensor(
+                values, dtype=torch.float, device=losses.device
+            ).repeat_interleave(chunk_size)
+
+        interaction.aux["sender_id"] = per_example([s_idx for s_idx, _, _ in pairs])
+        interaction.aux["receiver_id"] = per_example([r_idx for _, r_idx, _ in pairs])
+        interaction.aux["pair_loss"] = losses.detach().repeat_interleave(chunk_size)
+        # the chunks have the same size, hence the mean over the batch is the mean over the pairs
+        return losses.mean(), interaction
+
+    def _sequential_forward(self, pairs, args, kwargs, n_chunks, batch_size):
+        sampler = self.agents_loss_sampler
+        args_chunks = _split_batch(args, n_chunks, batch_size)
+        kwargs_chunks = _split_batch(kwargs, n_chunks, batch_size)
+
+        total_loss, interactions = 0.0, []
+        batch_size = 0
+        for (s_idx, r_idx, l_idx), chunk_args, chunk_kwargs in zip(
+            pairs, args_chunks, kwargs_chunks
+        ):
+            optimized_loss, interaction = self.game(
+                sampler.senders[s_idx],
+                sampler.receivers[r_idx],
+                sampler.losses[l_idx],
+                *chunk_args,
+                **chunk_kwargs,
+            )
+            # the games return batch means: weighting by the chunk sizes recovers the mean over the batch
+            chunk_size = interaction.size
+            total_loss = total_loss + optimized_loss * chunk_size
+            batch_size += chunk_size
+
+            device = optimized_loss.device
+            interaction.aux["sender_id"] = torch.full(
+                (chunk_size,), float(s_idx), device=device
+            )
+            interaction.aux["receiver_id"] = torch.full(
+                (chunk_size,), float(r_idx), device=device
+            )
+            interaction.aux["pair_loss"] = optimized_loss.detach().expand(chunk_size)
+            interactions.append(interaction)
 
-        return self.game(sender, receiver, loss, *args, **kwargs)
+        return total_loss / batch_size, Interaction.from_iterable(interactions)
@@ -0,0 +1,180 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import json
+import pathlib
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
+
+import torch
+
+from .callbacks import Callback
+from .interaction import Interaction
+from .util import get_summary_writer
+
+
+class StepProfiler(Callback):
+    """
+    Measures where the time of the training steps goes. When it is among the callbacks of a Trainer, the trainer
+    times the following phases of each training step:
+        data: drawing the batch from the training data,
+        to_device: wrapping the batch and moving it to the device,
+        forward, backward and optimizer (the latter only on update steps),
+        logs: moving (and gathering) the interaction logs and aggregating them,
+        callbacks: the `on_batch_end` calls, also broken down by callback class.
+    At the end of each epoch, the per-step means (in ms) and the training throughput (samples/s) are printed as
+    a json line, reported to tensorboard (if enabled), and stored in `history`; if `summary_path` is set, the
+    history is also written there as a json file.
+
+    The timers only cost a couple of `time.perf_counter` calls per phase. As CUDA kernels run asynchronously,
+    the time of the gpu work is attributed to the phase that waits for it, unless `synchronize` is set.
+
+    :param summary_path: json file where the per-epoch summaries are written (default: None)
+    :param trace_steps: if set, a (first, last) range of (1-based, over the whole training) steps that are
+        recorded by torch.profiler; the trace, where the phases are labelled, is exported to `trace_dir` in the
+        chrome trace format
+    :param trace_dir: where the torch.profiler trace is exported
+    :param synchronize: synchronize CUDA at the end of each phase, for exact per-phase gpu timings
+    :param print_summary: print the per-epoch summaries
+    """
+
+    def __init__(
+        self,
+        summary_path: Optional[Union[str, pathlib.Path]] = None,
+        trace_steps: Optional[Tuple[int, int]] = None,
+        trace_dir: Union[str, pathlib.Path] = "./profiler_traces",
+        synchronize: bool = False,
+        print_summary: bool = True,
+    ):
+        if trace_steps is not None:
+            assert 0 < trace_steps[0] <= trace_steps[1], "invalid range of steps"
+        self.summary_path = pathlib.Path(summary_path) if summary_path else None
+        self.trace_steps = trace_steps
+        self.trace_dir = pathlib.Path(trace_dir)
+        self.synchronize = synchronize and torch.cuda.is_available()
+        self.print_summary = print_summary
+
+        self.history: List[Dict[str, Any]] = []
+        self.n_steps_total = 0
+        self._trace = None
+        self._reset()
+
+    def _reset(self):
+        self.totals: Dict[str, float] = defaultdict(float)
+        self.n_steps = 0
+        self.n_samples = 0
+        self._epoch_start = time.perf_counter()
+
+    def on_epoch_begin(self, epoch: int):
+        self._reset()
+
+    @contextmanager
+    def phase(self, name: str):
+        """Accumulates the time spent in the enclosed code under `name`"""
+        record = torch.profiler.record_function(name) if self._trace else None
+        if record:
+            record.__enter__()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.synchronize:
+                torch.cuda.synchronize()
+            self.totals[name] += time.perf_counter() - start
+            if record:
+                record.__exit__(None, None, None)
+
+    def timed(self, data: Iterable) -> Iterable:
+        """Iterates over `data`, timing each draw as the `data` phase"""
+        iterator = iter(data)
+        while True:
+            with self.phase("data"):
+                try:
+                    batch = next(iterator)
+                except StopIteration:
+                    return
+            yield batch
+
+    def begin_step(self):
+        if self.trace_steps and self.n_steps_total + 1 == self.trace_steps[0]:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self._trace = torch.profiler.profile(activities=activities)
+            self._trace.__enter__()
+
+    def end_step(self, batch):
+        self.n_steps += 1
+        self.n_steps_total += 1
+        self.n_samples += _batch_size(batch)
+        if self._trace and self.n_steps_total == self.trace_steps[1]:
+            self._export_trace()
+
+    def _export_trace(self):
+        trace, self._trace = self._trace, None
+        trace.__exit__(None, None, None)
+        self.trace_dir.mkdir(exist_ok=True, parents=True)
+        first, last = self.trace_steps
+        trace.export_chrome_trace(str(self.trace_dir / f"steps_{first}_{last}.json"))
+
+    def summary(self, epoch: int) -> Dict[str, Any]:
+        elapsed = time.perf_counter() - self._epoch_start
+        n_steps = max(self.n_steps, 1)
+
+        def ms_per_step(seconds):
+            return 1000.0 * seconds / n_steps
+
+        phases = dict(
+            (k, ms_per_step(v)) for k, v in self.totals.items() if "/" not in k
+        )
+        callbacks = dict(
+            (k.split("/", 1)[1], ms_per_step(v))
+            for k, v in self.totals.items()
+            if k.startswith("callbacks/")
+        )
+        phases["callbacks"] = sum(callbacks.values())
+        return dict(
+            epoch=epoch,
+            steps=self.n_steps,
+            samples=self.n_samples,
+            epoch_s=elapsed,
+            samples_per_s=self.n_samples / elapsed if elapsed > 0 else 0.0,
+            ms_per_step=phases,
+            callback_ms_per_step=callbacks,
+        )
+
+    def on_epoch_end(self, loss: float, logs: Interaction, epoch: int):
+        summary = self.summary(epoch)
+        self.history.append(summary)
+
+        if self.print_summary:
+            print(json.dumps(dict(mode="profile", **summary)), flush=True)
+
+        writer = get_summary_writer()
+        if writer is not None:
+            writer.add_scalar(
+                "profile/samples_per_s", summary["samples_per_s"], global_step=epoch
+            )
+            for k, v in summary["ms_per_step"].items():
+                writer.add_scalar(f"profile/{k}_ms", v, global_step=epoch)
+
+        if self.summary_path:
+            self.summary_path.parent.mkdir(exist_ok=True, parents=True)
+            with open(self.summary_path, "w") as f:
+                json.dump(self.history, f, indent=2)
+
+    def on_train_end(self):
+        if self._trace:
+            # training ended within the traced window
+            self._export_trace()
+
+
+def _batch_size(batch) -> int:
+    for x in batch:
+        if torch.is_tensor(x) and x.dim() > 0:
+            return x.size(0)
+    return 0
@@ -3,6 +3,7 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import inspect
 import math
 from collections import defaultdict
 from typing import Callable
@@ -16,7 +17,7 @@ from .baselines import Baseline, MeanBaseline
 from .interaction import LoggingStrategy
 from .rnn import RnnEncoder
 from .transformer import TransformerDecoder, TransformerEncoder
-from .util import find_lengths
+from .util import call_on_unique_messages, find_lengths, message_mask
 
 
 class ReinforceWrapper(nn.Module):
@@ -118,7 +119,50 @@ class ReinforceDeterministicWrapper(nn.Module):
         return out, torch.zeros(1).to(out.device), torch.zeros(1).to(out.device)
 
 
-class SymbolGameReinforce(nn.Module):
+class _BaselineStateMixin:
+    """Stores the state of the module's baselines (see `baselines.Baseline.state_dict`) in its state_dict, so that
+    they are checkpointed along with the agents. Checkpoints saved without it still load, keeping the current
+    baselines."""
+
+    def _named_baselines(self):
+        return self.baselines
+
+    def get_extra_state(self):
+        return {
+            name: baseline.state_dict()
+            for name, baseline in self._named_baselines().items()
+        }
+
+    def set_extra_state(self, state):
+        baselines = self._named_baselines()
+        for name, baseline_state in state.items():
+            baselines[name].load_state_dict(baseline_state)
+
+    def _load_from_state_dict(
+        self,
+        state_dict,
+        prefix,
+        local_metadata,
+        strict,
+        missing_keys,
+        unexpected_keys,
+        error_msgs,
+    ):
+        super()._load_from_state_dict(
+            state_dict,
+            prefix,
+            local_metadata,
+            strict,
+            missing_keys,
+            unexpected_keys,
+            error_msgs,
+        )
+        extra_state_key = prefix + "_extra_state"
+        if extra_state_key in missing_keys:
+            missing_keys.remove(extra_state_key)
+
+
+class SymbolGameReinforce(_BaselineStateMixin, nn.Module):
     """
     A single-symbol Sender/Receiver game implemented with Reinforce.
     """
@@ -133,6 +177,7 @@ class SymbolGameReinforce(nn.Module):
         baseline_type: Baseline = MeanBaseline,
         train_logging_strategy: LoggingStrategy = None,
         test_logging_strategy: LoggingStrategy = None,
+        deduplicate_messages: bool = False,
     ):
         """
         :param sender: Sender agent. On forward, returns a tuple of (message, log-prob of the message, entropy).
@@ -150,6 +195,8 @@ class SymbolGameReinforce(nn.Module):
         :param baseline_type: Callable, returns a baseline instance (eg a class specializing core.baselines.Baseline)
         :param train_logging_strategy, test_logging_strategy: specify what parts of interactions to persist for
             later analysis in callbacks
+        :param deduplicate_messages: If set, in evaluation mode and when there is neither receiver_input nor
+            aux_input, Receiver is only run once per distinct message (see util.call_on_unique_messages)
         """
         super(SymbolGameReinforce, self).__init__()
         self.sender = sender
@@ -158,6 +205,7 @@ class SymbolGameReinforce(nn.Module):
 
         self.receiver_entropy_coeff = receiver_entropy_coeff
         self.sender_entropy_coeff = sender_entropy_coeff
+        self.deduplicate_messages = deduplicate_messages
 
         self.baseline = baseline_type()
         self.train_logging_strategy = (
@@ -171,11 +219,28 @@ class SymbolGameReinforce(nn.Module):
             else test_logging_strategy
         )
 
+    def _named_baselines(self):
+        return {"baseline": self.baseline}
+
     def forward(self, sender_input, labels, receiver_input=None, aux_input=None):
         message, sender_log_prob, sender_entropy = self.sender(sender_input, aux_input)
-        receiver_output, receiver_log_prob, receiver_entropy = self.receiver(
-            message, receiver_input, aux_input
-        )
+        if (
+            self.deduplicate_messages
+            and not self.training
+            and receiver_input is None
+            and not aux_input
+        ):
+            (
+                receiver_output,
+                receiver_log_prob,
+                receiver_entropy,
+            ) = call_on_unique_messages(
+                lambda m: self.receiver(m, None, aux_input), message, expand=(0, 1, 2)
+            )
+        else:
+            receiver_output, receiver_log_prob, receiver_entropy = self.receiver(
+                message, receiver_input, aux_input
+            )
 
         loss, aux_info = self.loss(
             sender_input, message, receiver_input, receiver_output, labels, aux_input
@@ -251,6 +316,7 @@ class RnnSenderReinforce(nn.Module):
         max_len,
         num_layers=1,
         cell="rnn",
+        early_exit=False,
     ):
         """
         :param agent: the agent to be wrapped
@@ -259,9 +325,15 @@ class RnnSenderReinforce(nn.Module):
         :param hidden_size: the RNN cell's hidden state size
         :param max_len: maximal length of the output messages
         :param cell: type of the cell used (rnn, gru, lstm)
+        :param early_exit: if set, the rows that have emitted the EOS symbol are dropped from the unrolling, which
+            stops as soon as all messages are finished. The outputs keep the (batch size, max_len + 1) shape; the
+            positions after EOS are filled with EOS symbols and have zero log-probability and entropy. As everything
+            after EOS is ignored by the games, this does not change the losses, but during training fewer random
+            samples are drawn, hence the sampled messages differ from those obtained with early_exit=False.
         """
         super(RnnSenderReinforce, self).__init__()
         self.agent = agent
+        self.early_exit = early_exit
 
         assert max_len >= 1, "Cannot have a max_len below 1"
         self.max_len = max_len
@@ -307,6 +379,9 @@ class RnnSenderReinforce(nn.Module):
 
         input = torch.stack([self.sos_embedding] * x.size(0))
 
+        if self.early_exit:
+            return self._unroll_early_exit(input, prev_hidden, prev_c)
+
         sequence = []
         logits = []
         entropy = []
@@ -346,6 +421,57 @@ class RnnSenderReinforce(nn.Module):
 
         return sequence, logits, entropy
 
+    def _unroll_early_exit(self, input, prev_hidden, prev_c):
+        batch_size = input.size(0)
+        device = input.device
+        dtype = prev_hidden[0].dtype
+
+        sequence = torch.zeros(
+            (batch_size, self.max_len + 1), dtype=torch.long, device=device
+        )
+        logits = torch.zeros((batch_size, self.max_len + 1), dtype=dtype, device=device)
+        entropy = torch.zeros(
+            (batch_size, self.max_len + 1), dtype=dtype, device=device
+        )
+
+        # indices of the rows that have not emitted EOS yet
+        active = torch.arange(batch_size, device=device)
+
+        for step in range(self.max_len):
+            for i, layer in enumerate(self.cells):
+                if isinstance(layer, nn.LSTMCell):
+                    h_t, c_t = layer(input, (prev_hidden[i], prev_c[i]))
+                    prev_c[i] = c_t
+                else:
+                    h_t = layer(input, prev_hidden[i])
+                prev_hidden[i] = h_t
+                input = h_t
+
+            step_logits = F.log_softmax(self.hidden_to_output(h_t), dim=1)
+            distr = Categorical(logits=step_logits)
+
+            if self.training:
+                x = distr.sample()
+            else:
+                x = step_logits.argmax(dim=1)
+
+            sequence[active, step] = x
+            logits[active, step] = distr.log_prob(x)
+            entropy[active, step] = distr.entropy()
+
+            not_eos = x != 0
+            if not not_eos.all():
+                active = active[not_eos]
+                if active.numel() == 0:
+                    break
+                x = x[not_eos]
+                prev_hidden = [h[not_eos] for h in prev_hidden]
+                prev_c = [c[not_eos] for c in prev_c]
+
+            input = self.embedding(x)
+
+        return sequence, logits, entropy
+
 
 class RnnReceiverReinforce(nn.Module):
     """
@@ -452,6 +578,9 @@ class SenderReceiverRnnReinforce(nn.Module):
     ['aux', 'length', 'receiver_entropy', 'sender_entropy']
     >>> interaction.aux['aux'], interaction.aux['aux'].sum()
     (tensor([1., 1., 1., 1., 1.]), tensor(5.))
+    >>> mask = message_mask(interaction.message_length, interaction.message.size(1))  # positions up to the eos
+    >>> (mask.sum(dim=1) == interaction.message_length).all().item()
+    True
     """
 
     def __init__(
@@ -465,6 +594,7 @@ class SenderReceiverRnnReinforce(nn.Module):
         baseline_type: Baseline = MeanBaseline,
         train_logging_strategy: LoggingStrategy = None,
         test_logging_strategy: LoggingStrategy = None,
+        deduplicate_messages: bool = False,
     ):
         """
         :param sender: sender agent
@@ -475,6 +605,9 @@ class SenderReceiverRnnReinforce(nn.Module):
             receiver_input: input of Receiver from the dataset
             receiver_output: output of Receiver
             labels: labels assigned to Sender's input data
+            aux_input: auxiliary input from the dataset
+            message_mask: if the loss accepts this keyword argument, a boolean tensor of shape (batch size, message
+                length) marking the message positions up to and including the eos symbol (see util.message_mask)
           and outputs a tuple of (1) a loss tensor of shape (batch size, 1) (2) the dict with auxiliary information
           of the same shape. The loss will be minimized during training, and the auxiliary information aggregated over
           all batches in the dataset.
@@ -485,6 +618,8 @@ class SenderReceiverRnnReinforce(nn.Module):
         :param baseline_type: Callable, returns a baseline instance (eg a class specializing core.baselines.Baseline)
         :param train_logging_strategy, test_logging_strategy: specify what parts of interactions to persist for
             later analysis in callbacks
+        :param deduplicate_messages: If set, in evaluation mode and when there is neither receiver_input nor
+            aux_input, Receiver is only run once per distinct message (see util.call_on_unique_messages)
         """
         super(SenderReceiverRnnReinforce, self).__init__()
         self.sender = sender
@@ -498,6 +633,7 @@ class SenderReceiverRnnReinforce(nn.Module):
             baseline_type,
             train_logging_strategy,
             test_logging_strategy,
+            deduplicate_messages,
         )
 
     def forward(self, sender_input, labels, receiver_input=None, aux_input=None):
@@ -512,7 +648,15 @@ class SenderReceiverRnnReinforce(nn.Module):
         )
 
 
-class CommunicationRnnReinforce(nn.Module):
+def _accepts_message_mask(loss: Callable) -> bool:
+    try:
+        parameters = inspect.signature(loss).parameters
+    except (TypeError, ValueError):
+        return False
+    return "message_mask" in parameters
+
+
+class CommunicationRnnReinforce(_BaselineStateMixin, nn.Module):
     def __init__(
         self,
         sender_entropy_coeff: float,
@@ -521,6 +665,7 @@ class CommunicationRnnReinforce(nn.Module):
         baseline_type: Baseline = MeanBaseline,
         train_logging_strategy: LoggingStrategy = None,
         test_logging_strategy: LoggingStrategy = None,
+        deduplicate_messages: bool = False,
     ):
         """
         :param sender_entropy_coeff: entropy regularization coeff for sender
@@ -529,6 +674,8 @@ class CommunicationRnnReinforce(nn.Module):
         :param baseline_type: Callable, returns a baseline instance (eg a class specializing core.baselines.Baseline)
         :param train_logging_strategy, test_logging_strategy: specify what parts of interactions to persist for
             later analysis in callbacks
+        :param deduplicate_messages: If set, in evaluation mode and when there is neither receiver_input nor
+            aux_input, receiver is only run once per distinct message
 
         """
         super().__init__()
@@ -536,6 +683,7 @@ class CommunicationRnnReinforce(nn.Module):
         self.sender_entropy_coeff = sender_entropy_coeff
         self.receiver_entropy_coeff = receiver_entropy_coeff
         self.length_cost = length_cost
+        self.deduplicate_messages = deduplicate_messages
 
         self.baselines = defaultdict(baseline_type)
         self.train_logging_strategy = (
@@ -561,26 +709,41 @@ class CommunicationRnnReinforce(nn.Module):
     ):
         message, log_prob_s, entropy_s = sender(sender_input, aux_input)
         message_length = find_lengths(message)
-        receiver_output, log_prob_r, entropy_r = receiver(
-            message, receiver_input, aux_input, message_length
-        )
+        if (
+            self.deduplicate_messages
+            and not self.training
+            and receiver_input is None
+            and not aux_input
+        ):
+            # equal messages have equal lengths
+            receiver_output, log_prob_r, entropy_r = call_on_unique_messages(
+                lambda m: receiver(m, None, aux_input, find_lengths(m)),
+                message,
+                expand=(0, 1, 2),
+            )
+        else:
+            receiver_output, log_prob_r, entropy_r = receiver(
+                message, receiver_input, aux_input, message_length
+            )
+
+        # the positions of the message up to and including the eos symbol - as we don't care about what's after;
+        # callbacks get the same mask from the logged message_length, with util.message_mask
+        mask = message_mask(message_length, message.size(1))
+        loss_kwargs = dict(message_mask=mask) if _accepts_message_mask(loss) else {}
 
         loss, aux_info = loss(
-            sender_input, message, receiver_input, receiver_output, labels, aux_input
+            sender_input,
+            message,
+            receiver_input,
+            receiver_output,
+            labels,
+            aux_input,
+            **loss_kwargs,
         )
 
-        # the entropy of the outputs of S before and including the eos symbol - as we don't care about what's after
-        effective_entropy_s = torch.zeros_like(entropy_r)
-
-        # the log prob of the choices made by S before and including the eos symbol - again, we don't
-        # care about the rest
-        effective_log_prob_s = torch.zeros_like(log_prob_r)
-
-        for i in range(message.size(1)):
-            not_eosed = (i < message_length).float()
-            effective_entropy_s += entropy_s[:, i] * not_eosed
-            effective_log_prob_s += log_prob_s[:, i] * not_eosed
-        effective_entropy_s = effective_entropy_s / message_length.float()
+        # the entropy and log prob of the outputs of S before and including the eos symbol
+        effective_entropy_s = (entropy_s * mask).sum(dim=1) / message_length.float()
+        effective_log_prob_s = (log_prob_s * mask).sum(dim=1)
 
         weighted_entropy = (
             effective_entropy_s.mean() * self.sender_entropy_coeff
@@ -679,6 +842,7 @@ class TransformerSenderReinforce(nn.Module):
         hidden_size,
         generate_style="standard",
         causal=True,
+        incremental=True,
     ):
         """
         :param agent: the agent to be wrapped, returns the "encoder" state vector, which is the unrolled into a message
@@ -696,6 +860,12 @@ class TransformerSenderReinforce(nn.Module):
             'in-place': [s1 s2 s3] -> [s1 s2 s3 <need-symbol>] \
                                    -> embeddings [[e1] [e2] [e3] [e4]] \
                                    -> (s4 = argmax(linear(e4)))
+        :param incremental: whether, for causal senders, the decoder caches the self-attention keys and values of
+            the already generated symbols, so that each step only processes the new symbol(s). Without dropout
+            (i.e., in evaluation, or if the decoder has no dropout), this produces the same messages as re-running
+            the decoder over the whole prefix, at a fraction of the cost. The cached keys and values would keep
+            their dropout masks, unlike the recomputed ones, hence caching is disabled in training when the decoder
+            applies dropout.
         """
         super(TransformerSenderReinforce, self).__init__()
         self.agent = agent
@@ -703,6 +873,8 @@ class TransformerSenderReinforce(nn.Module):
         assert generate_style in ["standard", "in-place"]
         self.generate_style = generate_style
         self.causal = causal
+        self.incremental = incremental
+        self._attn_mask = None
 
         assert max_len >= 1, "Cannot have max_len below 1"
         self.max_len = max_len
@@ -725,6 +897,40 @@ class TransformerSenderReinforce(nn.Module):
         nn.init.normal_(self.embed_tokens.weight, mean=0, std=self.embed_dim ** -0.5)
         self.embed_scale = math.sqrt(embed_dim)
 
+    def _has_dropout(self) -> bool:
+        rates = [self.transformer.dropout]
+        for layer in self.transformer.layers:
+            rates += [
+                layer.dropout,
+                layer.activation_dropout,
+                layer.self_attn.dropout,
+                layer.encoder_attn.dropout,
+            ]
+        return any(rate > 0 for rate in rates)
+
+    def causal_mask(self, size, device):
+        """Returns the (size, size) left-to-right attention mask, sliced from a cached (max_len, max_len) one"""
+        if self._attn_mask is None or self._attn_mask.device != device:
+            attn_mask = torch.triu(
+                torch.ones(self.max_len, self.max_len, device=device), diagonal=1
+            )
+            self._attn_mask = attn_mask.masked_fill(attn_mask == 1, float("-inf"))
+        return self._attn_mask[:size, :size]
+
+    def _sample(self, output, sequence, logits, entropy):
+        step_logits = F.log_softmax(self.embedding_to_vocab(output[:, -1, :]), dim=1)
+
+        distr = Categorical(logits=step_logits)
+        entropy.append(distr.entropy())
+        if self.training:
+            symbols = distr.sample()
+        else:
+            symbols = step_logits.argmax(dim=1)
+        logits.append(distr.log_prob(symbols))
+        sequence.append(symbols)
+
+        return self.embed_tokens(symbols) * self.embed_scale
+
     def generate_standard(self, encoder_state):
         batch_size = encoder_state.size(0)
         device = encoder_state.device
@@ -739,33 +945,37 @@ class TransformerSenderReinforce(nn.Module):
         input = special_symbol
 
         for step in range(self.max_len):
-            if self.causal:
-                attn_mask = torch.triu(
-                    torch.ones(step + 1, step + 1).byte(), diagonal=1
-                ).to(
-                    device
-                )  # noqa: E226
-                attn_mask = attn_mask.float().masked_fill(attn_mask == 1, float("-inf"))
-            else:
-                attn_mask = None
+            attn_mask = self.causal_mask(step + 1, device) if self.causal else None
             output = self.transformer(
                 embedded_input=input, encoder_out=encoder_state, attn_mask=attn_mask
             )
-            step_logits = F.log_softmax(
-                self.embedding_to_vocab(output[:, -1, :]), dim=1
-            )
+            new_embedding = self._sample(output, sequence, logits, entropy)
+            input = torch.cat([input, new_embedding.unsqueeze(dim=1)], dim=1)
 
-            distr = Categorical(logits=step_logits)
-            entropy.append(distr.entropy())
-            if self.training:
-                symbols = distr.sample()
-            else:
-                symbols = step_logits.argmax(dim=1)
-            logits.append(distr.log_prob(symbols))
-            sequence.append(symbols)
+        return sequence, logits, entropy
 
-            new_embedding = self.embed_tokens(symbols) * self.embed_scale
-            input = torch.cat([input, new_embedding.unsqueeze(dim=1)], dim=1)
+    def generate_standard_incremental(self, encoder_state):
+        batch_size = encoder_state.size(0)
+        device = encoder_state.device
+
+        sequence = []
+        logits = []
+        entropy = []
+
+        input = (
+            self.special_symbol_embedding.expand(batch_size, -1).unsqueeze(1).to(device)
+        )
+        incremental_state = {}
+
+        for step in range(self.max_len):
+            # the single new symbol attends to all the cached ones, no mask is needed
+            output = self.transformer(
+                embedded_input=input,
+                encoder_out=encoder_state,
+                incremental_state=incremental_state,
+            )
+            new_embedding = self._sample(output, sequence, logits, entropy)
+            input = new_embedding.unsqueeze(dim=1)
 
         return sequence, logits, entropy
 
@@ -785,42 +995,66 @@ class TransformerSenderReinforce(nn.Module):
         output = []
         for step in range(self.max_len):
             input = torch.cat(output + [special_symbol], dim=1)
-            if self.causal:
-                attn_mask = torch.triu(
-                    torch.ones(step + 1, step + 1).byte(), diagonal=1
-                ).to(
-                    device
-                )  # noqa: E226
-                attn_mask = attn_mask.float().masked_fill(attn_mask == 1, float("-inf"))
-            else:
-                attn_mask = None
+            attn_mask = self.causal_mask(step + 1, device) if self.causal else None
 
             embedded = self.transformer(
                 embedded_input=input, encoder_out=encoder_state, attn_mask=attn_mask
             )
-            step_logits = F.log_softmax(
-                self.embedding_to_vocab(embedded[:, -1, :]), dim=1
-            )
+            new_embedding = self._sample(embedded, sequence, logits, entropy)
+            output.append(new_embedding.unsqueeze(dim=1))
 
-            distr = Categorical(logits=step_logits)
-            entropy.append(distr.entropy())
-            if self.training:
-                symbols = distr.sample()
-            else:
-                symbols = step_logits.argmax(dim=1)
-            logits.append(distr.log_prob(symbols))
-            sequence.append(symbols)
+        return sequence, logits, entropy
 
-            new_embedding = self.embed_tokens(symbols) * self.embed_scale
-            output.append(new_embedding.unsqueeze(dim=1))
+    def generate_inplace_incremental(self, encoder_state):
+        batch_size = encoder_state.size(0)
+        device = encoder_state.device
+
+        sequence = []
+        logits = []
+        entropy = []
+
+        special_symbol = (
+            self.special_symbol_embedding.expand(batch_size, -1).unsqueeze(1).to(device)
+        )
+        incremental_state = {}
+        input = special_symbol
+
+        for step in range(self.max_len):
+            # the new positions are the last generated symbol (replacing the special symbol of the previous step)
+            # and the special symbol; only the former is cached
+            n_new = input.size(1)
+            attn_mask = self.causal_mask(step + 1, device)[-n_new:]
+            embedded = self.transformer(
+                embedded_input=input,
+                encoder_out=encoder_state,
+                attn_mask=attn_mask,
+                incremental_state=incremental_state,
+                n_committed=n_new - 1,
+            )
+            new_embedding = self._sample(embedded, sequence, logits, entropy)
+            input = torch.cat([new_embedding.unsqueeze(dim=1), special_symbol], dim=1)
 
         return sequence, logits, entropy
 
     def forward(self, x, aux_input=None):
         encoder_state = self.agent(x, aux_input)
 
-        if self.generate_style == "standard":
+        # with bidirectional attention, the embeddings of all symbols change as new ones are appended,
+        # hence they cannot be cached
+        incremental = (
+            self.incremental
+            and self.causal
+            and not (self.training and self._has_dropout())
+        )
+
+        if self.generate_style == "standard" and incremental:
+            sequence, logits, entropy = self.generate_standard_incremental(
+                encoder_state
+            )
+        elif self.generate_style == "standard":
             sequence, logits, entropy = self.generate_standard(encoder_state)
+        elif self.generate_style == "in-place" and incremental:
+            sequence, logits, entropy = self.generate_inplace_incremental(encoder_state)
         elif self.generate_style == "in-place":
             sequence, logits, entropy = self.generate_inplace(encoder_state)
         else:
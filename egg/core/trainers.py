@@ -5,7 +5,7 @@
 
 import os
 import pathlib
-from typing import List, Optional
+from typing import Any, Dict, List, Optional
 
 try:
     # requires python >= 3.7
@@ -15,19 +15,22 @@ except ImportError:
     from contextlib import suppress as nullcontext
 
 import torch
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, DistributedSampler
 
-from .batch import Batch
+from .batch import Batch, BatchPrefetcher
 from .callbacks import (
     Callback,
     Checkpoint,
     CheckpointSaver,
     ConsoleLogger,
     TensorboardLogger,
+    find_checkpoint,
+    load_checkpoint,
 )
 from .distributed import get_preemptive_checkpoint_dir
-from .interaction import Interaction
-from .util import get_opts, move_to
+from .interaction import Interaction, InteractionBuffer, RunningAuxStatistics
+from .profiling import StepProfiler
+from .util import get_opts, get_rng_state, move_to, set_rng_state
 
 try:
     from torch.cuda.amp import GradScaler, autocast
@@ -52,6 +55,9 @@ class Trainer:
         callbacks: Optional[List[Callback]] = None,
         grad_norm: float = None,
         aggregate_interaction_logs: bool = True,
+        log_aggregation: str = "full",
+        distributed_reduction: str = "interactions",
+        prefetch: int = 0,
     ):
         """
         :param game: A nn.Module that implements forward(); it is expected that forward returns a tuple of (loss, d),
@@ -63,6 +69,23 @@ class Trainer:
         :param validation_data: A DataLoader for the validation set (can be None)
         :param device: A torch.device on which to tensors should be stored
         :param callbacks: A list of egg.core.Callback objects that can encapsulate monitoring or checkpointing
+        :param log_aggregation: How per-batch interaction logs are aggregated over an epoch. With "full" (default),
+            all batch logs are kept and concatenated at the end of the epoch. With "running", only the `aux` metrics
+            are folded into running statistics (see RunningAuxStatistics) and the callbacks receive an Interaction
+            that holds the per-epoch means in `aux`; the full statistics are available as `trainer.train_statistics`
+            and `trainer.validation_statistics`. The latter mode keeps the memory footprint constant in the epoch
+            length, but is only suitable for callbacks that rely on the averaged `aux` values.
+        :param distributed_reduction: How the logs of distributed workers are aggregated (if aggregate_interaction_logs
+            is set). With "interactions" (default), the interactions of all the workers are gathered after every
+            batch. With "metrics", only the `aux` statistics (see RunningAuxStatistics) and the loss are reduced,
+            by a single collective at the end of the epoch, and the callbacks receive their means as with the
+            "running" log aggregation; `on_batch_end` receives the logs of the worker. The full interaction logs are
+            only gathered, once at the end of the epoch, when a callback needs them (see
+            Callback.needs_interaction_logs, e.g. the epochs dumped by InteractionSaver).
+        :param prefetch: If positive, the training and validation batches are drawn and moved to the device by a
+            background thread, which keeps up to `prefetch` ready batches (see BatchPrefetcher), so that data
+            generation overlaps with the model steps. Data drawing its batches from the global RNGs is not
+            prefetched, to preserve determinism. Disabled by default.
         """
         self.game = game
         self.optimizer = optimizer
@@ -79,8 +102,34 @@ class Trainer:
         self.grad_norm = grad_norm
         self.aggregate_interaction_logs = aggregate_interaction_logs
 
+        assert log_aggregation in [
+            "full",
+            "running",
+        ], f"Unknown log aggregation mode: {log_aggregation}"
+        self.log_aggregation = log_aggregation
+        self.train_statistics = self.validation_statistics = None
+
+        assert distributed_reduction in [
+            "interactions",
+            "metrics",
+        ], f"Unknown distributed reduction mode: {distributed_reduction}"
+        self.distributed_reduction = distributed_reduction
+        self.prefetch = prefetch
+        self.current_epoch = self.start_epoch
+
         self.update_freq = common_opts.update_freq
 
+        if common_opts.fp16:
+            self.scaler = GradScaler()
+        else:
+            self.scaler = None
+
+        # position of the training, see training_state()
+        self.global_step = 0
+        self.batch_id = 0
+        self._epoch_rng_state = None
+        self._resume_state = None
+
         if common_opts.load_from_checkpoint is not None:
             print(
                 f"# Initializing model, trainer, and optimizer from {common_opts.load_from_checkpoint}"
@@ -112,6 +161,9 @@ class Trainer:
                 checkpointer = CheckpointSaver(
                     checkpoint_path=self.checkpoint_path,
                     checkpoint_freq=common_opts.checkpoint_freq,
+                    asynchronous=True,
+                    every_steps=common_opts.checkpoint_every_steps,
+                    every_seconds=common_opts.checkpoint_every_seconds,
                 )
                 self.callbacks.append(checkpointer)
 
@@ -126,11 +178,21 @@ class Trainer:
             self.callbacks = [
                 ConsoleLogger(print_train_loss=False, as_json=False),
             ]
+        # if a StepProfiler is among the callbacks, the phases of the training steps are timed
+        self.profiler = next(
+            (x for x in self.callbacks if isinstance(x, StepProfiler)), None
+        )
 
         if self.distributed_context.is_distributed:
-            device_id = self.distributed_context.local_rank
-            torch.cuda.set_device(device_id)
-            self.game.to(device_id)
+            if self.distributed_context.uses_cuda:
+                device_id = self.distributed_context.local_rank
+                torch.cuda.set_device(device_id)
+                self.device = torch.device("cuda", device_id)
+                ddp_kwargs = dict(device_ids=[device_id], output_device=device_id)
+            else:
+                # gloo: each worker keeps the game on its own device (typically, cpu)
+                ddp_kwargs = {}
+            self.game.to(self.device)
 
             # NB: here we are doing something that is a bit shady:
             # 1/ optimizer was created outside of the Trainer instance, so we don't really know
@@ -144,11 +206,10 @@ class Trainer:
 
             self.game = torch.nn.parallel.DistributedDataParallel(
                 self.game,
-                device_ids=[device_id],
-                output_device=device_id,
                 find_unused_parameters=True,
+                **ddp_kwargs,
             )
-            self.optimizer.state = move_to(self.optimizer.state, device_id)
+            self.optimizer.state = move_to(self.optimizer.state, self.device)
 
         else:
             self.game.to(self.device)
@@ -157,30 +218,20 @@ class Trainer:
             # on different devices. Here, we protect from that by moving optimizer's internal state to the proper device
             self.optimizer.state = move_to(self.optimizer.state, self.device)
 
-        if common_opts.fp16:
-            self.scaler = GradScaler()
-        else:
-            self.scaler = None
-
     def eval(self):
         mean_loss = 0.0
-        interactions = []
+        interactions = InteractionBuffer()
+        statistics = RunningAuxStatistics()
         n_batches = 0
+        keep_logs = self._keeps_interaction_logs(is_training=False)
         self.game.eval()
         with torch.no_grad():
-            for batch in self.validation_data:
+            for batch in self._batches(self.validation_data):
                 if not isinstance(batch, Batch):
                     batch = Batch(*batch)
                 batch = batch.to(self.device)
                 optimized_loss, interaction = self.game(*batch)
-                if (
-                    self.distributed_context.is_distributed
-                    and self.aggregate_interaction_logs
-                ):
-                    interaction = Interaction.gather_distributed_interactions(
-                        interaction
-                    )
-                interaction = interaction.to("cpu")
+                interaction = self._batch_logs(interaction)
                 mean_loss += optimized_loss
 
                 for callback in self.callbacks:
@@ -188,30 +239,48 @@ class Trainer:
                         interaction, optimized_loss, n_batches, is_training=False
                     )
 
-                interactions.append(interaction)
+                if self._uses_statistics:
+                    statistics.update(interaction.aux)
+                if keep_logs:
+                    interactions.append(interaction)
                 n_batches += 1
 
         mean_loss /= n_batches
-        full_interaction = Interaction.from_iterable(interactions)
+        if self._uses_statistics:
+            self.validation_statistics = statistics
+        mean_loss, full_interaction = self._epoch_logs(
+            mean_loss, interactions, statistics, keep_logs
+        )
 
         return mean_loss.item(), full_interaction
 
     def train_epoch(self):
         mean_loss = 0
         n_batches = 0
-        interactions = []
+        interactions = InteractionBuffer()
+        statistics = RunningAuxStatistics()
+        keep_logs = self._keeps_interaction_logs(is_training=True)
 
         self.game.train()
 
         self.optimizer.zero_grad()
 
-        for batch_id, batch in enumerate(self.train_data):
-            if not isinstance(batch, Batch):
-                batch = Batch(*batch)
-            batch = batch.to(self.device)
+        train_data, first_batch_id = self._resume_position()
+        train_data = self._batches(train_data)
+        if self.profiler:
+            train_data = self.profiler.timed(train_data)
+
+        for batch_id, batch in enumerate(train_data, start=first_batch_id):
+            if self.profiler:
+                self.profiler.begin_step()
+
+            with self._phase("to_device"):
+                if not isinstance(batch, Batch):
+                    batch = Batch(*batch)
+                batch = batch.to(self.device)
 
             context = autocast() if self.scaler else nullcontext()
-            with context:
+            with self._phase("forward"), context:
                 optimized_loss, interaction = self.game(*batch)
 
                 if self.update_freq > 1:
@@ -219,53 +288,163 @@ class Trainer:
                     # hence, we need to account for that when aggregating grads
                     optimized_loss = optimized_loss / self.update_freq
 
-            if self.scaler:
-                self.scaler.scale(optimized_loss).backward()
-            else:
-                optimized_loss.backward()
-
-            if batch_id % self.update_freq == self.update_freq - 1:
-                if self.scaler:
-                    self.scaler.unscale_(self.optimizer)
-
-                if self.grad_norm:
-                    torch.nn.utils.clip_grad_norm_(
-                        self.game.parameters(), self.grad_norm
-                    )
+            with self._phase("backward"):
                 if self.scaler:
-                    self.scaler.step(self.optimizer)
-                    self.scaler.update()
+                    self.scaler.scale(optimized_loss).backward()
                 else:
-                    self.optimizer.step()
+                    optimized_loss.backward()
 
-                self.optimizer.zero_grad()
+            if batch_id % self.update_freq == self.update_freq - 1:
+                with self._phase("optimizer"):
+                    if self.scaler:
+                        self.scaler.unscale_(self.optimizer)
+
+                    if self.grad_norm:
+                        torch.nn.utils.clip_grad_norm_(
+                            self.game.parameters(), self.grad_norm
+                        )
+                    if self.scaler:
+                        self.scaler.step(self.optimizer)
+                        self.scaler.update()
+                    else:
+                        self.optimizer.step()
+
+                    self.optimizer.zero_grad()
+                self.global_step += 1
 
             n_batches += 1
-            mean_loss += optimized_loss.detach()
-            if (
-                self.distributed_context.is_distributed
-                and self.aggregate_interaction_logs
-            ):
-                interaction = Interaction.gather_distributed_interactions(interaction)
-            interaction = interaction.to("cpu")
+            self.batch_id = batch_id + 1
+            with self._phase("logs"):
+                mean_loss += optimized_loss.detach()
+                interaction = self._batch_logs(interaction)
 
             for callback in self.callbacks:
-                callback.on_batch_end(interaction, optimized_loss, batch_id)
+                with self._phase(f"callbacks/{type(callback).__name__}"):
+                    callback.on_batch_end(interaction, optimized_loss, batch_id)
+
+            with self._phase("logs"):
+                if self._uses_statistics:
+                    statistics.update(interaction.aux)
+                if keep_logs:
+                    interactions.append(interaction)
 
-            interactions.append(interaction)
+            if self.profiler:
+                self.profiler.end_step(batch)
 
         if self.optimizer_scheduler:
             self.optimizer_scheduler.step()
+        # the epoch is complete
+        self.batch_id = 0
 
         mean_loss /= n_batches
-        full_interaction = Interaction.from_iterable(interactions)
+        if self._uses_statistics:
+            self.train_statistics = statistics
+        mean_loss, full_interaction = self._epoch_logs(
+            mean_loss, interactions, statistics, keep_logs
+        )
         return mean_loss.item(), full_interaction
 
+    def training_state(self) -> Dict[str, Any]:
+        """
+        Everything that is needed, besides the game, optimizer and scheduler states, to resume training exactly
+        where it is: the number of optimizer steps, the number of batches of the current epoch that are done
+        (0 between epochs), the RNG states at the beginning of the current epoch and now, and the GradScaler state.
+        The baselines of REINFORCE games are part of the state_dict of the game.
+        """
+        return dict(
+            global_step=self.global_step,
+            batch_id=self.batch_id,
+            epoch_rng_state=self._epoch_rng_state,
+            rng_state=get_rng_state(),
+            scaler_state_dict=self.scaler.state_dict() if self.scaler else None,
+        )
+
+    def _resume_position(self):
+        """
+        Returns the training data and the index of its first batch. When resuming from a checkpoint that was taken
+        in the middle of an epoch, the RNG states of the beginning of the epoch are restored, so that the data
+        iterator is re-created in the same state, and the batches that were already done are skipped (drawn, but
+        not used); then, the RNG states of the checkpoint are restored.
+        """
+        state, self._resume_state = self._resume_state, None
+        if not state or not state["batch_id"]:
+            if state:
+                set_rng_state(state["rng_state"])
+            self._epoch_rng_state = get_rng_state()
+            return self.train_data, 0
+
+        set_rng_state(state["epoch_rng_state"])
+        self._epoch_rng_state = state["epoch_rng_state"]
+        iterator = iter(self.train_data)
+        for _ in range(state["batch_id"]):
+            next(iterator)
+        set_rng_state(state["rng_state"])
+        return iterator, state["batch_id"]
+
+    def _phase(self, name: str):
+        return self.profiler.phase(name) if self.profiler else nullcontext()
+
+    def _batches(self, data):
+        if self.prefetch > 0:
+            return BatchPrefetcher(data, self.device, n_batches=self.prefetch)
+        return data
+
+    @property
+    def _reduces_metrics(self) -> bool:
+        return (
+            self.distributed_context.is_distributed
+            and self.aggregate_interaction_logs
+            and self.distributed_reduction == "metrics"
+        )
+
+    @property
+    def _uses_statistics(self) -> bool:
+        return self.log_aggregation == "running" or self._reduces_metrics
+
+    def _keeps_interaction_logs(self, is_training: bool) -> bool:
+        if self._reduces_metrics:
+            return any(
+                callback.needs_interaction_logs(self.current_epoch, is_training)
+                for callback in self.callbacks
+            )
+        return self.log_aggregation == "full"
+
+    def _batch_logs(self, interaction: Interaction) -> Interaction:
+        if (
+            self.distributed_context.is_distributed
+            and self.aggregate_interaction_logs
+            and not self._reduces_metrics
+        ):
+            interaction = Interaction.gather_distributed_interactions(interaction)
+        return interaction.to("cpu")
+
+    def _epoch_logs(self, mean_loss, interactions, statistics, keep_logs):
+        if self._reduces_metrics:
+            # a single collective for all the aux means and the loss
+            mean_loss = statistics.all_reduce(extra=mean_loss)
+            mean_loss /= self.distributed_context.world_size
+            if keep_logs:
+                full_interaction = Interaction.gather_distributed_interactions(
+                    interactions.as_interaction()
+                )
+            else:
+                full_interaction = statistics.summary()
+        elif self.log_aggregation == "running":
+            full_interaction = statistics.summary()
+        else:
+            full_interaction = interactions.as_interaction()
+        return mean_loss, full_interaction
+
     def train(self, n_epochs):
         for callback in self.callbacks:
             callback.on_train_begin(self)
 
         for epoch in range(self.start_epoch, n_epochs):
+            self.current_epoch = epoch + 1
+            sampler = getattr(self.train_data, "sampler", None)
+            if isinstance(sampler, DistributedSampler):
+                sampler.set_epoch(epoch)
+
             for callback in self.callbacks:
                 callback.on_epoch_begin(epoch + 1)
 
@@ -305,29 +484,43 @@ class Trainer:
 
     def load(self, checkpoint: Checkpoint):
         self.game.load_state_dict(checkpoint.model_state_dict)
-        self.optimizer.load_state_dict(checkpoint.optimizer_state_dict)
+        if checkpoint.optimizer_state_dict is not None:
+            self.optimizer.load_state_dict(checkpoint.optimizer_state_dict)
         if checkpoint.optimizer_scheduler_state_dict:
             self.optimizer_scheduler.load_state_dict(
                 checkpoint.optimizer_scheduler_state_dict
             )
         self.start_epoch = checkpoint.epoch
 
-    def load_from_checkpoint(self, path):
+        state = checkpoint.training_state
+        if state:
+            self.global_step = state["global_step"]
+            self.batch_id = state["batch_id"]
+            if self.scaler and state["scaler_state_dict"]:
+                self.scaler.load_state_dict(state["scaler_state_dict"])
+            # RNG states and data position are restored when training starts
+            self._resume_state = state
+
+    def load_from_checkpoint(self, path, load_optimizer: bool = True):
         """
         Loads the game, agents, and optimizer state from a file
         :param path: Path to the file
+        :param load_optimizer: If not set, the optimizer and scheduler states are not loaded
         """
         print(f"# loading trainer state from {path}")
-        checkpoint = torch.load(path)
+        checkpoint = load_checkpoint(path, load_optimizer=load_optimizer)
         self.load(checkpoint)
 
     def load_from_latest(self, path):
-        latest_file, latest_time = None, None
-
-        for file in path.glob("*.tar"):
-            creation_time = os.stat(file).st_ctime
-            if latest_time is None or creation_time > latest_time:
-                latest_file, latest_time = file, creation_time
+        # the index files of the checkpoints tell which one is the latest, without reading them
+        latest_file = find_checkpoint(path)
+
+        if latest_file is None:
+            latest_time = None
+            for file in path.glob("*.tar"):
+                creation_time = os.stat(file).st_ctime
+                if latest_time is None or creation_time > latest_time:
+                    latest_file, latest_time = file, creation_time
 
         if latest_file is not None:
             self.load_from_checkpoint(latest_file)
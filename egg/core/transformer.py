@@ -26,15 +26,16 @@ class SinusoidalPositionEmbedding(nn.Module):
         pos[:, 1::2] = torch.cos(pos[:, 1::2])
         self.register_buffer("pe", pos.unsqueeze(0))
 
-    def forward(self, x: torch.Tensor) -> torch.Tensor:
+    def forward(self, x: torch.Tensor, offset: int = 0) -> torch.Tensor:
         """Updates the input embedding with positional embedding
         Arguments:
             x {torch.Tensor} -- Input tensor
+            offset {int} -- Position of the first element of x in the sequence
         Returns:
             torch.Tensor -- Input updated with positional embeddings
         """
         # fmt: off
-        t = self.pe[:, :x.size(1), :]
+        t = self.pe[:, offset:offset + x.size(1), :]
         # fmt: on
         return x + t
 
@@ -289,9 +290,29 @@ class TransformerDecoder(torch.nn.Module):
 
         self.layer_norm = torch.nn.LayerNorm(embed_dim)
 
-    def forward(self, embedded_input, encoder_out, key_mask=None, attn_mask=None):
+    def forward(
+        self,
+        embedded_input,
+        encoder_out,
+        key_mask=None,
+        attn_mask=None,
+        incremental_state=None,
+        n_committed=None,
+    ):
+        """
+        :param incremental_state: optional dict (empty on the first call) used for incremental decoding. The
+            self-attention keys and values of the already processed positions are cached in it, so that
+            `embedded_input` only has to hold the new positions, which follow the cached ones. `attn_mask` then
+            covers (new positions) x (cached + new positions).
+        :param n_committed: in incremental decoding, the number of leading new positions that are added to the
+            cache (by default, all of them); the remaining ones are processed, but not remembered.
+        """
+        offset = 0
+        if incremental_state is not None:
+            offset = incremental_state.get("length", 0)
+
         # embed positions
-        embedded_input = self.embed_positions(embedded_input)
+        embedded_input = self.embed_positions(embedded_input, offset=offset)
 
         x = F.dropout(embedded_input, p=self.dropout, training=self.training)
 
@@ -299,8 +320,24 @@ class TransformerDecoder(torch.nn.Module):
         x = x.transpose(0, 1)
 
         # decoder layers
-        for layer in self.layers:
-            x, attn = layer(x, encoder_out, key_mask=key_mask, attn_mask=attn_mask)
+        for i, layer in enumerate(self.layers):
+            layer_state = (
+                incremental_state.setdefault(i, {})
+                if incremental_state is not None
+                else None
+            )
+            x, attn = layer(
+                x,
+                encoder_out,
+                key_mask=key_mask,
+                attn_mask=attn_mask,
+                incremental_state=layer_state,
+                n_committed=n_committed,
+            )
+
+        if incremental_state is not None:
+            n_new = x.size(0) if n_committed is None else n_committed
+            incremental_state["length"] = offset + n_new
 
         x = self.layer_norm(x)
 
@@ -358,24 +395,85 @@ class TransformerDecoderLayer(nn.Module):
         nn.init.xavier_uniform_(self.fc2.weight)
         nn.init.constant_(self.fc2.bias, 0.0)
 
-    def forward(self, x, encoder_out, key_mask=None, attn_mask=None):
+    def _cached_self_attn(self, x, incremental_state, attn_mask, n_committed):
+        """Self-attention of the new positions `x` over the cached and the new positions. Follows
+        torch.nn.MultiheadAttention, but keeps the projected keys and values of the committed positions."""
+        attn = self.self_attn
+        tgt_len, batch_size, embed_dim = x.size()
+        head_dim = embed_dim // attn.num_heads
+
+        def _split_heads(t):
+            # T x B x C -> B x H x T x D
+            return t.view(t.size(0), batch_size, attn.num_heads, head_dim).permute(
+                1, 2, 0, 3
+            )
+
+        q, k, v = F.linear(x, attn.in_proj_weight, attn.in_proj_bias).chunk(3, dim=-1)
+        q, k, v = _split_heads(q), _split_heads(k), _split_heads(v)
+
+        if "key" in incremental_state:
+            all_k = torch.cat([incremental_state["key"], k], dim=2)
+            all_v = torch.cat([incremental_state["value"], v], dim=2)
+        else:
+            all_k, all_v = k, v
+
+        n_committed = tgt_len if n_committed is None else n_committed
+        if n_committed > 0:
+            committed = all_k.size(2) - tgt_len + n_committed
+            incremental_state["key"] = all_k[:, :, :committed]
+            incremental_state["value"] = all_v[:, :, :committed]
+
+        scores = torch.matmul(q * head_dim ** -0.5, all_k.transpose(-2, -1))
+        if attn_mask is not None:
+            scores = scores + attn_mask
+        probs = F.dropout(
+            F.softmax(scores, dim=-1), p=attn.dropout, training=self.training
+        )
+
+        # B x H x T x D -> T x B x C
+        x = (
+            torch.matmul(probs, all_v)
+            .permute(2, 0, 1, 3)
+            .reshape(tgt_len, batch_size, -1)
+        )
+        return attn.out_proj(x), probs.mean(dim=1)
+
+    def forward(
+        self,
+        x,
+        encoder_out,
+        key_mask=None,
+        attn_mask=None,
+        incremental_state=None,
+        n_committed=None,
+    ):
         residual = x
         x = self.self_attn_layer_norm(x)
-        x, attn = self.self_attn(
-            query=x, key=x, value=x, key_padding_mask=key_mask, attn_mask=attn_mask
-        )
+        if incremental_state is not None:
+            assert (
+                key_mask is None
+            ), "key masks are not supported in incremental decoding"
+            x, attn = self._cached_self_attn(
+                x, incremental_state, attn_mask, n_committed
+            )
+        else:
+            x, attn = self.self_attn(
+                query=x, key=x, value=x, key_padding_mask=key_mask, attn_mask=attn_mask
+            )
 
         x = F.dropout(x, p=self.dropout, training=self.training)
         x = residual + x
 
         residual = x
         x = self.encoder_attn_layer_norm(x)
+        # the encoder state is typically a single vector (from the user-defined module), i.e. a source of length 1
+        if encoder_out.dim() == 2:
+            encoder_out = encoder_out.unsqueeze(0)
         # would be a single vector, so no point in attention at all
         x, attn = self.encoder_attn(
             query=x,
             key=encoder_out,
             value=encoder_out,
-            static_kv=True,
         )
         x = F.dropout(x, p=self.dropout, training=self.training)
         x = residual + x
@@ -8,7 +8,7 @@ import pathlib
 import random
 import sys
 from collections import defaultdict
-from typing import Any, Iterable, List, Optional
+from typing import Any, Callable, Iterable, List, Optional, Sequence
 
 import numpy as np
 import torch
@@ -44,6 +44,20 @@ def _populate_cl_params(arg_parser: argparse.ArgumentParser) -> argparse.Argumen
         default=0,
         help="How often the checkpoints are saved",
     )
+    arg_parser.add_argument(
+        "--checkpoint_every_steps",
+        type=int,
+        default=0,
+        help="If positive, a resumable checkpoint is also saved every `checkpoint_every_steps` optimizer steps "
+        "(default: 0)",
+    )
+    arg_parser.add_argument(
+        "--checkpoint_every_seconds",
+        type=float,
+        default=0,
+        help="If positive, a resumable checkpoint is also saved (at the end of an optimizer step) every "
+        "`checkpoint_every_seconds` seconds (default: 0)",
+    )
     arg_parser.add_argument(
         "--validation_freq",
         type=int,
@@ -117,6 +131,13 @@ def _populate_cl_params(arg_parser: argparse.ArgumentParser) -> argparse.Argumen
         type=int,
         help="Port to use in distributed learning",
     )
+    arg_parser.add_argument(
+        "--distributed_backend",
+        type=str,
+        default=None,
+        choices=["nccl", "gloo"],
+        help="Backend of torch.distributed; nccl when cuda is used and gloo otherwise (default: None)",
+    )
 
     arg_parser.add_argument(
         "--fp16",
@@ -254,31 +275,82 @@ def _set_seed(seed) -> None:
         torch.cuda.manual_seed_all(seed)
 
 
-def move_to(x: Any, device: torch.device) -> Any:
+def get_rng_state() -> dict:
+    """
+    The states of the python.random, numpy and torch {cpu/cuda} RNGs, that can be restored by `set_rng_state`.
+
+    >>> state = get_rng_state()
+    >>> x = random.random(), np.random.rand(), torch.rand(1).item()
+    >>> set_rng_state(state)
+    >>> x == (random.random(), np.random.rand(), torch.rand(1).item())
+    True
+    """
+    return dict(
+        python=random.getstate(),
+        numpy=np.random.get_state(),
+        torch=torch.get_rng_state(),
+        cuda=torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+    )
+
+
+def set_rng_state(state: dict) -> None:
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if state["cuda"] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+def move_to(x: Any, device: torch.device, non_blocking: bool = False) -> Any:
     """
     Simple utility function that moves a tensor or a dict/list/tuple of (dict/list/tuples of ...) tensors
         to a specified device, recursively.
     :param x: tensor, list, tuple, or dict with values that are lists, tuples or dicts with values of ...
     :param device: device to be moved to
+    :param non_blocking: If set, copies from pinned memory are asynchronous with respect to the host
     :return: Same as input, but with all tensors placed on device. Non-tensors are not affected.
              For dicts, the changes are done in-place!
     """
     if hasattr(x, "to"):
-        return x.to(device)
+        return x.to(device, non_blocking=True) if non_blocking else x.to(device)
     if isinstance(x, list) or isinstance(x, tuple):
-        return [move_to(i, device) for i in x]
+        return [move_to(i, device, non_blocking) for i in x]
     if isinstance(x, dict) or isinstance(x, defaultdict):
         for k, v in x.items():
-            x[k] = move_to(v, device)
+            x[k] = move_to(v, device, non_blocking)
+        return x
+    return x
+
+
+def pin_memory(x: Any) -> Any:
+    """
+    Same as `move_to`, but places the (cpu) tensors in page-locked memory, from which they can be copied to a gpu
+    asynchronously
+    """
+    if torch.is_tensor(x):
+        return x.pin_memory() if x.device.type == "cpu" else x
+    if isinstance(x, list) or isinstance(x, tuple):
+        return [pin_memory(i) for i in x]
+    if isinstance(x, dict) or isinstance(x, defaultdict):
+        for k, v in x.items():
+            x[k] = pin_memory(v)
         return x
     return x
 
 
 def load_interactions(file_path: str):
+    """
+    Loads interactions saved by InteractionSaver. Dumps in the directory format (see `interaction.save_interaction`)
+    are returned as a lazily memory-mapped `MappedInteraction`; older, pickled dumps are loaded as a whole.
+    """
+    from .interaction import MappedInteraction
+
     file_path = pathlib.Path(file_path)
     assert (
         file_path.exists()
     ), f"{file_path} does not exist. Interactions cannot be loaded"
+    if file_path.is_dir():
+        return MappedInteraction(file_path)
     try:
         return torch.load(file_path)
     except FileNotFoundError:
@@ -286,6 +358,65 @@ def load_interactions(file_path: str):
         exit(1)
 
 
+def call_on_unique_messages(
+    fn: Callable, message: torch.Tensor, expand: Optional[Sequence[int]] = None
+) -> Any:
+    """
+    Computes `fn(message)` by calling `fn` on the distinct rows of `message` only, and expanding its per-message
+    outputs back to one row per message. `fn` must process each message independently of the others.
+
+    :param fn: returns either a single per-message tensor, or a tuple of outputs
+    :param message: the messages, along the first dimension
+    :param expand: if `fn` returns a tuple, the indices of its outputs that are expanded: these must have one row
+        per distinct message, or be broadcastable placeholders of size 1 (as the `torch.zeros(1)` log-probs of
+        deterministic receivers), which are kept as they are; the other outputs are returned as they are
+
+    >>> calls = []
+    >>> def receiver(message):
+    ...     calls.append(message.size(0))
+    ...     return message.sum(dim=1), torch.zeros(1), message.float().mean()
+    >>> message = torch.tensor([[1, 2], [3, 4], [1, 2], [1, 2]])
+    >>> call_on_unique_messages(receiver, message, expand=(0, 1))
+    (tensor([3, 7, 3, 3]), tensor([0.]), tensor(2.5000))
+    >>> calls
+    [2]
+    """
+    unique, inverse = torch.unique(message, dim=0, return_inverse=True)
+    if unique.size(0) == message.size(0):
+        return fn(message)
+
+    def expand_output(x):
+        if x.dim() > 0 and x.size(0) == unique.size(0):
+            return x[inverse]
+        assert x.numel() == 1, (
+            f"an output of shape {tuple(x.shape)} has neither one row per distinct message ({unique.size(0)}) "
+            "nor size 1"
+        )
+        return x
+
+    output = fn(unique)
+    if expand is None:
+        return expand_output(output)
+    return type(output)(
+        expand_output(x) if i in expand else x for i, x in enumerate(output)
+    )
+
+
+def message_mask(message_length: torch.Tensor, max_len: int) -> torch.Tensor:
+    """
+    :param message_length: A tensor with the lengths of the messages, including the eos symbol (see `find_lengths`).
+    :param max_len: The length of the messages tensor.
+    :returns A boolean tensor of size (batch size, max_len), marking the positions up to and including the eos symbol.
+
+    >>> message_mask(torch.tensor([1, 3]), 4)
+    tensor([[ True, False, False, False],
+            [ True,  True,  True, False]])
+    """
+    return torch.arange(
+        max_len, device=message_length.device
+    ) < message_length.unsqueeze(1)
+
+
 def find_lengths(messages: torch.Tensor) -> torch.Tensor:
     """
     :param messages: A tensor of term ids, encoded as Long values, of size (batch size, max sequence length).
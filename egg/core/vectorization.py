@@ -0,0 +1,244 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import copy
+import warnings
+from typing import Any, Callable, Dict, Sequence, Tuple
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from .interaction import Interaction
+from .util import get_rng_state, set_rng_state
+
+_MODULE_INTERNALS = ("_parameters", "_buffers", "_modules")
+
+
+def same_structure(modules: Sequence[nn.Module]) -> bool:
+    """
+    Whether the modules are of the same type, with parameters and buffers of the same names, shapes and dtypes, so
+    that their states can be stacked
+
+    >>> same_structure([nn.Linear(2, 3), nn.Linear(2, 3)]), same_structure([nn.Linear(2, 3), nn.Linear(3, 3)])
+    (True, False)
+    """
+
+    def signature(module):
+        tensors = list(module.named_parameters()) + list(module.named_buffers())
+        return type(module), [(name, t.shape, t.dtype) for name, t in tensors]
+
+    first = signature(modules[0])
+    return all(signature(module) == first for module in modules[1:])
+
+
+def stack_state(
+    modules: Sequence[nn.Module],
+) -> Tuple[Dict[str, torch.Tensor], Dict[str, torch.Tensor]]:
+    """
+    The parameters and buffers of structurally identical modules, stacked along a new leading dimension, to be
+    passed to torch.func.functional_call under torch.func.vmap. Unlike torch.func.stack_module_state, the stacked
+    parameters are not detached, so that the gradients reach the parameters of the modules.
+
+    >>> modules = [nn.Linear(2, 3), nn.Linear(2, 3)]
+    >>> params, buffers = stack_state(modules)
+    >>> params["weight"].size()
+    torch.Size([2, 3, 2])
+    >>> params["weight"].sum().backward()
+    >>> modules[1].weight.grad.size()
+    torch.Size([3, 2])
+    """
+    params = dict(
+        (name, torch.stack([module.get_parameter(name) for module in modules]))
+        for name, _ in modules[0].named_parameters()
+    )
+    buffers = dict(
+        (name, torch.stack([module.get_buffer(name) for module in modules]))
+        for name, _ in modules[0].named_buffers()
+    )
+    return params, buffers
+
+
+def write_back_buffers(
+    modules: Sequence[nn.Module], buffers: Dict[str, torch.Tensor]
+) -> None:
+    """Copies the stacked buffers (e.g., updated in place under vmap) back to the modules"""
+    with torch.no_grad():
+        for name, stacked in buffers.items():
+            for module, buffer in zip(modules, stacked):
+                module.get_buffer(name).copy_(buffer)
+
+
+_INTERACTION_FIELDS = (
+    "sender_input",
+    "receiver_input",
+    "labels",
+    "message",
+    "receiver_output",
+    "message_length",
+)
+
+
+def flatten_interaction(interaction: Interaction) -> Dict[str, torch.Tensor]:
+    """The tensors of an interaction, as a flat dict that vmap can return"""
+    fields = dict((name, getattr(interaction, name)) for name in _INTERACTION_FIELDS)
+    if interaction.aux_input:
+        fields.update(("aux_input/" + k, v) for k, v in interaction.aux_input.items())
+    fields.update(("aux/" + k, v) for k, v in interaction.aux.items())
+    return dict((k, v) for k, v in fields.items() if torch.is_tensor(v))
+
+
+def concatenate_stacked(fields: Dict[str, torch.Tensor]) -> Interaction:
+    """
+    The concatenation of K interactions, whose fields (as returned by `flatten_interaction`) are stacked along dim
+    0, as vmap returns them. Per-interaction scalars are repeated over the rows of their interaction.
+
+    >>> fields = {"labels": torch.arange(6).view(2, 3), "aux/acc": torch.tensor([0.0, 1.0])}
+    >>> interaction = concatenate_stacked(fields)
+    >>> interaction.labels.tolist(), interaction.aux["acc"].tolist()
+    ([0, 1, 2, 3, 4, 5], [0.0, 0.0, 0.0, 1.0, 1.0, 1.0])
+    """
+    # as Interaction.size, from the first field that is present
+    size = next(fields[name].size(1) for name in _INTERACTION_FIELDS if name in fields)
+
+    def rows(values):
+        # (K, size, ...) -> (K * size, ...)
+        if values.dim() > 1 and values.size(1) == size:
+            return values.flatten(0, 1)
+        return values.repeat_interleave(size, dim=0)
+
+    aux_input, aux = {}, {}
+    for name, values in fields.items():
+        if name.startswith("aux_input/"):
+            aux_input[name[len("aux_input/") :]] = rows(values)
+        elif name.startswith("aux/"):
+            aux[name[len("aux/") :]] = rows(values)
+
+    return Interaction(
+        aux_input=aux_input or None,
+        aux=aux,
+        **dict(
+            (name, rows(fields[name]) if name in fields else None)
+            for name in _INTERACTION_FIELDS
+        ),
+    )
+
+
+class ModuleState:
+    """
+    A copy of the python attributes (e.g. counters or baselines, but not the parameters) and of the buffers of
+    modules and of their submodules, that can be compared with their current attributes and restored.
+    """
+
+    def __init__(self, modules: Sequence[nn.Module]):
+        submodules = [s for module in modules for s in module.modules()]
+        self.attributes = [
+            (
+                submodule,
+                copy.deepcopy(
+                    dict(
+                        (k, v)
+                        for k, v in submodule.__dict__.items()
+                        if k not in _MODULE_INTERNALS
+                    )
+                ),
+            )
+            for submodule in submodules
+        ]
+        self.buffers = [
+            (buffer, buffer.detach().clone())
+            for submodule in submodules
+            for buffer in submodule.buffers(recurse=False)
+        ]
+
+    def attributes_changed(self) -> bool:
+        for submodule, attributes in self.attributes:
+            current = dict(
+                (k, v)
+                for k, v in submodule.__dict__.items()
+                if k not in _MODULE_INTERNALS
+            )
+            if not _equal(attributes, current):
+                return True
+        return False
+
+    def restore(self) -> None:
+        for submodule, attributes in self.attributes:
+            submodule.__dict__.update(copy.deepcopy(attributes))
+        with torch.no_grad():
+            for buffer, value in self.buffers:
+                buffer.copy_(value)
+
+
+def probe_vmap(
+    vmapped: Callable[[], Any],
+    sequential: Callable[[], Any],
+    modules: Sequence[nn.Module],
+    name: str,
+) -> Tuple[Any, bool]:
+    """
+    Runs `vmapped`, which calls `modules` under torch.func.vmap, and checks that it can stand for `sequential`, which
+    calls them one after another: it fails if `vmapped` raises, or if it changes the python attributes of the modules
+    (under vmap, the python code runs once for all the stacked modules, which would share such state). On failure,
+    the state of the modules and the RNGs are restored, a warning is issued, and `sequential` is run instead.
+
+    :returns the result, and whether `vmapped` could be used
+    """
+    try:
+        state = ModuleState(modules)
+    except Exception as e:
+        # the python state cannot be copied, hence it cannot be checked either
+        warnings.warn(
+            f"{name} cannot be vmapped ({type(e).__name__}: {e}), its modules are run one after another"
+        )
+        return sequential(), False
+
+    rng_state = get_rng_state()
+    try:
+        result = vmapped()
+    except Exception as e:
+        reason = f"{type(e).__name__}: {e}"
+    else:
+        if not state.attributes_changed():
+            return result, True
+        reason = "its forward updates python-side state"
+
+    state.restore()
+    set_rng_state(rng_state)
+    warnings.warn(
+        f"{name} cannot be vmapped ({reason}), its modules are run one after another"
+    )
+    return sequential(), False
+
+
+def _equal(a: Any, b: Any) -> bool:
+    """Conservative equality of python attributes: values that cannot be compared are deemed different"""
+    try:
+        if torch.is_tensor(a) or torch.is_tensor(b):
+            return (
+                torch.is_tensor(a)
+                and torch.is_tensor(b)
+                and a.shape == b.shape
+                and a.dtype == b.dtype
+                and a.device == b.device
+                and torch.equal(a, b)
+            )
+        if type(a) is not type(b):
+            return False
+        if isinstance(a, dict):
+            return a.keys() == b.keys() and all(_equal(a[k], b[k]) for k in a)
+        if isinstance(a, (list, tuple)):
+            return len(a) == len(b) and all(_equal(x, y) for x, y in zip(a, b))
+        if isinstance(a, np.ndarray):
+            return np.array_equal(a, b)
+        if isinstance(a, float):
+            return a == b or (a != a and b != b)
+        if a is b or isinstance(a, (int, str, bool, type(None))):
+            return a == b
+        if hasattr(a, "__dict__") and not callable(a):
+            return _equal(vars(a), vars(b))
+        return bool(a == b)
+    except Exception:
+        return False
@@ -7,7 +7,10 @@ import copy
 import itertools
 import random
 
+import numpy as np
 import torch
+import torch.nn.functional as F
+from torch.utils.data import BatchSampler, DataLoader, SequentialSampler
 
 
 def enumerate_attribute_value(n_attributes, n_values):
@@ -121,6 +124,185 @@ class ScaledDataset:
         return self.examples[k], torch.zeros(1)
 
 
+class AttributeValueSpace:
+    """
+    The space of all n_values ** n_attributes attribute-value combinations, where each combination is represented
+    by its integer id: the mixed-radix number whose digits are the values, the first attribute being the most
+    significant one. Ids are thus ordered as `enumerate_attribute_value`, and the functions above have id-based,
+    vectorised counterparts here, which produce the same examples in the same order. Only ids are materialised,
+    large spaces are processed in chunks of `chunk_size` ids.
+
+    >>> space = AttributeValueSpace(n_attributes=2, n_values=3)
+    >>> len(space)
+    9
+    >>> space.decode(torch.tensor([0, 5, 7]))
+    tensor([[0, 0],
+            [1, 2],
+            [2, 1]])
+    >>> space.encode(torch.tensor([[1, 2]]))
+    tensor([5])
+    >>> train, holdout = space.split_holdout()
+    >>> [tuple(x) for x in space.decode(train).tolist()] == split_holdout(enumerate_attribute_value(2, 3))[0]
+    True
+    >>> space.one_hot(torch.tensor([5]))
+    tensor([[0., 1., 0., 0., 0., 1.]])
+    """
+
+    def __init__(self, n_attributes: int, n_values: int, chunk_size: int = 2 ** 20):
+        self.n_attributes = n_attributes
+        self.n_values = n_values
+        self.chunk_size = chunk_size
+        # the place value of each attribute
+        self.radix = n_values ** torch.arange(n_attributes - 1, -1, -1)
+
+    def __len__(self):
+        return self.n_values ** self.n_attributes
+
+    def ids(self):
+        """Lazily enumerates all ids, in chunks"""
+        for start in range(0, len(self), self.chunk_size):
+            yield torch.arange(start, min(start + self.chunk_size, len(self)))
+
+    def decode(self, ids: torch.Tensor) -> torch.Tensor:
+        """(n,) ids -> (n, n_attributes) values"""
+        return torch.div(ids.unsqueeze(-1), self.radix, rounding_mode="floor") % (
+            self.n_values
+        )
+
+    def encode(self, values: torch.Tensor) -> torch.Tensor:
+        """(n, n_attributes) values -> (n,) ids"""
+        return (values * self.radix).sum(dim=-1)
+
+    def one_hot(self, ids: torch.Tensor) -> torch.Tensor:
+        """(n,) ids -> (n, n_attributes * n_values) concatenated one-hot encodings of the values, as `one_hotify`"""
+        values = self.decode(ids)
+        return F.one_hot(values, self.n_values).view(ids.size(0), -1).float()
+
+    def split_holdout(self, ids: torch.Tensor = None):
+        """Vectorised `split_holdout`: returns the ids (of the whole space, by default) without zero values, and
+        the ids with exactly one zero value"""
+        chunks = ids.split(self.chunk_size) if ids is not None else self.ids()
+        train, hold_out = [], []
+        for chunk in chunks:
+            n_zeros = (self.decode(chunk) == 0).sum(dim=1)
+            train.append(chunk[n_zeros == 0])
+            hold_out.append(chunk[n_zeros == 1])
+        return torch.cat(train), torch.cat(hold_out)
+
+    @staticmethod
+    def split_train_test(ids: torch.Tensor, p_hold_out=0.1, random_seed=7):
+        """Vectorised `split_train_test`, returns the train and test ids"""
+        assert p_hold_out > 0
+        random_state = np.random.RandomState(seed=random_seed)
+
+        n = len(ids)
+        permutation = torch.from_numpy(random_state.permutation(n))
+
+        n_test = int(p_hold_out * n)
+
+        test, train = ids[permutation[:n_test]], ids[permutation[n_test:]]
+        assert len(train) and len(test)
+
+        return train, test
+
+    def select_subset_V1(self, n_subset, random_seed=7):
+        """Id-based `select_subset_V1`: the ids of the combinations of n_subset values (including 0) per attribute"""
+        assert n_subset <= self.n_values
+        random_state = np.random.RandomState(seed=random_seed)
+
+        chosen_val = []
+        for attribute in range(self.n_attributes):
+            chosen_val.append(
+                [0]
+                + list(
+                    random_state.choice(
+                        range(1, self.n_values), n_subset - 1, replace=False
+                    )
+                )
+            )
+
+        ids = torch.zeros(1, dtype=torch.long)
+        for attribute in range(self.n_attributes):
+            digits = torch.tensor(chosen_val[attribute]) * self.radix[attribute]
+            ids = (ids.unsqueeze(1) + digits.unsqueeze(0)).view(-1)
+        return ids.sort().values
+
+    def select_subset_V2(self, n_subset, random_seed=7):
+        """Id-based `select_subset_V2`"""
+        assert n_subset <= self.n_values
+        random_state = np.random.RandomState(seed=random_seed)
+
+        # Sample the diagonal (minus (0,0)) to impose having each attribute is present at least once in the dataset
+        diagonal = torch.arange(self.n_values + 1, len(self), self.n_values + 1)
+        # Sample remaining, among the other ids
+        to_sample = (n_subset ** self.n_attributes) - len(diagonal)
+        sampled = torch.from_numpy(
+            random_state.choice(len(self) - len(diagonal), to_sample, replace=False)
+        )
+        # the k-th id that is not on the diagonal is k + the number of diagonal ids before it
+        sampled = sampled + torch.searchsorted(
+            diagonal - torch.arange(len(diagonal)), sampled, right=True
+        )
+        return torch.cat([diagonal, sampled])
+
+
+class AttributeValueDataset:
+    """
+    `ScaledDataset` for examples given by their ids in an `AttributeValueSpace`; the examples are one-hot encoded
+    on the fly. Besides single positions, it can be indexed with a list of positions, returning a whole batch at
+    once (see `batch_loader`).
+
+    >>> space = AttributeValueSpace(n_attributes=2, n_values=3)
+    >>> dataset = AttributeValueDataset(space, torch.tensor([5, 7]), scaling_factor=2)
+    >>> len(dataset)
+    4
+    >>> dataset[3][0]
+    tensor([0., 0., 1., 0., 1., 0.])
+    >>> examples, labels = dataset[[0, 1, 2]]
+    >>> examples.size(), labels.size()
+    (torch.Size([3, 6]), torch.Size([3, 1]))
+    """
+
+    def __init__(self, space: AttributeValueSpace, ids: torch.Tensor, scaling_factor=1):
+        self.space = space
+        self.ids = ids
+        self.scaling_factor = scaling_factor
+
+    def __len__(self):
+        return len(self.ids) * self.scaling_factor
+
+    def __getitem__(self, k):
+        if isinstance(k, int):
+            return self.examples[k % len(self.ids)], torch.zeros(1)
+        k = torch.as_tensor(k) % len(self.ids)
+        return self.space.one_hot(self.ids[k]), torch.zeros(len(k), 1)
+
+    @property
+    def examples(self):
+        return _OneHotExamples(self.space, self.ids)
+
+
+class _OneHotExamples:
+    def __init__(self, space, ids):
+        self.space = space
+        self.ids = ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, k):
+        return self.space.one_hot(self.ids[k : k + 1])[0]
+
+
+def batch_loader(dataset: AttributeValueDataset, batch_size: int) -> DataLoader:
+    """A DataLoader yielding the same batches as DataLoader(dataset, batch_size=batch_size), where each batch is
+    fetched with a single (vectorised) indexing of the dataset"""
+    sampler = BatchSampler(
+        SequentialSampler(dataset), batch_size=batch_size, drop_last=False
+    )
+    return DataLoader(dataset, batch_size=None, sampler=sampler)
+
+
 if __name__ == "__main__":
     dataset = enumerate_attribute_value(n_attributes=2, n_values=10)
     train, holdout = split_holdout(dataset)
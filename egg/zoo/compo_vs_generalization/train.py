@@ -9,7 +9,6 @@ import json
 
 import torch
 import torch.nn.functional as F
-from torch.utils.data import DataLoader
 
 import egg.core as core
 from egg.core import EarlyStopperAccuracy
@@ -21,13 +20,9 @@ from egg.zoo.compo_vs_generalization.archs import (
     Sender,
 )
 from egg.zoo.compo_vs_generalization.data import (
-    ScaledDataset,
-    enumerate_attribute_value,
-    one_hotify,
-    select_subset_V1,
-    select_subset_V2,
-    split_holdout,
-    split_train_test,
+    AttributeValueDataset,
+    AttributeValueSpace,
+    batch_loader,
 )
 from egg.zoo.compo_vs_generalization.intervention import Evaluator, Metrics
 
@@ -195,35 +190,32 @@ def main(params):
     opts = get_params(params)
     device = opts.device
 
-    full_data = enumerate_attribute_value(opts.n_attributes, opts.n_values)
+    # examples are represented by their ids in the attribute-value space, and one-hot encoded batch by batch
+    space = AttributeValueSpace(opts.n_attributes, opts.n_values)
+    full_data = torch.arange(len(space))
     if opts.density_data > 0:
-        sampled_data = select_subset_V2(
-            full_data, opts.density_data, opts.n_attributes, opts.n_values
-        )
-        full_data = copy.deepcopy(sampled_data)
-
-    train, generalization_holdout = split_holdout(full_data)
-    train, uniform_holdout = split_train_test(train, 0.1)
+        full_data = space.select_subset_V2(opts.density_data)
 
-    generalization_holdout, train, uniform_holdout, full_data = [
-        one_hotify(x, opts.n_attributes, opts.n_values)
-        for x in [generalization_holdout, train, uniform_holdout, full_data]
-    ]
+    train, generalization_holdout = space.split_holdout(full_data)
+    train, uniform_holdout = space.split_train_test(train, 0.1)
 
-    train, validation = ScaledDataset(train, opts.data_scaler), ScaledDataset(train, 1)
+    train, validation = (
+        AttributeValueDataset(space, train, opts.data_scaler),
+        AttributeValueDataset(space, train, 1),
+    )
 
     generalization_holdout, uniform_holdout, full_data = (
-        ScaledDataset(generalization_holdout),
-        ScaledDataset(uniform_holdout),
-        ScaledDataset(full_data),
+        AttributeValueDataset(space, generalization_holdout),
+        AttributeValueDataset(space, uniform_holdout),
+        AttributeValueDataset(space, full_data),
     )
     generalization_holdout_loader, uniform_holdout_loader, full_data_loader = [
-        DataLoader(x, batch_size=opts.batch_size)
+        batch_loader(x, batch_size=opts.batch_size)
         for x in [generalization_holdout, uniform_holdout, full_data]
     ]
 
-    train_loader = DataLoader(train, batch_size=opts.batch_size)
-    validation_loader = DataLoader(validation, batch_size=len(validation))
+    train_loader = batch_loader(train, batch_size=opts.batch_size)
+    validation_loader = batch_loader(validation, batch_size=len(validation))
 
     n_dim = opts.n_attributes * opts.n_values
 
@@ -13,6 +13,7 @@ import torch
 import torch.nn as nn
 from torchvision import datasets
 
+from egg.core.callbacks import load_checkpoint
 from egg.core.interaction import Interaction
 from egg.core.util import move_to
 from egg.zoo.emcom_as_ssl.data import ImageTransformation
@@ -109,7 +110,7 @@ def get_params(
 
 def get_game(params: argparse.Namespace, checkpoint_path: str):
     game = build_game(params)
-    checkpoint = torch.load(checkpoint_path)
+    checkpoint = load_checkpoint(checkpoint_path, load_optimizer=False)
     game.load_state_dict(checkpoint.model_state_dict)
     return game
 
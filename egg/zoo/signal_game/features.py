@@ -12,6 +12,15 @@ import torch.nn.parallel
 import torch.utils.data as data
 
 
+def _concept_tables(obj2id):
+    """Flattens the concept -> image indices lists of `obj2id` into a single array of image indices, grouped by
+    concept, along with the offset and the number of images of each concept in it"""
+    ims = [obj2id[c]["ims"] for c in range(len(obj2id))]
+    counts = np.array([len(x) for x in ims])
+    offsets = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    return np.concatenate(ims).astype(np.int64), offsets, counts
+
+
 class _BatchIterator:
     def __init__(self, loader, n_batches, seed=None):
         self.loader = loader
@@ -30,49 +39,50 @@ class _BatchIterator:
         self.batches_generated += 1
         return batch_data
 
+    def _sample_without_replacement(self, n, k):
+        """For each row, k distinct values in range(n[row]), in random order"""
+        keys = self.random_state.random_sample((len(n), n.max()))
+        keys[np.arange(n.max()) >= n[:, None]] = np.inf
+        return np.argsort(keys, axis=1)[:, :k]
+
     def get_batch(self):
         loader = self.loader
         opt = loader.opt
+        ims, offsets, counts = loader.concept_tables
 
-        C = len(self.loader.dataset.obj2id.keys())  # number of concepts
-        images_indexes_sender = np.zeros((opt.batch_size, opt.game_size))
-
-        for b in range(opt.batch_size):
-            if opt.same:
-                # randomly sample a concept
-                concepts = self.random_state.choice(C, 1)
-                c = concepts[0]
-                ims = loader.dataset.obj2id[c]["ims"]
-                idxs_sender = self.random_state.choice(
-                    ims, opt.game_size, replace=False
-                )
-                images_indexes_sender[b, :] = idxs_sender
-            else:
-                idxs_sender = []
-                # randomly sample k concepts
-                concepts = self.random_state.choice(C, opt.game_size, replace=False)
-                for i, c in enumerate(concepts):
-                    ims = loader.dataset.obj2id[c]["ims"]
-                    idx = self.random_state.choice(ims, 2, replace=False)
-                    idxs_sender.append(idx[0])
-
-                images_indexes_sender[b, :] = np.array(idxs_sender)
-
-        images_vectors_sender = []
-
-        for i in range(opt.game_size):
-            x, _ = loader.dataset[images_indexes_sender[:, i]]
-            images_vectors_sender.append(x)
-
-        images_vectors_sender = torch.stack(images_vectors_sender).contiguous()
-        y = torch.zeros(opt.batch_size).long()
-
-        images_vectors_receiver = torch.zeros_like(images_vectors_sender)
-        for i in range(opt.batch_size):
-            permutation = torch.randperm(opt.game_size)
-
-            images_vectors_receiver[:, i, :] = images_vectors_sender[permutation, i, :]
-            y[i] = permutation.argmin()
+        C = len(counts)  # number of concepts
+
+        if opt.same:
+            # randomly sample a concept per game, and game_size different images of it
+            concepts = self.random_state.randint(C, size=opt.batch_size)
+            ranks = self._sample_without_replacement(counts[concepts], opt.game_size)
+            concepts = concepts[:, None]
+        else:
+            # randomly sample game_size different concepts per game, and an image of each
+            concepts = self._sample_without_replacement(
+                np.full(opt.batch_size, C), opt.game_size
+            )
+            ranks = (
+                self.random_state.random_sample(concepts.shape) * counts[concepts]
+            ).astype(np.int64)
+        images_indexes_sender = torch.from_numpy(ims[offsets[concepts] + ranks])
+
+        # game_size x batch_size x feature size
+        x, _ = loader.dataset[images_indexes_sender.t()]
+        images_vectors_sender = x.contiguous()
+
+        # the receiver sees the images in a random order, the target (first) image being at position y
+        permutations = torch.from_numpy(
+            np.argsort(
+                self.random_state.random_sample((opt.game_size, opt.batch_size)),
+                axis=0,
+            )
+        )
+        images_vectors_receiver = images_vectors_sender.gather(
+            0,
+            permutations.unsqueeze(-1).expand_as(images_vectors_sender),
+        )
+        y = permutations.argmin(dim=0)
         return images_vectors_sender, y, images_vectors_receiver
 
 
@@ -83,6 +93,13 @@ class ImagenetLoader(torch.utils.data.DataLoader):
         self.batches_per_epoch = kwargs.pop("batches_per_epoch")
 
         super(ImagenetLoader, self).__init__(*args, **kwargs)
+        self._concept_tables = None
+
+    @property
+    def concept_tables(self):
+        if self._concept_tables is None:
+            self._concept_tables = _concept_tables(self.dataset.obj2id)
+        return self._concept_tables
 
     def __iter__(self):
         if self.seed is None:
@@ -93,24 +110,31 @@ class ImagenetLoader(torch.utils.data.DataLoader):
 
 
 class ImageNetFeat(data.Dataset):
-    def __init__(self, root, train=True):
-        import h5py
-
+    """
+    The L2-normalised FC features are cached next to the h5 file as a .npy file (rebuilt when older than the h5
+    file), which is memory-mapped
+    (copy-on-write): the pages are shared between DataLoader workers and between jobs using the same data.
+    If the cache cannot be written, the features are kept in memory.
+    """
+
+    def __init__(self, root, train=True, cache=True):
         self.root = os.path.expanduser(root)
         self.train = train  # training set or test set
 
         # FC features
         fc_file = os.path.join(root, "ours_images_single_sm0.h5")
-
-        fc = h5py.File(fc_file, "r")
-        # There should be only 1 key
-        key = list(fc.keys())[0]
-        # Get the data
-        data = torch.FloatTensor(list(fc[key]))
-
-        # normalise data
-        img_norm = torch.norm(data, p=2, dim=1, keepdim=True)
-        normed_data = data / img_norm
+        normed_file = os.path.join(root, "ours_images_single_sm0.normed.npy")
+
+        if (
+            cache
+            and os.path.exists(normed_file)
+            and os.path.getmtime(normed_file) >= os.path.getmtime(fc_file)
+        ):
+            normed_data = np.load(normed_file, mmap_mode="c")
+        else:
+            normed_data = self._load_normed(fc_file)
+            if cache:
+                normed_data = self._save_cache(normed_data, normed_file)
 
         objects_file = os.path.join(root, "ours_images_single_sm0.objects")
         with open(objects_file, "rb") as f:
@@ -120,10 +144,37 @@ class ImageNetFeat(data.Dataset):
             paths = pickle.load(f)
 
         self.create_obj2id(labels)
-        self.data_tensor = normed_data
+        self.data_tensor = torch.from_numpy(normed_data)
         self.labels = labels
         self.paths = paths
 
+    @staticmethod
+    def _load_normed(fc_file):
+        import h5py
+
+        with h5py.File(fc_file, "r") as fc:
+            # There should be only 1 key
+            key = list(fc.keys())[0]
+            # Get the data, read as a whole
+            data = fc[key][()].astype(np.float32, copy=False)
+
+        # normalise data
+        img_norm = np.linalg.norm(data, ord=2, axis=1, keepdims=True)
+        return data / img_norm
+
+    @staticmethod
+    def _save_cache(normed_data, normed_file):
+        # written under a temporary name and renamed, so that concurrent jobs never see a partial file
+        tmp_file = f"{normed_file}.{os.getpid()}.tmp.npy"
+        try:
+            np.save(tmp_file, normed_data)
+            os.replace(tmp_file, normed_file)
+        except OSError:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            return normed_data
+        return np.load(normed_file, mmap_mode="c")
+
     def __getitem__(self, index):
         return self.data_tensor[index], index
 
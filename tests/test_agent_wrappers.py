@@ -7,6 +7,7 @@
 import sys
 from pathlib import Path
 
+import pytest
 import torch
 from torch.nn import functional as F
 
@@ -150,3 +151,317 @@ def test_symbol_wrapper():
     output_gs = receiver(message_gs)
 
     assert output_rf.eq(output_gs).all().item() == 1
+
+
+def test_transformer_sender_incremental_decoding():
+    core.init()
+
+    class Encoder(torch.nn.Module):
+        def __init__(self):
+            super(Encoder, self).__init__()
+            self.fc = torch.nn.Linear(8, 16)
+
+        def forward(self, x, _aux_input=None):
+            return self.fc(x)
+
+    for generate_style in ["standard", "in-place"]:
+        agent = core.TransformerSenderReinforce(
+            Encoder(),
+            vocab_size=5,
+            embed_dim=16,
+            max_len=4,
+            num_layers=2,
+            num_heads=4,
+            hidden_size=32,
+            generate_style=generate_style,
+        )
+        for training in [True, False]:
+            agent.train(training)
+            outputs = []
+            for incremental in [True, False]:
+                agent.incremental = incremental
+                torch.manual_seed(7)
+                outputs.append(agent(BATCH_X))
+
+            for incremental_output, full_output in zip(*outputs):
+                assert incremental_output.size() == torch.Size((8, 5))
+                assert torch.allclose(incremental_output, full_output, atol=1e-5)
+
+        # with dropout, the prefix is recomputed in training, as the cache would keep the dropout masks
+        agent.transformer.layers[0].dropout = 0.5
+        agent.train()
+        outputs = []
+        for incremental in [True, False]:
+            agent.incremental = incremental
+            torch.manual_seed(7)
+            outputs.append(agent(BATCH_X))
+        for incremental_output, full_output in zip(*outputs):
+            assert torch.equal(incremental_output, full_output)
+
+
+def test_rnn_reinforce_message_mask():
+    core.init()
+    received = {}
+
+    def loss(
+        sender_input,
+        message,
+        receiver_input,
+        receiver_output,
+        labels,
+        aux_input,
+        message_mask,
+    ):
+        received.update(aux_input=aux_input, message_mask=message_mask)
+        return F.cross_entropy(receiver_output, labels, reduction="none"), {}
+
+    game = core.SenderReceiverRnnReinforce(
+        core.RnnSenderReinforce(
+            ToyAgent(), vocab_size=3, embed_dim=4, hidden_size=2, max_len=3
+        ),
+        core.RnnReceiverDeterministic(
+            Receiver(), vocab_size=3, embed_dim=4, hidden_size=2
+        ),
+        loss,
+    )
+    _, interaction = game(BATCH_X, BATCH_Y)
+    # the loss gets the mask that callbacks rebuild from the logged lengths
+    assert received["aux_input"] is None and interaction.aux_input is None
+    assert torch.equal(
+        received["message_mask"],
+        core.message_mask(interaction.message_length, interaction.message.size(1)),
+    )
+
+
+def test_rnn_sender_early_exit():
+    core.init()
+
+    class Encoder(torch.nn.Module):
+        def __init__(self):
+            super(Encoder, self).__init__()
+            self.fc = torch.nn.Linear(8, 10)
+
+        def forward(self, x, _aux_input=None):
+            return self.fc(x)
+
+    for cell in ["rnn", "gru", "lstm"]:
+        agent = core.RnnSenderReinforce(
+            Encoder(),
+            vocab_size=3,
+            embed_dim=5,
+            hidden_size=10,
+            max_len=6,
+            num_layers=2,
+            cell=cell,
+        )
+        for training in [True, False]:
+            agent.train(training)
+            agent.early_exit = True
+            message, logprob, entropy = agent(BATCH_X)
+            assert message.size() == logprob.size() == entropy.size() == (8, 7)
+
+            lengths = core.find_lengths(message)
+            after_eos = torch.arange(7).unsqueeze(0) >= lengths.unsqueeze(1)
+            assert (message[after_eos] == 0).all()
+            assert (logprob[after_eos] == 0).all() and (entropy[after_eos] == 0).all()
+
+            logprob.sum().backward()
+
+        agent.early_exit = False
+        full_message, full_logprob, full_entropy = agent(BATCH_X)
+        before_eos = ~after_eos
+        assert (full_message[before_eos] == message[before_eos]).all()
+        assert torch.allclose(full_logprob[before_eos], logprob[before_eos], atol=1e-6)
+        assert torch.allclose(full_entropy[before_eos], entropy[before_eos], atol=1e-6)
+
+        # the buffers follow the dtype of the agent
+        agent.double().early_exit = True
+        _, logprob, entropy = agent(BATCH_X.double())
+        assert logprob.dtype == entropy.dtype == torch.float64
+
+
+def test_vectorized_loss_rnn_gs():
+    core.init()
+
+    class Sender(torch.nn.Module):
+        def __init__(self):
+            super(Sender, self).__init__()
+            self.fc = torch.nn.Linear(8, 6)
+
+        def forward(self, x, _aux_input=None):
+            return self.fc(x)
+
+    class Receiver(torch.nn.Module):
+        def __init__(self):
+            super(Receiver, self).__init__()
+            self.fc = torch.nn.Linear(6, 2)
+
+        def forward(self, x, _input=None, _aux_input=None):
+            return self.fc(x)
+
+    sender = core.RnnSenderGS(
+        Sender(), vocab_size=3, embed_dim=4, hidden_size=6, max_len=5, temperature=1.0
+    )
+    receiver = core.RnnReceiverGS(
+        Receiver(), vocab_size=3, embed_dim=4, hidden_size=6, cell="gru"
+    )
+    game = core.SenderReceiverRnnGS(
+        sender, receiver, core.DiscriminationLoss(vectorized=True), length_cost=0.1
+    )
+    assert game.vectorized_loss
+
+    for training in [True, False]:
+        game.train(training)
+        results = []
+        for loss in [
+            core.DiscriminationLoss(vectorized=True),
+            core.DiscriminationLoss(),
+        ]:
+            game.loss = loss
+            game.vectorized_loss = loss.vectorized
+            torch.manual_seed(0)
+            results.append(game(BATCH_X, BATCH_Y))
+
+        (vectorized_loss, vectorized_interaction), (loss, interaction) = results
+        assert torch.allclose(vectorized_loss, loss)
+        for name in ["acc", "length"]:
+            assert torch.allclose(
+                vectorized_interaction.aux[name], interaction.aux[name]
+            )
+
+        params = list(game.parameters())
+        vectorized_grads = torch.autograd.grad(
+            vectorized_loss, params, allow_unused=True
+        )
+        grads = torch.autograd.grad(loss, params, allow_unused=True)
+        for vectorized_grad, grad in zip(vectorized_grads, grads):
+            if grad is not None:
+                assert torch.allclose(vectorized_grad, grad, atol=1e-6)
+
+
+def test_baselines_in_state_dict():
+    core.init()
+    loss = lambda sender_input, message, receiver_input, receiver_output, labels, aux_input: (
+        -(receiver_output == labels).float(),
+        {},
+    )
+
+    def make_game():
+        sender = core.ReinforceWrapper(ToyAgent())
+        receiver = core.ReinforceDeterministicWrapper(Receiver())
+        return core.SymbolGameReinforce(
+            sender, receiver, loss, baseline_type=core.baselines.EMABaseline
+        )
+
+    game = make_game()
+    game(BATCH_X, BATCH_Y)
+    assert game.baseline.n_points == 1
+
+    restored = make_game()
+    restored.load_state_dict(game.state_dict())
+    assert restored.baseline.n_points == 1
+    assert torch.equal(restored.baseline.ema, game.baseline.ema)
+
+    # checkpoints without the baselines state are still accepted
+    state_dict = {
+        k: v for k, v in game.state_dict().items() if not k.endswith("_extra_state")
+    }
+    make_game().load_state_dict(state_dict)
+
+
+class CountingReceiver(torch.nn.Module):
+    def __init__(self, receiver):
+        super().__init__()
+        self.receiver = receiver
+        self.n_rows = 0
+
+    def forward(self, message, *args):
+        self.n_rows += message.size(0)
+        return self.receiver(message, *args)
+
+
+def test_eval_message_deduplication():
+    core.init()
+    loss = lambda sender_input, message, receiver_input, receiver_output, labels, aux_input: (
+        F.cross_entropy(receiver_output, labels, reduction="none"),
+        {},
+    )
+    # the 8 inputs are mapped onto 2 messages
+    sender_input = BATCH_X[:2].repeat(4, 1)
+    labels = torch.tensor([0, 1] * 4)
+
+    def check(make_game):
+        game, deduplicated = make_game(False), make_game(True)
+        with torch.no_grad():
+            # the two distinct inputs get distinct symbols
+            game.sender.agent.fc1.weight.copy_(torch.eye(2, 8))
+        deduplicated.load_state_dict(game.state_dict())
+        game.eval(), deduplicated.eval()
+        with torch.no_grad():
+            expected_loss, expected = game(sender_input, labels)
+            loss_value, interaction = deduplicated(sender_input, labels)
+        assert torch.allclose(expected_loss, loss_value)
+        assert torch.allclose(expected.receiver_output, interaction.receiver_output)
+        n_rows = deduplicated.receiver.n_rows
+        assert n_rows <= 2
+
+        # per-example receiver inputs prevent the deduplication
+        deduplicated(sender_input, labels, receiver_input=sender_input)
+        assert deduplicated.receiver.n_rows == n_rows + 8
+
+    check(
+        lambda dedup: core.SymbolGameGS(
+            core.GumbelSoftmaxWrapper(ToyAgent()),
+            CountingReceiver(core.SymbolReceiverWrapper(Receiver(), 2, 2)),
+            loss,
+            deduplicate_messages=dedup,
+        )
+    )
+    check(
+        lambda dedup: core.SymbolGameReinforce(
+            core.ReinforceWrapper(ToyAgent()),
+            CountingReceiver(
+                core.ReinforceDeterministicWrapper(
+                    core.SymbolReceiverWrapper(Receiver(), 2, 2)
+                )
+            ),
+            loss,
+            deduplicate_messages=dedup,
+        )
+    )
+    check(
+        lambda dedup: core.SenderReceiverRnnReinforce(
+            core.RnnSenderReinforce(
+                ToyAgent(), vocab_size=3, embed_dim=4, hidden_size=2, max_len=3
+            ),
+            CountingReceiver(
+                core.RnnReceiverDeterministic(
+                    Receiver(), vocab_size=3, embed_dim=4, hidden_size=2
+                )
+            ),
+            loss,
+            deduplicate_messages=dedup,
+        )
+    )
+
+
+def test_eval_message_deduplication_non_batch_outputs():
+    class ScalarOutputsReceiver(torch.nn.Module):
+        def forward(self, message, _input=None, _aux_input=None):
+            # a per-message output, a placeholder log-prob, and batch-level outputs
+            return message.float(), torch.zeros(1), torch.arange(2), "unchanged"
+
+    for message in [torch.tensor([0, 1, 1, 0, 1]), torch.ones(5).long()]:
+        output, log_prob, batch_level, name = core.util.call_on_unique_messages(
+            ScalarOutputsReceiver(), message, expand=(0, 1)
+        )
+        assert torch.equal(output, message.float())
+        assert (log_prob == 0).all() and log_prob.numel() in (1, 5)
+        # only the named outputs are expanded, even if their size matches the number of distinct messages
+        assert torch.equal(batch_level, torch.arange(2))
+        assert name == "unchanged"
+
+    with pytest.raises(AssertionError):
+        core.util.call_on_unique_messages(
+            ScalarOutputsReceiver(), torch.tensor([0, 1, 2, 0]), expand=(2,)
+        )
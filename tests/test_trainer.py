@@ -2,10 +2,15 @@
 
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
+import json
+import os
 import shutil
 import sys
+import warnings
 from pathlib import Path
 
+import numpy as np
+import pytest
 import torch
 from torch.nn import functional as F
 
@@ -115,6 +120,236 @@ def test_snapshoting():
     """
 
 
+def test_async_snapshoting(tmp_path):
+    core.init()
+    sender = core.GumbelSoftmaxWrapper(ToyAgent(), temperature=1)
+    receiver = Receiver()
+    loss = lambda sender_input, message, receiver_input, receiver_output, labels, aux_input: (
+        F.cross_entropy(receiver_output, labels),
+        {},
+    )
+
+    game = core.SymbolGameGS(sender, receiver, loss)
+    optimizer = torch.optim.Adam(game.parameters())
+    saver = core.CheckpointSaver(
+        checkpoint_path=tmp_path, max_checkpoints=2, asynchronous=True
+    )
+
+    trainer = core.Trainer(game, optimizer, train_data=Dataset(), callbacks=[saver])
+    trainer.train(n_epochs=6)
+    assert sorted(x.name for x in tmp_path.iterdir()) == [
+        "5.index.json",
+        "5.tar",
+        "6.index.json",
+        "6.tar",
+        "final.index.json",
+        "final.tar",
+    ]
+    assert saver.get_checkpoint_files() == ["5.tar", "6.tar", "final.tar"]
+
+    final = torch.load(tmp_path / "final.tar", weights_only=False)
+    for k, v in game.state_dict().items():
+        assert torch.equal(final.model_state_dict[k], v)
+    # the snapshot of epoch 5 was not affected by the later updates
+    epoch_5 = torch.load(tmp_path / "5.tar", weights_only=False)
+    weight = "sender.agent.fc1.weight"
+    assert not torch.equal(
+        epoch_5.model_state_dict[weight], final.model_state_dict[weight]
+    )
+
+
+def test_prefetching():
+    def train(prefetch):
+        core.init(params=["--random_seed=1"])
+        sender = core.GumbelSoftmaxWrapper(ToyAgent(), temperature=1)
+        loss = lambda sender_input, message, receiver_input, receiver_output, labels, aux_input: (
+            F.cross_entropy(receiver_output, labels),
+            {"acc": (receiver_output.argmax(dim=1) == labels).float()},
+        )
+        game = core.SymbolGameGS(sender, Receiver(), loss)
+        optimizer = torch.optim.Adam(game.parameters(), lr=1e-2)
+        data = [(BATCH_X[i : i + 2], BATCH_Y[i : i + 2]) for i in range(0, 8, 2)]
+
+        trainer = core.Trainer(
+            game, optimizer, train_data=data, validation_data=data, prefetch=prefetch
+        )
+        trainer.train(n_epochs=3)
+        return game.sender.agent.fc1.weight, trainer.eval()[1]
+
+    weight, interaction = train(prefetch=0)
+    prefetched_weight, prefetched_interaction = train(prefetch=2)
+    assert torch.equal(weight, prefetched_weight)
+    assert torch.equal(interaction.sender_input, prefetched_interaction.sender_input)
+    assert torch.equal(interaction.message, prefetched_interaction.message)
+
+
+def test_prefetching_global_rng_data():
+    def train(prefetch):
+        core.init(params=["--random_seed=1"])
+        sender = core.GumbelSoftmaxWrapper(ToyAgent(), temperature=1)
+        loss = lambda sender_input, message, receiver_input, receiver_output, labels, aux_input: (
+            F.cross_entropy(receiver_output, labels),
+            {},
+        )
+        game = core.SymbolGameGS(sender, Receiver(), loss)
+        optimizer = torch.optim.Adam(game.parameters(), lr=1e-2)
+        trainer = core.Trainer(
+            game, optimizer, train_data=RandomData(), prefetch=prefetch
+        )
+        trainer.train(n_epochs=3)
+        return game.sender.agent.fc1.weight
+
+    weight = train(prefetch=0)
+    # the noise is drawn from the global torch RNG, which the training samples from as well
+    with pytest.warns(UserWarning, match="not prefetched"):
+        prefetched_weight = train(prefetch=2)
+    assert torch.equal(weight, prefetched_weight)
+
+
+def test_step_profiler(tmp_path):
+    core.init()
+    sender = core.GumbelSoftmaxWrapper(ToyAgent(), temperature=1)
+    loss = lambda sender_input, message, receiver_input, receiver_output, labels, aux_input: (
+        F.cross_entropy(receiver_output, labels),
+        {},
+    )
+    game = core.SymbolGameGS(sender, Receiver(), loss)
+    optimizer = torch.optim.Adam(game.parameters())
+    data = [(BATCH_X[i : i + 2], BATCH_Y[i : i + 2]) for i in range(0, 8, 2)]
+
+    profiler = core.StepProfiler(
+        summary_path=tmp_path / "profile.json",
+        trace_steps=(2, 3),
+        trace_dir=tmp_path,
+        print_summary=False,
+    )
+    trainer = core.Trainer(
+        game,
+        optimizer,
+        train_data=data,
+        callbacks=[core.ConsoleLogger(), profiler],
+    )
+    trainer.train(n_epochs=2)
+
+    with open(tmp_path / "profile.json") as f:
+        history = json.load(f)
+    assert [h["epoch"] for h in history] == [1, 2]
+    assert history[0]["steps"] == 4 and history[0]["samples"] == 8
+    assert set(history[0]["ms_per_step"]) == {
+        "data",
+        "to_device",
+        "forward",
+        "backward",
+        "optimizer",
+        "logs",
+        "callbacks",
+    }
+    assert set(history[0]["callback_ms_per_step"]) == {
+        "ConsoleLogger",
+        "StepProfiler",
+    }
+    assert (tmp_path / "steps_2_3.json").exists()
+
+
+def test_checkpoint_index(tmp_path):
+    core.init()
+    sender = core.GumbelSoftmaxWrapper(ToyAgent(), temperature=1)
+    loss = lambda sender_input, message, receiver_input, receiver_output, labels, aux_input: (
+        F.cross_entropy(receiver_output, labels),
+        {"acc": (receiver_output.argmax(dim=1) == labels).float()},
+    )
+    game = core.SymbolGameGS(sender, Receiver(), loss)
+    optimizer = torch.optim.Adam(game.parameters(), lr=0.1)
+
+    trainer = core.Trainer(
+        game,
+        optimizer,
+        train_data=Dataset(),
+        validation_data=Dataset(),
+        callbacks=[core.CheckpointSaver(tmp_path, asynchronous=True)],
+    )
+    trainer.train(n_epochs=3)
+
+    entries = core.callbacks.read_checkpoint_index(tmp_path)
+    assert [entry["file"] for entry in entries] == [
+        "1.tar",
+        "2.tar",
+        "3.tar",
+        "final.tar",
+    ]
+    assert [entry["epoch"] for entry in entries] == [1, 2, 3, 3]
+    assert entries[0]["size"] == (tmp_path / "1.tar").stat().st_size
+    # the validation metrics are added once the validation is done
+    assert set(entries[0]["metrics"]["validation"]) == {"loss", "acc"}
+
+    assert core.find_checkpoint(tmp_path) == tmp_path / "final.tar"
+    best = core.find_checkpoint(tmp_path, metric="loss", mode="min")
+    losses = dict(
+        (entry["file"], entry["metrics"]["validation"]["loss"]) for entry in entries
+    )
+    assert losses[best.name] == min(losses.values())
+
+    checkpoint = core.load_checkpoint(best, load_optimizer=False, verify=True)
+    assert checkpoint.optimizer_state_dict is None
+    assert torch.equal(
+        checkpoint.model_state_dict["sender.agent.fc1.weight"],
+        torch.load(best, weights_only=False).model_state_dict[
+            "sender.agent.fc1.weight"
+        ],
+    )
+
+    trainer = core.Trainer(game, optimizer, train_data=Dataset())
+    trainer.load_from_latest(tmp_path)
+    assert trainer.start_epoch == 3
+
+
+class RandomData:
+    """Draws a seed from the global numpy RNG for each epoch, and noise from the global torch RNG for each batch"""
+
+    def __iter__(self):
+        random_state = np.random.RandomState(np.random.randint(2 ** 31))
+        for _ in range(4):
+            idx = torch.from_numpy(random_state.randint(8, size=2))
+            yield BATCH_X[idx] + 0.1 * torch.rand(2, 8), BATCH_Y[idx]
+
+
+def test_mid_epoch_resume(tmp_path):
+    def train(seed, callbacks=(), load_from_checkpoint=None):
+        params = [f"--random_seed={seed}"]
+        if load_from_checkpoint:
+            params.append(f"--load_from_checkpoint={load_from_checkpoint}")
+        core.init(params=params)
+        sender = core.GumbelSoftmaxWrapper(ToyAgent(), temperature=1)
+        loss = lambda sender_input, message, receiver_input, receiver_output, labels, aux_input: (
+            F.cross_entropy(receiver_output, labels),
+            {},
+        )
+        game = core.SymbolGameGS(sender, Receiver(), loss)
+        optimizer = torch.optim.Adam(game.parameters(), lr=1e-2)
+        trainer = core.Trainer(
+            game, optimizer, train_data=RandomData(), callbacks=list(callbacks)
+        )
+        trainer.train(n_epochs=2)
+        return game.sender.agent.fc1.weight, trainer
+
+    weight, _ = train(seed=1)
+
+    # a checkpoint is taken at the 6th step, i.e. in the middle of the second epoch
+    saver = core.CheckpointSaver(tmp_path, checkpoint_freq=0, every_steps=6)
+    interrupted_weight, _ = train(seed=1, callbacks=[saver])
+    assert torch.equal(weight, interrupted_weight)
+    checkpoint = torch.load(tmp_path / "latest.tar", weights_only=False)
+    assert checkpoint.epoch == 1
+    assert checkpoint.training_state["batch_id"] == 2
+
+    # resuming from it with a different seed gives the same result as training without interruption
+    resumed_weight, trainer = train(
+        seed=2, load_from_checkpoint=tmp_path / "latest.tar"
+    )
+    assert trainer.global_step == 8
+    assert torch.equal(weight, resumed_weight)
+
+
 def test_max_snapshoting():
     CHECKPOINT_PATH = Path("./test_checkpoints")
 
@@ -143,7 +378,8 @@ def test_max_snapshoting():
     assert (CHECKPOINT_PATH / Path("5.tar")).exists()
     assert (CHECKPOINT_PATH / Path("6.tar")).exists()
     assert (CHECKPOINT_PATH / Path("final.tar")).exists()
-    assert len([x for x in CHECKPOINT_PATH.glob("**/*") if x.is_file()]) == 3
+    assert len([x for x in CHECKPOINT_PATH.glob("**/*.tar") if x.is_file()]) == 3
+    assert len(list(CHECKPOINT_PATH.glob("**/*.index.json"))) == 3
     shutil.rmtree(CHECKPOINT_PATH)  # Clean-up
     """
     The following code randomly fail on the CI server due to a weird behavior of system in assigning the same
@@ -170,3 +406,310 @@ def test_early_stopping():
     )
     trainer.train(1)
     assert trainer.should_stop
+
+
+def test_running_log_aggregation():
+    game, data = MockGame(), Dataset()
+    early_stopper = core.EarlyStopperAccuracy(threshold=0.9)
+    trainer = core.Trainer(
+        game=game,
+        optimizer=torch.optim.Adam(game.parameters()),
+        train_data=data,
+        validation_data=data,
+        callbacks=[early_stopper],
+        log_aggregation="running",
+    )
+    trainer.train(1)
+    assert trainer.should_stop
+    assert trainer.validation_statistics.count["acc"] == 1
+    _, logs = early_stopper.validation_stats[-1]
+    assert logs.aux["acc"].item() == 1.0
+
+
+def test_ensemble_training(tmp_path):
+    core.init()
+    loss = lambda sender_input, message, receiver_input, receiver_output, labels, aux_input: (
+        F.cross_entropy(receiver_output, labels),
+        {"acc": (receiver_output.argmax(dim=1) == labels).float()},
+    )
+
+    def game_factory():
+        sender = core.GumbelSoftmaxWrapper(ToyAgent(), temperature=1)
+        return core.SymbolGameGS(sender, Receiver(), loss)
+
+    # the vmapped and the sequential runs of the members agree
+    vectorized = core.EnsembleGame(game_factory, seeds=[1, 2, 3])
+    sequential = core.EnsembleGame(game_factory, seeds=[1, 2, 3], vectorize=False)
+    for game in [vectorized, sequential]:
+        game.eval()
+    with torch.no_grad():
+        vectorized_loss, vectorized_logs = vectorized(BATCH_X, BATCH_Y)
+        sequential_loss, sequential_logs = sequential(BATCH_X, BATCH_Y)
+    assert vectorized.vectorize
+    assert torch.allclose(vectorized_loss, sequential_loss)
+    # the interactions of the members are concatenated
+    assert vectorized_logs.message.size() == (24, 2)
+    assert torch.equal(vectorized_logs.labels, BATCH_Y.repeat(3))
+    assert torch.equal(vectorized_logs.message, sequential_logs.message)
+    for k in range(3):
+        assert torch.allclose(
+            vectorized_logs.aux[f"loss_member{k}"],
+            sequential_logs.aux[f"loss_member{k}"],
+        )
+    # the reported loss is the mean over the members
+    member_losses = [vectorized_logs.aux[f"loss_member{k}"][0] for k in range(3)]
+    assert torch.allclose(vectorized_loss, torch.stack(member_losses).mean())
+
+    # the reported loss is the optimised one: each member gets 1/K of the gradient of a solo run (run one after
+    # another, the members sample their messages as solo runs do)
+    solo = core.EnsembleGame(game_factory, seeds=[2], vectorize=False)
+    for game in [sequential, solo]:
+        game.train()
+        game(BATCH_X, BATCH_Y)[0].backward()
+    assert torch.allclose(
+        3 * sequential.members[1].sender.agent.fc1.weight.grad,
+        solo.members[0].sender.agent.fc1.weight.grad,
+    )
+
+    game = core.EnsembleGame(game_factory, seeds=[1, 2, 3])
+    early_stopper = core.EnsembleEarlyStopperAccuracy(threshold=1.0)
+    trainer = core.Trainer(
+        game,
+        torch.optim.Adam(game.parameters(), lr=1e-1),
+        train_data=Dataset(),
+        validation_data=Dataset(),
+        callbacks=[
+            early_stopper,
+            core.EnsembleCheckpointSaver(checkpoint_path=tmp_path),
+        ],
+    )
+    trainer.train(100)
+    assert trainer.should_stop and not any(game.active)
+    assert game.vectorize
+
+    _, logs = early_stopper.validation_stats[-1]
+    for k in range(3):
+        assert logs.aux[f"acc_member{k}"].mean() == 1.0
+
+    # the member checkpoints can be loaded by a trainer of the game alone
+    member = game_factory()
+    member_trainer = core.Trainer(
+        member, torch.optim.Adam(member.parameters(), lr=1e-1), train_data=Dataset()
+    )
+    member_trainer.load_from_checkpoint(tmp_path / "seed2" / "final.tar")
+    assert torch.equal(
+        member.sender.agent.fc1.weight, game.members[1].sender.agent.fc1.weight
+    )
+
+
+def test_ensemble_sequential_fallback():
+    core.init()
+    loss = lambda sender_input, message, receiver_input, receiver_output, labels, aux_input: (
+        (receiver_output != labels).float(),
+        {},
+    )
+
+    def game_factory():
+        # the mean baseline is updated in place with a shape that vmap cannot batch
+        sender = core.ReinforceWrapper(ToyAgent())
+        receiver = core.ReinforceDeterministicWrapper(Receiver())
+        return core.SymbolGameReinforce(sender, receiver, loss)
+
+    game = core.EnsembleGame(game_factory, seeds=[1, 2])
+    sequential = core.EnsembleGame(game_factory, seeds=[1, 2], vectorize=False)
+    with pytest.warns(UserWarning, match="cannot be vmapped"):
+        game_loss, _ = game(BATCH_X, BATCH_Y)
+    sequential_loss, _ = sequential(BATCH_X, BATCH_Y)
+    assert not game.vectorize
+    assert torch.allclose(game_loss, sequential_loss)
+    # the failed attempt did not update the baseline of the first member
+    baseline, sequential_baseline = (
+        game.members[0].baseline,
+        sequential.members[0].baseline,
+    )
+    assert baseline.n_points == sequential_baseline.n_points == 1
+    assert torch.equal(baseline.mean_baseline, sequential_baseline.mean_baseline)
+
+
+def test_ensemble_python_state():
+    class Game(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.fc = torch.nn.Linear(8, 1)
+            self.n_calls = 0
+
+        def forward(self, x, labels):
+            # vmappable, but the counter would be shared by the members under vmap
+            self.n_calls += 1
+            loss = (self.fc(x).squeeze(1) - labels).pow(2)
+            return loss.mean(), core.Interaction(
+                x, None, labels, None, None, None, None, {}
+            )
+
+    game = core.EnsembleGame(Game, seeds=[1, 2])
+    with pytest.warns(UserWarning, match="updates python-side state"):
+        game(BATCH_X, BATCH_Y.float())
+    assert not game.vectorize
+    assert [member.n_calls for member in game.members] == [1, 1]
+
+
+def test_population_game_fallback():
+    class Mechanics(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.n_calls = 0
+
+        def forward(self, sender, receiver, loss, x, labels):
+            # vmappable, but the counter would be shared by the pairs under vmap
+            self.n_calls += 1
+            loss = F.cross_entropy(receiver(sender(x), None, None), labels)
+            return loss, core.Interaction(x, None, labels, None, None, None, None, {})
+
+    agents = [ToyAgent() for _ in range(2)]
+    sampler = core.UniformAgentSampler(agents, [Receiver()], [None])
+    game = core.PopulationGame(Mechanics(), sampler, n_pairs=4)
+    with pytest.warns(UserWarning, match="updates python-side state"):
+        game(BATCH_X, BATCH_Y)
+    assert not game.vectorize and game.game.n_calls == 4
+
+    # agents of different architectures cannot be stacked, and are run one after another
+    class WiderAgent(ToyAgent):
+        def __init__(self):
+            super().__init__()
+            self.fc2 = torch.nn.Linear(2, 2)
+
+    sampler = core.FullSweepAgentSampler(
+        [ToyAgent(), WiderAgent()], [Receiver()], [None]
+    )
+    game = core.PopulationGame(Mechanics(), sampler, n_pairs=2)
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        game(BATCH_X, BATCH_Y)
+    assert game.vectorize and game.game.n_calls == 2
+
+
+def _distributed_worker(checkpoint_dir):
+    opts = core.init(
+        params=[
+            "--no_cuda",
+            "--random_seed=7",
+            "--batch_size=4",
+            f"--checkpoint_dir={checkpoint_dir}",
+        ]
+    )
+    assert opts.distributed_context.is_distributed
+    assert opts.distributed_context.backend == "gloo"
+
+    dataset = torch.utils.data.TensorDataset(BATCH_X, BATCH_Y)
+    train_data = core.distributed_data_loader(dataset, batch_size=opts.batch_size)
+    # each of the two workers gets a single batch holding a half of the data
+    assert len(train_data) == 1
+
+    sender = core.GumbelSoftmaxWrapper(ToyAgent(), temperature=1)
+    receiver = Receiver()
+    loss = lambda sender_input, message, receiver_input, receiver_output, labels, aux_input: (
+        F.cross_entropy(receiver_output, labels),
+        {"acc": (receiver_output.argmax(dim=1) == labels).float()},
+    )
+    game = core.SymbolGameGS(sender, receiver, loss)
+    optimizer = torch.optim.Adam(game.parameters(), lr=1e-2)
+
+    trainer = core.Trainer(
+        game=game,
+        optimizer=optimizer,
+        train_data=train_data,
+        validation_data=train_data,
+    )
+    trainer.train(n_epochs=3)
+
+    _, interaction = trainer.eval()
+    # the interactions of both workers are gathered
+    assert interaction.size == 8
+
+    # the gradients are averaged, hence the replicas stay in sync
+    weight = trainer.game.module.sender.agent.fc1.weight.detach().clone()
+    weights = [torch.zeros_like(weight) for _ in range(2)]
+    torch.distributed.all_gather(weights, weight)
+    assert torch.equal(weights[0], weights[1])
+
+    # workers can gather interactions of different sizes
+    rank = opts.distributed_context.rank
+    local = core.Interaction(
+        torch.full((rank + 1, 2), float(rank)),
+        None,
+        torch.arange(rank + 1),
+        None,
+        None,
+        None,
+        None,
+        {"flag": torch.ones(rank + 1).bool()},
+    )
+    gathered = core.Interaction.gather_distributed_interactions(local)
+    assert torch.equal(gathered.sender_input[:, 0], torch.tensor([0.0, 1.0, 1.0]))
+    assert torch.equal(gathered.labels, torch.tensor([0, 0, 1]))
+    assert gathered.aux["flag"].dtype == torch.bool and gathered.aux["flag"].all()
+
+    # a worker can hold no row of a field, or of all of them
+    local = core.Interaction(
+        torch.full((rank, 2), float(rank)),
+        None,
+        None,
+        None,
+        None,
+        None,
+        None,
+        {"empty": torch.zeros(0, 3)},
+    )
+    gathered = core.Interaction.gather_distributed_interactions(local)
+    assert torch.equal(gathered.sender_input, torch.ones(1, 2))
+    assert gathered.aux["empty"].size() == (0, 3)
+
+    # with the metrics-only reduction, the full logs are only gathered for the dumped epochs
+    sizes = _LogSizes()
+    trainer = core.Trainer(
+        game=game,
+        optimizer=optimizer,
+        train_data=core.distributed_data_loader(dataset, batch_size=3),
+        distributed_reduction="metrics",
+        callbacks=[
+            sizes,
+            core.InteractionSaver(train_epochs=[2], checkpoint_dir=checkpoint_dir),
+        ],
+    )
+    trainer.train(n_epochs=3)
+    # the workers get batches of 3 and 1 examples
+    assert sizes.batch_sizes == [3, 1] * 3
+    assert sizes.epoch_sizes == [None, 8, None]
+    accuracy = trainer.train_statistics.mean["acc"]
+    assert trainer.train_statistics.count["acc"] == 8
+    accuracies = [torch.zeros_like(accuracy) for _ in range(2)]
+    torch.distributed.all_gather(accuracies, accuracy)
+    assert torch.equal(accuracies[0], accuracies[1])
+
+
+class _LogSizes(core.Callback):
+    def __init__(self):
+        self.batch_sizes, self.epoch_sizes = [], []
+
+    def on_batch_end(self, logs, loss, batch_id, is_training=True):
+        self.batch_sizes.append(logs.size)
+
+    def on_epoch_end(self, loss, logs, epoch):
+        self.epoch_sizes.append(logs.size if logs.sender_input is not None else None)
+
+
+def test_cpu_distributed_training(tmp_path):
+    import socket
+
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+
+    core.launch_local_workers(_distributed_worker, 2, tmp_path, port=port)
+    # only the leader saves checkpoints and aggregated interactions
+    assert sorted(os.listdir(tmp_path)) == [
+        "final.index.json",
+        "final.tar",
+        "interactions",
+    ]
+    assert os.listdir(tmp_path / "interactions" / "train") == ["epoch_2"]